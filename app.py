@@ -7,189 +7,132 @@
 
 import streamlit as st
 import pandas as pd
-from rapidfuzz import process, fuzz
 import plotly.express as px
+import os
 import re
+import json
+import time
+import functools
+import threading
 import gspread
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from gspread_dataframe import set_with_dataframe
 import numpy as np # Diperlukan untuk HPP
+from pipeline import (
+    PAIR_CACHE_META, pair_cache_dir, blocking_recall_report, brands_by_name, latest_source_rows,
+    load_dataset as pipeline_load_dataset, load_snapshot, read_snapshot_meta, replace_snapshot_matches,
+    run_price_comparison_update, compute_data_version, derive_frames, MY_STORE_NAME,
+    build_price_comparison, availability_changes, AVAILABILITY_CHANGES, merge_hpp, hpp_tables, hpp_index, hpp_margin_history, export_frame, export_formats, EXPORT_FORMATS,
+    Diagnostics, activate_diagnostics, current_diagnostics, diagnostic_stage, instrument_client, record_cache, record_frame,
+    use_diagnostics, QuotaSheetsClient, SHEETS_REQUESTS_PER_MINUTE, DatasetRegistry, SharedDataset, SessionToken, history_path, history_bounds, query_history, ensure_history,
+    change_feed, CHANGE_EVENT_TYPES
+)
 
 # ================================
 # KONFIGURASI HALAMAN
 # ================================
 st.set_page_config(layout="wide", page_title="Dashboard Analisis v5.0")
+# Penanda rerun penuh skrip; fragment yang dijalankan ulang sendiri tidak menaikkan nomor ini
+SCRIPT_STARTED = time.perf_counter()
+st.session_state['script_run_id'] = st.session_state.get('script_run_id', 0) + 1
+
+# Mode diagnostik: satu pencatat per rerun penuh (5 terakhir disimpan); mati = tanpa pencatat, instrumentasi jadi no-op
+DIAGNOSTICS_HISTORY = 5
+diagnostics_on = st.sidebar.toggle("🩺 Mode Diagnostik", key="diagnostics_on",
+                                   help="Catat waktu per tahap, panggilan API Sheets, memori DataFrame dan hit/miss cache.")
+run_diagnostics = Diagnostics(f"rerun {st.session_state['script_run_id']}") if diagnostics_on else None
+activate_diagnostics(run_diagnostics)
+if run_diagnostics is not None:
+    diagnostics_runs = st.session_state.setdefault('diagnostics_runs', [])
+    diagnostics_runs.append(run_diagnostics)
+    del diagnostics_runs[:-DIAGNOSTICS_HISTORY]
 
 # ================================
 # FUNGSI KONEKSI GOOGLE SHEETS
 # ================================
 @st.cache_resource(show_spinner="Menghubungkan ke Google Sheets...")
 def connect_to_gsheets():
-    # Cukup panggil satu kunci utama dari secrets
+    # Cukup panggil satu kunci utama dari secrets. Satu klien (satu sesi HTTP & satu anggaran kuota)
+    # dipakai bersama oleh semua sesi, pemuatan data dan job pembaruan.
     gc = gspread.service_account_from_dict(st.secrets["gcp_service_account"])
-    return gc
+    return QuotaSheetsClient(gc, requests_per_minute=int(st.secrets.get("SHEETS_REQUESTS_PER_MINUTE", SHEETS_REQUESTS_PER_MINUTE)))
 
 # ================================
 # FUNGSI MEMUAT SEMUA DATA
 # ================================
-@st.cache_data(show_spinner="Mengambil data terbaru dari Google Sheets...")
-def load_all_data(spreadsheet_key):
-    gc = connect_to_gsheets()
-    try:
-        spreadsheet = gc.open_by_key(spreadsheet_key)
-    except Exception as e:
-        st.error(f"GAGAL KONEKSI/OPEN SPREADSHEET: {e}")
-        return None, None, None
-
-    # Nama sheet yang relevan sekarang termasuk DATABASE secara eksplisit
-    sheet_names = [
-        "DATABASE", "DB KLIK - REKAP - READY", "DB KLIK - REKAP - HABIS",
-        "ABDITAMA - REKAP - READY", "ABDITAMA - REKAP - HABIS", "LEVEL99 - REKAP - READY", "LEVEL99 - REKAP - HABIS",
-        "JAYA PC - REKAP - READY", "JAYA PC - REKAP - HABIS", "MULTIFUNGSI - REKAP - READY", "MULTIFUNGSI - REKAP - HABIS",
-        "IT SHOP - REKAP - READY", "IT SHOP - REKAP - HABIS", "SURYA MITRA ONLINE - REKAP - READY", "SURYA MITRA ONLINE - REKAP - HABIS",
-        "GG STORE - REKAP - READY", "GG STORE - REKAP - HABIS", "TECH ISLAND - REKAP - READY", "TECH ISLAND - REKAP - HABIS",
-        "LOGITECH - REKAP - READY", "LOGITECH - REKAP - HABIS"
-    ]
-    rekap_list_df, database_df, matches_df = [], pd.DataFrame(), pd.DataFrame()
-
-    for sheet_name in sheet_names:
-        try:
-            worksheet = spreadsheet.worksheet(sheet_name)
-            all_values = worksheet.get_all_values()
-            if not all_values or len(all_values) < 2: continue
-            header, data = all_values[0], all_values[1:]
-            df_sheet = pd.DataFrame(data, columns=header)
-            if '' in df_sheet.columns: df_sheet = df_sheet.drop(columns=[''])
-            if "DATABASE" in sheet_name.upper():
-                database_df = df_sheet
-            elif "REKAP" in sheet_name.upper():
-                store_name_match = re.match(r"^(.*?) - REKAP", sheet_name, re.IGNORECASE)
-                toko_name = store_name_match.group(1).strip() if store_name_match else "Toko Tak Dikenal"
-                df_sheet['Toko'] = toko_name
-                if 'Status' not in df_sheet.columns:
-                    df_sheet['Status'] = 'Tersedia' if "READY" in sheet_name.upper() else 'Habis'
-                rekap_list_df.append(df_sheet)
-        except gspread.exceptions.WorksheetNotFound: continue
-        except Exception as e: st.warning(f"Gagal baca sheet '{sheet_name}': {e}"); continue
-
-    if not rekap_list_df:
-        st.error("Tidak ada data REKAP yang berhasil dimuat."); return None, None, None
-    rekap_df = pd.concat(rekap_list_df, ignore_index=True)
-    rekap_df.columns = [str(c).strip().upper() for c in rekap_df.columns]
-    
-    final_rename = {
-        'NAMA': 'Nama Produk', 'TERJUAL/BLN': 'Terjual per Bulan', 
-        'TANGGAL': 'Tanggal', 'HARGA': 'Harga', 'BRAND': 'Brand', 
-        'STOK': 'Stok', 'TOKO': 'Toko', 'STATUS': 'Status'
-    }
-    rekap_df.rename(columns=final_rename, inplace=True)
-
-    if 'Nama Produk' in rekap_df.columns:
-        rekap_df['Nama Produk'] = rekap_df['Nama Produk'].astype(str).str.strip()
-    if 'Tanggal' in rekap_df.columns:
-        rekap_df['Tanggal'] = pd.to_datetime(rekap_df['Tanggal'], errors='coerce', dayfirst=True)
-    if 'Harga' in rekap_df.columns:
-        rekap_df['Harga'] = pd.to_numeric(rekap_df['Harga'].astype(str).str.replace(r'[^\d]', '', regex=True), errors='coerce')
-    if 'Terjual per Bulan' in rekap_df.columns:
-        rekap_df['Terjual per Bulan'] = pd.to_numeric(rekap_df['Terjual per Bulan'], errors='coerce').fillna(0)
-    
-    rekap_df.dropna(subset=['Tanggal', 'Nama Produk', 'Harga', 'Toko'], inplace=True)
-    if 'Brand' not in rekap_df.columns or rekap_df['Brand'].isnull().all():
-        rekap_df['Brand'] = rekap_df['Nama Produk'].str.split(n=1).str[0].str.upper()
-    rekap_df['Omzet'] = (rekap_df['Harga'].fillna(0) * rekap_df.get('Terjual per Bulan', 0).fillna(0)).astype(int)
+# Pengambilan, normalisasi, snapshot & pencocokan ada di pipeline.py (tanpa Streamlit, dipakai juga oleh cron).
+def st_notify(level, message):
+    getattr(st, level)(message)
+
+def load_dataset(spreadsheet_key, snapshot_dir, max_age_minutes, force_refresh=False, report_timing=False, incremental=True):
+    with st.spinner("Mengambil data terbaru dari Google Sheets..."):
+        return pipeline_load_dataset(
+            instrument_client(connect_to_gsheets(), current_diagnostics()), spreadsheet_key, snapshot_dir, max_age_minutes, force_refresh=force_refresh,
+            report_timing=report_timing, incremental=incremental, notify=st_notify
+        )
 
-    try:
-        matches_sheet = spreadsheet.worksheet("HASIL_MATCHING")
-        matches_df = pd.DataFrame(matches_sheet.get_all_records())
-        if not matches_df.empty:
-            matches_df.columns = [str(c).strip() for c in matches_df.columns]
-            expected_cols = ['Produk Toko Saya', 'Produk Kompetitor', 'Harga Kompetitor']
-            missing_cols = [col for col in expected_cols if col not in matches_df.columns]
-            if missing_cols:
-                st.error(f"Header di sheet 'HASIL_MATCHING' salah! Kolom berikut tidak ditemukan: {', '.join(missing_cols)}")
-                matches_df = pd.DataFrame()
-    except gspread.exceptions.WorksheetNotFound: pass
-    except Exception as e: st.warning(f"Gagal memuat 'HASIL_MATCHING': {e}")
-
-    return rekap_df.sort_values('Tanggal'), database_df, matches_df
+@st.cache_resource
+def get_dataset_registry():
+    # Satu dataset read-only per versi data untuk semua sesi (lihat DatasetRegistry di pipeline.py)
+    return DatasetRegistry()
 
 # ================================
-# FUNGSI UNTUK PROSES UPDATE HARGA
+# JOB LATAR UNTUK PEMBARUAN PERBANDINGAN HARGA
 # ================================
-def load_source_data_for_update(gc, spreadsheet_key):
-    # (Fungsi ini tidak diubah)
-    spreadsheet = gc.open_by_key(spreadsheet_key)
-    sheet_objs = [s for s in spreadsheet.worksheets() if "REKAP" in s.title.upper()]
-    rekap_list = []
-    
-    for s in sheet_objs:
-        try:
-            vals = s.get_all_values()
-            if not vals or len(vals) < 2: continue
-            header, data = vals[0], vals[1:]
-            df = pd.DataFrame(data, columns=header)
-            if '' in df.columns: df = df.drop(columns=[''])
-            store_name_match = re.match(r"^(.*?) - REKAP", s.title, re.IGNORECASE)
-            df['Toko'] = store_name_match.group(1).strip() if store_name_match else "Toko Tak Dikenal"
-            rekap_list.append(df)
-        except Exception: continue
-
-    if not rekap_list: return pd.DataFrame()
-    rekap_df = pd.concat(rekap_list, ignore_index=True)
-    rekap_df.columns = [str(c).strip().upper() for c in rekap_df.columns]
-    final_rename = {
-        'NAMA': 'Nama Produk', 'TERJUAL/BLN': 'Terjual per Bulan', 'TANGGAL': 'Tanggal', 'HARGA': 'Harga', 
-        'BRAND': 'Brand', 'STOK': 'Stok', 'TOKO': 'Toko', 'STATUS': 'Status'
+@st.cache_resource
+def get_job_registry():
+    """
+    Registri job se-proses (dibagi semua sesi): executor thread terbatas, satu job aktif per
+    spreadsheet (single-flight), dan hasil terakhir yang dipublikasikan ke semua sesi.
+    """
+    return {
+        'executor': ThreadPoolExecutor(max_workers=2, thread_name_prefix='matching-job'),
+        'lock': threading.Lock(),
+        'jobs': {},       # spreadsheet_key -> job terakhir
+        'published': {},  # spreadsheet_key -> {'seq', 'matches_df', 'data_version', 'matches_version'}
     }
-    rekap_df.rename(columns=final_rename, inplace=True)
-    required_cols = ['Tanggal', 'Nama Produk', 'Toko', 'Harga']
-    if not all(col in rekap_df.columns for col in required_cols): return pd.DataFrame()
-    rekap_df['Tanggal'] = pd.to_datetime(rekap_df['Tanggal'], errors='coerce', dayfirst=True)
-    rekap_df['Harga'] = pd.to_numeric(rekap_df['Harga'].astype(str).str.replace(r'[^\d]', '', regex=True), errors='coerce')
-    rekap_df.dropna(subset=required_cols, inplace=True)
-    idx = rekap_df.groupby(['Toko', 'Nama Produk'])['Tanggal'].idxmax()
-    return rekap_df.loc[idx].reset_index(drop=True)
-
-def run_price_comparison_update(gc, spreadsheet_key, score_cutoff=88):
-    # (Fungsi ini tidak diubah)
-    placeholder = st.empty()
-    with placeholder.container():
-        st.info("Memulai pembaruan perbandingan harga...")
-        prog = st.progress(0, text="0%")
-    source_df = load_source_data_for_update(gc, spreadsheet_key)
-    if source_df is None or source_df.empty:
-        with placeholder.container(): st.error("Gagal memuat data sumber untuk update. Batal."); return
-    my_store_name = "DB KLIK"
-    my_store_df = source_df[source_df['Toko'] == my_store_name]
-    competitor_df = source_df[source_df['Toko'] != my_store_name]
-    if my_store_df.empty or competitor_df.empty:
-        with placeholder.container(): st.warning("Data toko Anda atau kompetitor tidak cukup."); return
-    competitor_products_list = competitor_df['Nama Produk'].unique().tolist()
-    all_matches = []
-    total = len(my_store_df)
-    for i, (_, row) in enumerate(my_store_df.iterrows()):
-        prog.progress(int((i / total) * 80), text=f"Mencocokkan produk {i+1}/{total}")
-        matches = process.extract(row['Nama Produk'], competitor_products_list, scorer=fuzz.token_set_ratio, limit=5, score_cutoff=score_cutoff)
-        for match_name, score, _ in matches:
-            matched_rows = competitor_df[competitor_df['Nama Produk'] == match_name]
-            for _, mrow in matched_rows.iterrows():
-                all_matches.append({'Produk Toko Saya': row['Nama Produk'], 'Harga Toko Saya': int(row['Harga']), 'Produk Kompetitor': match_name, 'Harga Kompetitor': int(mrow['Harga']), 'Toko Kompetitor': mrow['Toko'], 'Skor Kemiripan': int(score), 'Tanggal_Update': datetime.now().strftime('%Y-%m-%d')})
-    prog.progress(90, text="Menyimpan hasil...")
+
+def _run_update_job(registry, spreadsheet_key, job, gc, snapshot_dir, update_kwargs):
+    def report(pct, text):
+        job['progress'], job['message'] = max(0, min(int(pct), 100)), text
     try:
-        spreadsheet = gc.open_by_key(spreadsheet_key)
-        try:
-            worksheet = spreadsheet.worksheet("HASIL_MATCHING")
-            worksheet.clear()
-        except gspread.exceptions.WorksheetNotFound:
-            worksheet = spreadsheet.add_worksheet(title="HASIL_MATCHING", rows=1, cols=1)
-        if all_matches:
-            results_df = pd.DataFrame(all_matches)
-            set_with_dataframe(worksheet, results_df, resize=True)
-            with placeholder.container(): st.success(f"Selesai: {len(results_df)} baris hasil disimpan.")
-        else:
-            with placeholder.container(): st.warning("Tidak ditemukan pasangan produk yang cocok.")
+        with use_diagnostics(job['diagnostics']):
+            outcome = run_price_comparison_update(instrument_client(gc, job['diagnostics']), spreadsheet_key, progress=report, **update_kwargs)
+        if outcome['results_df'] is not None:
+            # Snapshot diperbarui sekali di sini; sesi hanya menukar state di memori (publish_matches)
+            data_version = None
+            try:
+                data_version = replace_snapshot_matches(snapshot_dir, spreadsheet_key, outcome['results_df'])
+            except Exception as e:
+                outcome['notes'].append(f"Snapshot lokal tidak dapat diperbarui: {e}")
+            matches_version = compute_data_version(outcome['results_df']) if data_version is None else None
+            with registry['lock']:
+                seq = registry['published'].get(spreadsheet_key, {}).get('seq', 0) + 1
+                registry['published'][spreadsheet_key] = {'seq': seq, 'matches_df': outcome['results_df'],
+                                                          'data_version': data_version, 'matches_version': matches_version}
+        job.update(status=outcome['status'], message=outcome['message'], notes=outcome['notes'], write_stats=outcome['write_stats'],
+                   degraded_sheets=outcome['degraded_sheets'])
     except Exception as e:
-        with placeholder.container(): st.error(f"Gagal menyimpan hasil: {e}")
+        job.update(status='gagal', message=f"Pembaruan gagal: {e}")
+    finally:
+        job['finished_at'] = datetime.now()
+
+def submit_update_job(registry, spreadsheet_key, gc, snapshot_dir, **update_kwargs):
+    """
+    Jalankan run_price_comparison_update di executor latar. Jika job untuk spreadsheet yang sama
+    masih berjalan, job itu yang dikembalikan (tidak ada dua job menulis HASIL_MATCHING bersamaan).
+    Return (job, dibuat_baru).
+    """
+    with registry['lock']:
+        current = registry['jobs'].get(spreadsheet_key)
+        if current is not None and current['status'] == 'berjalan':
+            return current, False
+        job = {'status': 'berjalan', 'progress': 0, 'message': "Menunggu giliran...", 'notes': [], 'write_stats': None, 'degraded_sheets': {},
+               'started_at': datetime.now(), 'finished_at': None, 'dry_run': update_kwargs.get('dry_run', False),
+               'diagnostics': Diagnostics('job pembaruan') if current_diagnostics() is not None else None}
+        registry['jobs'][spreadsheet_key] = job
+    registry['executor'].submit(_run_update_job, registry, spreadsheet_key, job, gc, snapshot_dir, update_kwargs)
+    return job, True
 
 # ================================
 # FUNGSI-FUNGSI PEMBANTU (UTILITY)
@@ -207,14 +150,125 @@ def style_wow_growth(val):
         elif '▼' in val: color = 'red'
     return f'color: {color}'
 
-@st.cache_data
-def convert_df_for_download(df):
-    return df.to_csv(index=False).encode('utf-8')
+def track_cache(cached_func):
+    """
+    Bungkus fungsi st.cache_*: setiap panggilan dicatat ke diagnostik (jika aktif), dan isi fungsi
+    memanggil record_cache(nama, miss=True) sehingga hit = panggilan - miss.
+    """
+    @functools.wraps(cached_func)
+    def call(*args, **kwargs):
+        record_cache(cached_func.__name__)
+        return cached_func(*args, **kwargs)
+    return call
+
+# Frame turunan & CSV ekspor dikunci dengan versi data + rentang tanggal + toko (bukan hash isi DataFrame),
+# dibagi antar-sesi dan dibatasi jumlah entrinya; `_df` tidak ikut di-hash.
+DERIVED_CACHE_ENTRIES = 8
+
+@track_cache
+@st.cache_resource(max_entries=DERIVED_CACHE_ENTRIES, show_spinner="Menyiapkan data analisis...")
+def get_derived_frames(data_cache_key, start_date, end_date, _df, stores=None):
+    record_cache('get_derived_frames', miss=True)
+    # Rentang tanggal & toko di-pushdown ke riwayat SQLite (hanya jendela terpilih yang dimuat, termasuk
+    # baris yang sudah dipangkas dari sheet); tanpa riwayat, filter di memori seperti sebelumnya.
+    if start_date is not None and os.path.exists(HISTORY_PATH):
+        return derive_frames(_df, start_date, end_date, window_df=query_history(HISTORY_PATH, start_date, end_date, stores))
+    if stores: _df = _df[_df['Toko'].isin(stores)]
+    return derive_frames(_df, start_date, end_date)
+
+@track_cache
+@st.cache_resource(max_entries=DERIVED_CACHE_ENTRIES, show_spinner="Menyusun tabel perbandingan harga...")
+def get_price_comparison(data_cache_key, start_date, end_date, score_cutoff, _df, _matches_df, stores=None):
+    record_cache('get_price_comparison', miss=True)
+    # data_cache_key sudah berubah setiap HASIL_MATCHING diperbarui
+    return build_price_comparison(get_derived_frames(data_cache_key, start_date, end_date, _df, stores), _matches_df, score_cutoff)
+
+@track_cache
+@st.cache_data(max_entries=DERIVED_CACHE_ENTRIES, show_spinner=False)
+def get_history_bounds(data_cache_key):
+    # Riwayat hanya bertambah saat data dimuat/disinkronkan, yang juga mengganti data_cache_key
+    record_cache('get_history_bounds', miss=True)
+    return history_bounds(HISTORY_PATH)
+
+@track_cache
+@st.cache_resource(max_entries=DERIVED_CACHE_ENTRIES, show_spinner=False)
+def get_hpp_index(data_cache_key, _db_df):
+    # Indeks SKU -> HPP dibangun sekali per versi data (saat data dimuat), dibagi semua sesi
+    record_cache('get_hpp_index', miss=True)
+    return hpp_index(_db_df)
+
+@track_cache
+@st.cache_resource(max_entries=DERIVED_CACHE_ENTRIES, show_spinner="Menghitung selisih harga vs HPP...")
+def get_hpp_tables(data_cache_key, _df, _db_df):
+    # Selalu dari snapshot terbaru seluruh data (bukan rentang tanggal), sama seperti tampilan HPP
+    record_cache('get_hpp_tables', miss=True)
+    my_latest_df = get_derived_frames(data_cache_key, None, None, _df)['main_store_latest_overall']
+    return hpp_tables(merge_hpp(my_latest_df, _db_df, index=get_hpp_index(data_cache_key, _db_df)))
+
+@track_cache
+@st.cache_resource(max_entries=DERIVED_CACHE_ENTRIES, show_spinner="Menghitung margin HPP historis...")
+def get_hpp_margin_history(data_cache_key, _df, _db_df):
+    # Semua snapshot toko sendiri; dari riwayat lokal jika ada (termasuk baris yang sudah dipangkas dari sheet)
+    record_cache('get_hpp_margin_history', miss=True)
+    if os.path.exists(HISTORY_PATH):
+        my_rekap_df = query_history(HISTORY_PATH, stores=(MY_STORE_NAME,))
+    else:
+        my_rekap_df = _df[_df['Toko'] == MY_STORE_NAME]
+    return hpp_margin_history(my_rekap_df, get_hpp_index(data_cache_key, _db_df))
+
+@track_cache
+@st.cache_resource(max_entries=DERIVED_CACHE_ENTRIES, show_spinner="Membaca perubahan harga & stok kompetitor...")
+def get_change_feed(data_cache_key, start_date, end_date, _matches_df, stores=None):
+    # Event ditulis saat sinkronisasi (yang juga mengganti data_cache_key); jenis event difilter di memori
+    record_cache('get_change_feed', miss=True)
+    return change_feed(HISTORY_PATH, _matches_df, start_date, end_date, stores=stores)
+
+def export_download_button(views, key):
+    """
+    Pilihan tampilan & format ekspor. `views` = {label: fungsi tanpa argumen -> DataFrame}; fungsi dan
+    penulisan file baru dijalankan saat tombol unduh diklik (bukan setiap rerun).
+    """
+    view = st.selectbox("Data yang diekspor:", list(views), key=f"{key}_view")
+    fmt = st.radio("Format:", export_formats(), horizontal=True, key=f"{key}_format",
+                   help="XLSX tersedia jika paket xlsxwriter atau openpyxl terpasang.")
+    extension, mime = EXPORT_FORMATS[fmt]
+    file_stem = re.sub(r'[^0-9a-z]+', '_', view.lower()).strip('_')
+    st.download_button(f"📥 Unduh {fmt}", data=lambda: export_frame(views[view](), fmt), file_name=f"{file_stem}.{extension}",
+                       mime=mime, key=f"{key}_download", on_click="ignore")
 
-def format_rupiah(val):
-    if pd.isna(val) or not isinstance(val, (int, float, np.number)):
-        return "N/A"
-    return f"Rp {int(val):,}"
+# ================================
+# RENDER TABEL (FORMAT DI BROWSER + PAGINASI SERVER)
+# ================================
+# Kolom uang tetap numerik (bisa diurutkan); "Rp 1,234,000" hanya format tampilan di browser
+RUPIAH_FORMAT = "Rp %,d"
+TABLE_PAGE_SIZE = 100
+
+def rupiah_config(*columns):
+    return {col: st.column_config.NumberColumn(col, format=RUPIAH_FORMAT) for col in columns}
+
+def show_table(df, rupiah=(), column_config=None, page_size=TABLE_PAGE_SIZE, key=None, **kwargs):
+    """
+    st.dataframe dengan kolom `rupiah` diformat di sisi browser. Tabel lebih panjang dari `page_size`
+    dipotong per halaman di server sehingga hanya satu halaman yang dikirim ke browser setiap rerun.
+    """
+    config = rupiah_config(*[col for col in rupiah if col in df.columns])
+    config.update(column_config or {})
+    if page_size and len(df) > page_size:
+        pages = -(-len(df) // page_size)
+        page = st.number_input(f"Halaman (dari {pages})", min_value=1, max_value=pages, value=1, step=1, key=key)
+        start = (page - 1) * page_size
+        st.caption(f"Baris {start + 1:,}–{min(start + page_size, len(df)):,} dari {len(df):,}")
+        df = df.iloc[start:start + page_size]
+    st.dataframe(df, use_container_width=True, hide_index=True, column_config=config, **kwargs)
+
+def show_wide_table(df, id_columns, value_columns, rupiah=False, window=14, key=None):
+    """Tabel lebar (mis. Toko x Tanggal): kolom nilai ditampilkan per jendela `window` kolom."""
+    if len(value_columns) > window:
+        windows = -(-len(value_columns) // window)
+        part = st.number_input(f"Jendela kolom (dari {windows})", min_value=1, max_value=windows, value=windows, step=1, key=key)
+        value_columns = value_columns[(part - 1) * window:part * window]
+        st.caption(f"Kolom {value_columns[0]} – {value_columns[-1]}")
+    show_table(df[list(id_columns) + list(value_columns)], rupiah=value_columns if rupiah else (), page_size=None)
 
 # ================================
 # APLIKASI UTAMA (MAIN APP)
@@ -223,29 +277,95 @@ st.title("📊 Dashboard Analisis Penjualan & Bisnis")
 
 # Mengambil kunci dari secrets, bukan ditulis langsung
 SPREADSHEET_KEY = st.secrets["SOURCE_SPREADSHEET_ID"]
-gc = connect_to_gsheets()
-
-# --- Tombol untuk memuat data di awal ---
+# Snapshot lokal: lokasi folder & umur maksimum (menit) sebelum wajib tarik ulang dari Sheets
+SNAPSHOT_DIR = st.secrets.get("SNAPSHOT_DIR", ".snapshot")
+SNAPSHOT_TTL_MINUTES = float(st.secrets.get("SNAPSHOT_TTL_MINUTES", 360))
+PAIR_CACHE_DIR = pair_cache_dir(SNAPSHOT_DIR, SPREADSHEET_KEY)
+HISTORY_PATH = history_path(SNAPSHOT_DIR, SPREADSHEET_KEY)
+gc = connect_to_gsheets()  # job latar membungkus sendiri dengan pencatat milik job
+
+dataset_registry = get_dataset_registry()
+session_token = st.session_state.setdefault('session_token', SessionToken())
+
+def use_dataset(dataset):
+    # Sesi hanya menyimpan referensi ke dataset bersama; versi yang sama dari sesi lain dipakai ulang
+    st.session_state.dataset = dataset_registry.attach(dataset_registry.publish(dataset), session_token)
+    st.session_state.data_loaded = True
+
+def set_session_data(df, db_df, matches_df, data_version):
+    use_dataset(SharedDataset(data_version, df, db_df, matches_df))
+
+def publish_matches(new_matches_df, data_version, matches_version=None):
+    # Hanya menukar state di memori (tanpa I/O): snapshot sudah diperbarui sekali oleh job latar.
+    # Jika snapshot tidak bisa diperbarui, versi di memori = versi data sesi + hash hasil matching dari job,
+    # sehingga sesi dengan data dasar yang sama tetap berbagi satu dataset.
+    dataset = st.session_state.dataset
+    if data_version is None and matches_version is not None:
+        data_version = f"{dataset.version or f'sesi-{id(dataset.df)}'}+{matches_version}"
+    use_dataset(dataset_registry.get(data_version) or dataset.with_matches(data_version, new_matches_df))
+
+def render_job_result(job):
+    finished = job['finished_at'].strftime('%H:%M:%S') if job['finished_at'] else '-'
+    show = {'sukses': st.success, 'dry_run': st.info, 'kosong': st.warning}.get(job['status'], st.error)
+    show(f"{job['message']} (selesai {finished})")
+    for note in job['notes']: st.caption(note)
+    if job['dry_run'] and job['write_stats']:
+        st.dataframe(pd.DataFrame([(k, str(v)) for k, v in job['write_stats'].items()], columns=['Metrik', 'Nilai']),
+                     use_container_width=True, hide_index=True)
+
+@st.fragment(run_every=2)
+def poll_update_job(job):
+    # Hanya fragmen ini yang dijalankan ulang selama job berjalan; halaman penuh di-rerun sekali saat selesai
+    if job['status'] != 'berjalan':
+        st.rerun()
+    elapsed = (datetime.now() - job['started_at']).total_seconds()
+    st.progress(job['progress'], text=f"{job['message']} ({elapsed:.0f} dtk)")
+
+# --- Muat dari snapshot lokal jika masih segar, selain itu tombol untuk menarik data ---
 if 'data_loaded' not in st.session_state:
     st.session_state.data_loaded = False
+if not st.session_state.data_loaded:
+    # Snapshot segar yang sudah dimuat sesi lain dipakai langsung, tanpa membaca parquet lagi
+    fresh_meta = read_snapshot_meta(SNAPSHOT_DIR, SPREADSHEET_KEY)
+    shared = dataset_registry.get(fresh_meta['data_version']) if fresh_meta and fresh_meta['age_minutes'] <= SNAPSHOT_TTL_MINUTES else None
+    snapshot = load_snapshot(SNAPSHOT_DIR, SPREADSHEET_KEY, SNAPSHOT_TTL_MINUTES) if shared is None else None
+    if shared is not None:
+        use_dataset(shared)
+    elif snapshot is not None:
+        snap_df, snap_db_df, snap_matches_df, snap_meta = snapshot
+        ensure_history(SNAPSHOT_DIR, SPREADSHEET_KEY, snap_df, notify=st_notify)
+        set_session_data(snap_df, snap_db_df, snap_matches_df, snap_meta['data_version'])
 if not st.session_state.data_loaded:
     _, col_center, _ = st.columns([2, 3, 2])
     with col_center:
+        report_timing = st.checkbox("Catat waktu pengambilan per sheet", value=False)
         if st.button("Tarik Data & Mulai Analisis 🚀", type="primary"):
-            df, db_df, matches_df = load_all_data(SPREADSHEET_KEY)
+            df, db_df, matches_df, data_version = load_dataset(
+                SPREADSHEET_KEY, SNAPSHOT_DIR, SNAPSHOT_TTL_MINUTES, force_refresh=True, report_timing=report_timing
+            )
             if df is not None and not df.empty and db_df is not None:
-                st.session_state.df, st.session_state.db_df, st.session_state.matches_df = df, db_df, matches_df
-                st.session_state.data_loaded = True
+                set_session_data(df, db_df, matches_df, data_version)
                 st.rerun()
             else:
                 st.error("Gagal memuat data. Periksa akses Google Sheets dan pastikan sheet 'DATABASE' ada.")
     st.info("👆 Klik tombol untuk menarik semua data yang diperlukan untuk analisis.")
     st.stop()
 
-# Ambil data dari session state
-df = st.session_state.df
-db_df = st.session_state.db_df if 'db_df' in st.session_state else pd.DataFrame()
-matches_df = st.session_state.matches_df if 'matches_df' in st.session_state else pd.DataFrame()
+# Hasil job pembaruan (dari sesi mana pun) diadopsi sekali per publikasi
+job_registry = get_job_registry()
+published = job_registry['published'].get(SPREADSHEET_KEY)
+if published is not None and published['seq'] > st.session_state.get('matches_seq', 0):
+    publish_matches(published['matches_df'], published['data_version'], published['matches_version'])
+    st.session_state.matches_seq = published['seq']
+
+# Ambil data dari dataset bersama (read-only: jangan diubah in-place, dipakai juga oleh sesi lain)
+dataset = st.session_state.dataset
+df = dataset.df
+db_df = dataset.db_df if dataset.db_df is not None else pd.DataFrame()
+matches_df = dataset.matches_df if dataset.matches_df is not None else pd.DataFrame()
+# Kunci cache frame turunan: versi data (sama untuk semua sesi yang memuat data yang sama)
+data_cache_key = dataset.version or f"sesi-{id(df)}"
+get_hpp_index(data_cache_key, db_df)
 
 # ================================
 # SIDEBAR (KONTROL UTAMA)
@@ -255,383 +375,576 @@ app_mode = st.sidebar.radio(
     "Pilih Tampilan:",
     ("Tab Analisis", "HPP Produk")
 )
+snapshot_meta = read_snapshot_meta(SNAPSHOT_DIR, SPREADSHEET_KEY)
+if snapshot_meta is not None:
+    st.sidebar.caption(
+        f"Snapshot lokal `{snapshot_meta['data_version']}` · dibuat {snapshot_meta['created_at'].replace('T', ' ')} "
+        f"({snapshot_meta['age_minutes']:.0f} menit lalu, TTL {SNAPSHOT_TTL_MINUTES:.0f} menit)"
+    )
+full_reload = st.sidebar.checkbox("Muat ulang penuh (abaikan watermark)", value=False,
+                                  help="Default: hanya baris REKAP baru setelah sinkronisasi terakhir yang diunduh.")
+if st.sidebar.button("Tarik Ulang dari Google Sheets 🔄"):
+    df, db_df, matches_df, data_version = load_dataset(
+        SPREADSHEET_KEY, SNAPSHOT_DIR, SNAPSHOT_TTL_MINUTES, force_refresh=True, incremental=not full_reload
+    )
+    if df is not None and not df.empty and db_df is not None:
+        set_session_data(df, db_df, matches_df, data_version)
+        st.rerun()
+    else:
+        st.sidebar.error("Gagal menarik ulang data. Data sebelumnya tetap dipakai.")
 st.sidebar.divider()
 
 if app_mode == "Tab Analisis":
     st.sidebar.header("Kontrol & Filter Analisis")
+    # Riwayat lokal bisa lebih panjang dari data sheet (baris lama yang sudah dipangkas tetap tersimpan)
+    history = get_history_bounds(data_cache_key)
     min_date, max_date = df['Tanggal'].min().date(), df['Tanggal'].max().date()
+    if history is not None: min_date, max_date = min(min_date, history[0].date()), max(max_date, history[1].date())
     selected_date_range = st.sidebar.date_input("Rentang Tanggal:", [min_date, max_date], min_value=min_date, max_value=max_date)
     if len(selected_date_range) != 2: st.sidebar.warning("Pilih 2 tanggal."); st.stop()
     start_date, end_date = selected_date_range
+    competitor_options = sorted(set(history[2] if history is not None else df['Toko'].unique()) - {MY_STORE_NAME})
+    selected_competitors = st.sidebar.multiselect("Toko Kompetitor:", competitor_options, default=competitor_options,
+                                                  help=f"{MY_STORE_NAME} selalu disertakan.")
+    # Semua toko terpilih = tanpa filter toko (kunci cache sama seperti sebelum ada filter)
+    selected_stores = None if set(selected_competitors) == set(competitor_options) else tuple(sorted([MY_STORE_NAME, *selected_competitors]))
     accuracy_cutoff = st.sidebar.slider("Tingkat Akurasi Pencocokan (%)", 80, 100, 91, 1)
+    use_blocking = st.sidebar.checkbox("Blocking kandidat (brand & token model)", value=True,
+                                       help="Hanya produk kompetitor yang berbagi brand atau token model (mis. G502, RTX4060) yang dibandingkan.")
+    dry_run_write = st.sidebar.checkbox("Dry-run penulisan HASIL_MATCHING", value=False,
+                                        help="Jalankan pencocokan dan hitung jumlah sel yang akan ditulis, tanpa mengubah sheet.")
+
+    current_job = job_registry['jobs'].get(SPREADSHEET_KEY)
+    job_running = current_job is not None and current_job['status'] == 'berjalan'
 
     latest_source_date = df['Tanggal'].max().date()
     last_destination_update = datetime(1970, 1, 1).date()
     if not matches_df.empty and 'Tanggal_Update' in matches_df.columns:
-        matches_df['Tanggal_Update'] = pd.to_datetime(matches_df['Tanggal_Update'], errors='coerce')
-        if not matches_df['Tanggal_Update'].isna().all():
-            last_destination_update = matches_df['Tanggal_Update'].max().date()
+        match_update_dates = pd.to_datetime(matches_df['Tanggal_Update'], errors='coerce')
+        if not match_update_dates.isna().all():
+            last_destination_update = match_update_dates.max().date()
+    if snapshot_meta is not None and snapshot_meta.get('matches_updated_at'):
+        last_destination_update = max(last_destination_update, datetime.fromisoformat(snapshot_meta['matches_updated_at']).date())
     st.sidebar.info(f"Data Sumber Terbaru: **{latest_source_date.strftime('%d %b %Y')}**")
     st.sidebar.info(f"Perbandingan Terakhir: **{last_destination_update.strftime('%d %b %Y')}**")
     if latest_source_date > last_destination_update:
         st.sidebar.warning("Data sumber lebih baru dari hasil perbandingan.")
-        if st.sidebar.button("Perbarui Sekarang 🚀", type="primary"):
-            run_price_comparison_update(gc, SPREADSHEET_KEY, score_cutoff=accuracy_cutoff)
-            _, _, new_matches_df = load_all_data(SPREADSHEET_KEY)
-            st.session_state.matches_df = new_matches_df
-            st.success("Pembaruan selesai."); st.rerun()
+        if st.sidebar.button("Perbarui Sekarang 🚀", type="primary", disabled=job_running):
+            submit_update_job(
+                job_registry, SPREADSHEET_KEY, gc, SNAPSHOT_DIR, score_cutoff=accuracy_cutoff, use_blocking=use_blocking,
+                pair_cache_dir=PAIR_CACHE_DIR, dry_run=dry_run_write
+            )
+            st.rerun()
     else:
         st.sidebar.success("Data perbandingan sudah terbaru.")
-    if st.sidebar.button("Jalankan Pembaruan Manual", type="secondary"):
-        run_price_comparison_update(gc, SPREADSHEET_KEY, score_cutoff=accuracy_cutoff)
-        _, _, new_matches_df = load_all_data(SPREADSHEET_KEY)
-        st.session_state.matches_df = new_matches_df
-        st.success("Pembaruan manual selesai."); st.rerun()
+    if st.sidebar.button("Jalankan Pembaruan Manual", type="secondary", disabled=job_running):
+        submit_update_job(
+            job_registry, SPREADSHEET_KEY, gc, SNAPSHOT_DIR, score_cutoff=accuracy_cutoff, use_blocking=use_blocking,
+            pair_cache_dir=PAIR_CACHE_DIR, dry_run=dry_run_write
+        )
+        st.rerun()
+    if os.path.exists(os.path.join(PAIR_CACHE_DIR, PAIR_CACHE_META)):
+        if st.sidebar.button("Terapkan Akurasi dari Cache Skor", disabled=job_running,
+                             help="Susun ulang HASIL_MATCHING untuk akurasi di atas dari skor tersimpan, tanpa pencocokan ulang."):
+            # Sumber = snapshot terbaru per Toko & Nama Produk dari data yang sudah dimuat (tanpa unduh ulang)
+            cached_source_df = latest_source_rows(df)
+            submit_update_job(
+                job_registry, SPREADSHEET_KEY, gc, SNAPSHOT_DIR, score_cutoff=accuracy_cutoff, use_blocking=use_blocking,
+                pair_cache_dir=PAIR_CACHE_DIR, source_df=cached_source_df, dry_run=dry_run_write
+            )
+            st.rerun()
+    # Status job pembaruan: progres dipoll saat berjalan, hasil terakhir ditampilkan setelah selesai
+    if current_job is not None:
+        with st.sidebar:
+            if job_running: poll_update_job(current_job)
+            else: render_job_result(current_job)
+    with st.sidebar.expander("🧪 Uji Recall Blocking"):
+        st.caption("Bandingkan hasil pencocokan dengan dan tanpa blocking pada data yang sedang dimuat.")
+        if st.button("Jalankan Uji Recall"):
+            with st.spinner("Mencocokkan dua kali (penuh & blocking)..."):
+                latest_all = latest_source_rows(df)
+                recall_my = latest_all[latest_all['Toko'] == "DB KLIK"]
+                recall_comp = latest_all[latest_all['Toko'] != "DB KLIK"]
+                recall_comp_names = recall_comp['Nama Produk'].unique().tolist()
+                recall_summary, recall_missed = blocking_recall_report(
+                    recall_my['Nama Produk'].tolist(), recall_comp_names, accuracy_cutoff,
+                    my_brands=recall_my['Brand'].tolist(), competitor_brands=brands_by_name(recall_comp, recall_comp_names)
+                )
+            st.dataframe(pd.DataFrame([(k, str(v)) for k, v in recall_summary.items()], columns=['Metrik', 'Nilai']), use_container_width=True, hide_index=True)
+            if recall_missed.empty:
+                st.success("Blocking tidak membuang satu pun pasangan di atas cutoff.")
+            else:
+                st.warning(f"{len(recall_missed)} pasangan di atas cutoff terlewat karena blocking:")
+                st.dataframe(recall_missed, use_container_width=True, hide_index=True)
 
     st.sidebar.divider()
-    df_filtered_export = df[(df['Tanggal'].dt.date >= start_date) & (df['Tanggal'].dt.date <= end_date)]
     st.sidebar.header("Ekspor & Info")
-    st.sidebar.info(f"Baris data dalam rentang: **{len(df_filtered_export)}**")
-    csv_data = convert_df_for_download(df_filtered_export)
-    st.sidebar.download_button("📥 Unduh CSV (Filter)", data=csv_data, file_name=f'analisis_{start_date}_{end_date}.csv', mime='text/csv')
+    st.sidebar.info(f"Baris data dalam rentang: **{len(get_derived_frames(data_cache_key, start_date, end_date, df, selected_stores)['df_filtered'])}**")
+    export_views = {
+        f"Data mentah ({start_date} s.d. {end_date})":
+            lambda: get_derived_frames(data_cache_key, start_date, end_date, df, selected_stores)['df_filtered'].drop(columns=['Minggu']),
+        f"Posisi harga katalog (akurasi {accuracy_cutoff}%)":
+            lambda: get_price_comparison(data_cache_key, start_date, end_date, accuracy_cutoff, df, matches_df, selected_stores)['summary'].reset_index(),
+        f"Perubahan harga & stok kompetitor ({start_date} s.d. {end_date})":
+            lambda: get_change_feed(data_cache_key, start_date, end_date, matches_df, selected_stores),
+    }
 else: # Untuk mode HPP
     st.sidebar.info("Tampilan ini menganalisis harga jual produk Anda dibandingkan dengan Harga Pokok Penjualan (HPP) dari sheet 'DATABASE'.")
+    export_views = {}
+if not db_df.empty and 'SKU' in db_df.columns:
+    export_views.update({
+        "HPP rugi (di bawah HPP)": lambda: get_hpp_tables(data_cache_key, df, db_df)['rugi'],
+        "HPP untung (di atas HPP)": lambda: get_hpp_tables(data_cache_key, df, db_df)['untung'],
+        "HPP tidak ditemukan": lambda: get_hpp_tables(data_cache_key, df, db_df)['tidak_ditemukan'],
+        "HPP eksposur mingguan": lambda: get_hpp_margin_history(data_cache_key, df, db_df)['mingguan'],
+        "HPP margin per SKU (historis)": lambda: get_hpp_margin_history(data_cache_key, df, db_df)['per_sku'],
+    })
+with st.sidebar.expander("📥 Ekspor Data", expanded=app_mode == "Tab Analisis"):
+    export_download_button(export_views, key="export")
+
+if df.attrs.get('degraded_sheets'):
+    with st.sidebar.expander(f"⚠️ {len(df.attrs['degraded_sheets'])} Sheet Gagal Dimuat", expanded=True):
+        st.caption("Sheet berikut tetap gagal setelah retry; data toko dari sheet ini tidak ikut dalam analisis. Coba tarik ulang beberapa saat lagi.")
+        st.dataframe(pd.DataFrame(list(df.attrs['degraded_sheets'].items()), columns=['Sheet', 'Alasan']), use_container_width=True, hide_index=True)
+with st.sidebar.expander("🚦 Kuota Google Sheets"):
+    st.caption(f"Anggaran {gc.requests_per_minute} request/menit, dibagi semua sesi & job pada proses ini.")
+    st.dataframe(pd.DataFrame(list(gc.stats_snapshot().items()), columns=['Metrik', 'Nilai']).astype({'Nilai': str}),
+                 use_container_width=True, hide_index=True)
+if df.attrs.get('sync_stats') is not None:
+    with st.sidebar.expander("🔁 Sinkronisasi Inkremental Terakhir"):
+        sync_stats = df.attrs['sync_stats']
+        st.caption(f"{sum(sync_stats.values())} baris baru dari {len(sync_stats)} sheet REKAP.")
+        st.dataframe(pd.DataFrame(list(sync_stats.items()), columns=['Sheet', 'Baris Baru']), use_container_width=True, hide_index=True)
+if df.attrs.get('sheet_timings'):
+    with st.sidebar.expander("⏱️ Waktu Pengambilan per Sheet"):
+        st.dataframe(pd.DataFrame(df.attrs['sheet_timings']), use_container_width=True, hide_index=True)
+with st.sidebar.expander("💾 Memori Dataset"):
+    memory_report = df.attrs.get('memory_report')
+    if memory_report:
+        st.caption(f"REKAP: {memory_report['Sebelum (MB)']} MB sebelum pemadatan → {memory_report['Sesudah (MB)']} MB sesudah.")
+        st.dataframe(pd.DataFrame(memory_report['Kolom']), use_container_width=True, hide_index=True)
+    else:
+        st.caption(f"REKAP (dari snapshot, sudah padat): {dataset.memory_mb()['REKAP']} MB.")
+    # Dataset dibagi semua sesi; tambahan per sesi hanya frame yang disimpan sendiri di session state
+    shared_ids = {id(dataset.df), id(dataset.db_df), id(dataset.matches_df)}
+    session_mb = sum(value.memory_usage(deep=True).sum() for value in st.session_state.values()
+                     if isinstance(value, pd.DataFrame) and id(value) not in shared_ids) / 1e6
+    st.caption(f"Dataset bersama per versi (dipakai semua sesi); memori khusus sesi ini: {session_mb:.2f} MB.")
+    st.dataframe(pd.DataFrame(dataset_registry.stats()), use_container_width=True, hide_index=True)
+if app_mode == "Tab Analisis" and history is not None:
+    with st.sidebar.expander("🗄️ Riwayat Harga Lokal"):
+        st.caption(f"{history[3]:,} baris · {history[0]:%d %b %Y} – {history[1]:%d %b %Y} · {len(history[2])} toko (SQLite, hanya bertambah).")
+        if df.attrs.get('history_stats'):
+            st.dataframe(pd.DataFrame(list(df.attrs['history_stats'].items()), columns=['Metrik', 'Nilai']), use_container_width=True, hide_index=True)
+if st.session_state.get('render_latency'):
+    with st.sidebar.expander("⏱️ Latensi Render Tab"):
+        st.dataframe(pd.DataFrame(st.session_state['render_latency'][::-1]), use_container_width=True, hide_index=True)
 
 
 # ================================
 # PERSIAPAN DATA UNTUK TABS
 # ================================
-df_filtered = df.copy()
 if app_mode == "Tab Analisis":
-    start_date_dt, end_date_dt = pd.to_datetime(start_date), pd.to_datetime(end_date)
-    df_filtered = df[(df['Tanggal'] >= start_date_dt) & (df['Tanggal'] <= end_date_dt)].copy()
+    derived = get_derived_frames(data_cache_key, start_date, end_date, df, selected_stores)
+else:
+    derived = get_derived_frames(data_cache_key, None, None, df)
+df_filtered = derived['df_filtered']
 
 if df_filtered.empty: 
     st.error("Tidak ada data di rentang tanggal yang dipilih (jika pada Tab Analisis)."); st.stop()
 
-df_filtered['Minggu'] = df_filtered['Tanggal'].dt.to_period('W-SUN').apply(lambda p: p.start_time).dt.date
-my_store_name = "DB KLIK"
-main_store_df = df_filtered[df_filtered['Toko'] == my_store_name]
-competitor_df = df_filtered[df_filtered['Toko'] != my_store_name]
+my_store_name = MY_STORE_NAME
+main_store_df, competitor_df = derived['main_store_df'], derived['competitor_df']
 
-latest_entries_weekly = df_filtered.loc[df_filtered.groupby(['Minggu', 'Toko', 'Nama Produk'])['Tanggal'].idxmax()]
-latest_entries_overall = df_filtered.loc[df_filtered.groupby(['Toko', 'Nama Produk'])['Tanggal'].idxmax()]
-main_store_latest_overall = latest_entries_overall[latest_entries_overall['Toko'] == my_store_name]
-competitor_latest_overall = latest_entries_overall[latest_entries_overall['Toko'] != my_store_name]
+record_frame('REKAP', df); record_frame('DATABASE', db_df); record_frame('HASIL_MATCHING', matches_df)
+record_frame('Frame turunan (rentang aktif)', derived)
+latest_entries_weekly = derived['latest_entries_weekly']
+latest_entries_overall = derived['latest_entries_overall']
+main_store_latest_overall = derived['main_store_latest_overall']
+competitor_latest_overall = derived['competitor_latest_overall']
 
-# =========================================================================================
-# ================================ TAMPILAN KONTEN UTAMA ================================
-# =========================================================================================
+# ================================
+# TAB ANALISIS (FRAGMENT, DIHITUNG SAAT DILIHAT)
+# ================================
+# Setiap tab adalah fragment terpisah: hanya tab yang sedang dipilih yang dihitung dan digambar,
+# dan interaksi widget di dalam tab hanya menjalankan ulang fragment tab itu, bukan seluruh skrip.
+ANALYSIS_TABS = {}
+RENDER_LATENCY_LOG_SIZE = 20
+# Trade-off navigasi radio: Streamlit membuang state widget yang tidak dirender pada sebuah run, jadi pilihan
+# di tab yang sedang tidak aktif akan hilang. Pilihan & filter ini disimpan ulang tiap rerun penuh agar tetap
+# sama saat kembali ke tabnya; nomor halaman / jendela tabel sengaja kembali ke awal. Widget di daftar ini tidak
+# boleh memakai argumen default (nilai awalnya diisi lewat session state).
+TAB_WIDGET_KEYS = ('brand_select_compare', 'product_select_compare', 'overpriced_sort', 'change_kinds', 'change_matched_only')
+
+def keep_tab_widget_state():
+    for key in TAB_WIDGET_KEYS:
+        if key in st.session_state: st.session_state[key] = st.session_state[key]
+
+def record_render_latency(tab_label, started):
+    """Catat latensi render tab. Rerun penuh diukur dari awal skrip, rerun fragment dari awal fragment."""
+    run_id = st.session_state.get('script_run_id')
+    full_run = st.session_state.get('latency_run_id') != run_id
+    st.session_state['latency_run_id'] = run_id
+    elapsed_ms = (time.perf_counter() - (SCRIPT_STARTED if full_run else started)) * 1000
+    latency_log = st.session_state.setdefault('render_latency', [])
+    latency_log.append({'Tab': tab_label, 'Rerun': 'Penuh' if full_run else 'Fragment', 'Latensi (ms)': round(elapsed_ms, 1)})
+    del latency_log[:-RENDER_LATENCY_LOG_SIZE]
+    st.caption(f"⏱️ Dirender dalam {elapsed_ms:,.0f} ms ({'rerun penuh' if full_run else 'rerun fragment'}).")
+
+def analysis_tab(label):
+    """Daftarkan fungsi render sebagai tab analisis yang berjalan sebagai fragment tersendiri."""
+    def register(render):
+        @st.fragment
+        @functools.wraps(render)
+        def run_tab():
+            started = time.perf_counter()
+            with diagnostic_stage(f"render tab {label}"):
+                render()
+            record_render_latency(label, started)
+        ANALYSIS_TABS[label] = run_tab
+        return run_tab
+    return register
+
+
+@analysis_tab("⭐ Analisis Toko Saya")
+def render_tab_toko_saya():
+    """Kinerja toko sendiri: kategori, produk terlaris, brand, dan WoW."""
+    st.header(f"Analisis Kinerja Toko: {my_store_name}")
+    
+    section_counter = 1
 
-if app_mode == "Tab Analisis":
-    st.header("📈 Tampilan Analisis Penjualan & Kompetitor")
-    tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(["⭐ Analisis Toko Saya", "⚖️ Perbandingan Harga", "🏆 Analisis Brand Kompetitor", "📦 Status Stok Produk", "📈 Kinerja Penjualan", "📊 Analisis Mingguan"])
+    st.subheader(f"{section_counter}. Analisis Kategori Terlaris (Berdasarkan Omzet)")
+    section_counter += 1
     
-    # KODE UNTUK SEMUA TAB DARI VERSI SEBELUMNYA TETAP SAMA DI SINI
-    with tab1:
-        st.header(f"Analisis Kinerja Toko: {my_store_name}")
+    if 'KATEGORI' in main_store_latest_overall.columns:
+        main_store_cat = main_store_latest_overall.copy()
+        main_store_cat['KATEGORI'] = main_store_cat['KATEGORI'].astype(object).replace('', 'Lainnya').fillna('Lainnya')
         
-        section_counter = 1
-
-        st.subheader(f"{section_counter}. Analisis Kategori Terlaris (Berdasarkan Omzet)")
-        section_counter += 1
+        category_sales = main_store_cat.groupby('KATEGORI')['Omzet'].sum().reset_index()
         
-        if 'KATEGORI' in main_store_latest_overall.columns:
-            main_store_cat = main_store_latest_overall.copy()
-            main_store_cat['KATEGORI'] = main_store_cat['KATEGORI'].replace('', 'Lainnya').fillna('Lainnya')
+        if not category_sales.empty:
+            cat_sales_sorted = category_sales.sort_values('Omzet', ascending=False).head(10)
+            fig_cat = px.bar(cat_sales_sorted, x='KATEGORI', y='Omzet', title='Top 10 Kategori Berdasarkan Omzet', text_auto='.2s')
+            st.plotly_chart(fig_cat, use_container_width=True)
+
+            st.markdown("##### Rincian Data Omzet per Kategori")
+            show_table(cat_sales_sorted, rupiah=['Omzet'])
+
+            st.markdown("---")
+            st.subheader("Lihat Produk Terlaris per Kategori")
             
-            category_sales = main_store_cat.groupby('KATEGORI')['Omzet'].sum().reset_index()
+            category_list = category_sales.sort_values('Omzet', ascending=False)['KATEGORI'].tolist()
             
-            if not category_sales.empty:
-                cat_sales_sorted = category_sales.sort_values('Omzet', ascending=False).head(10)
-                fig_cat = px.bar(cat_sales_sorted, x='KATEGORI', y='Omzet', title='Top 10 Kategori Berdasarkan Omzet', text_auto='.2s')
-                st.plotly_chart(fig_cat, use_container_width=True)
-
-                st.markdown("##### Rincian Data Omzet per Kategori")
-                table_cat_sales = cat_sales_sorted.copy()
-                table_cat_sales['Omzet'] = table_cat_sales['Omzet'].apply(lambda x: f"Rp {int(x):,.0f}")
-                st.dataframe(table_cat_sales, use_container_width=True, hide_index=True)
-
-                st.markdown("---")
-                st.subheader("Lihat Produk Terlaris per Kategori")
-                
-                category_list = category_sales.sort_values('Omzet', ascending=False)['KATEGORI'].tolist()
-                
-                selected_category = st.selectbox(
-                    "Pilih Kategori untuk melihat produk terlaris:",
-                    options=category_list
-                )
+            selected_category = st.selectbox(
+                "Pilih Kategori untuk melihat produk terlaris:",
+                options=category_list
+            )
 
-                if selected_category:
-                    products_in_category = main_store_cat[main_store_cat['KATEGORI'] == selected_category].copy()
-                    top_products_in_category = products_in_category.sort_values('Terjual per Bulan', ascending=False)
+            if selected_category:
+                products_in_category = main_store_cat[main_store_cat['KATEGORI'] == selected_category].copy()
+                top_products_in_category = products_in_category.sort_values('Terjual per Bulan', ascending=False)
 
-                    if top_products_in_category.empty:
-                        st.info(f"Tidak ada produk terlaris untuk kategori '{selected_category}'.")
-                    else:
-                        columns_to_display = ['Nama Produk', 'SKU', 'Harga', 'Terjual per Bulan', 'Omzet']
-                        if 'SKU' not in top_products_in_category.columns:
-                            top_products_in_category['SKU'] = 'N/A'
-                        
-                        display_table = top_products_in_category[columns_to_display].copy()
-                        display_table['Harga'] = display_table['Harga'].apply(lambda x: f"Rp {int(x):,.0f}")
-                        display_table['Omzet'] = display_table['Omzet'].apply(lambda x: f"Rp {int(x):,.0f}")
-                        
-                        st.dataframe(display_table, use_container_width=True, hide_index=True)
-            else:
-                st.info("Tidak ada data omzet per kategori untuk ditampilkan.")
+                if top_products_in_category.empty:
+                    st.info(f"Tidak ada produk terlaris untuk kategori '{selected_category}'.")
+                else:
+                    columns_to_display = ['Nama Produk', 'SKU', 'Harga', 'Terjual per Bulan', 'Omzet']
+                    if 'SKU' not in top_products_in_category.columns:
+                        top_products_in_category['SKU'] = 'N/A'
+                    
+                    show_table(top_products_in_category[columns_to_display], rupiah=['Harga', 'Omzet'], key="page_category_products")
         else:
-            st.warning("Kolom 'KATEGORI' tidak ditemukan pada data toko Anda. Analisis ini dilewati.")
-
-        st.subheader(f"{section_counter}. Produk Terlaris")
-        section_counter += 1
-        top_products = main_store_latest_overall.sort_values('Terjual per Bulan', ascending=False).head(15).copy()
-        top_products['Harga_rp'] = top_products['Harga'].apply(lambda x: f"Rp {int(x):,.0f}")
-        top_products['Omzet_rp'] = top_products['Omzet'].apply(lambda x: f"Rp {int(x):,.0f}")
-        
-        display_cols_top = ['Nama Produk', 'SKU', 'Harga_rp', 'Omzet_rp', 'Terjual per Bulan']
-        if 'SKU' not in top_products.columns:
-            top_products['SKU'] = 'N/A'
+            st.info("Tidak ada data omzet per kategori untuk ditampilkan.")
+    else:
+        st.warning("Kolom 'KATEGORI' tidak ditemukan pada data toko Anda. Analisis ini dilewati.")
+
+    st.subheader(f"{section_counter}. Produk Terlaris")
+    section_counter += 1
+    top_products = main_store_latest_overall.sort_values('Terjual per Bulan', ascending=False).head(15).copy()
+    display_cols_top = ['Nama Produk', 'SKU', 'Harga', 'Omzet', 'Terjual per Bulan']
+    if 'SKU' not in top_products.columns:
+        top_products['SKU'] = 'N/A'
+    show_table(top_products[display_cols_top], rupiah=['Harga', 'Omzet'])
+
+    st.subheader(f"{section_counter}. Distribusi Omzet Brand")
+    section_counter += 1
+    brand_omzet_main = main_store_latest_overall.groupby('Brand', observed=True)['Omzet'].sum().reset_index()
+    if not brand_omzet_main.empty:
+        fig_brand_pie = px.pie(brand_omzet_main.sort_values('Omzet', ascending=False).head(7), 
+                             names='Brand', values='Omzet', title='Distribusi Omzet Top 7 Brand (Snapshot Terakhir)')
         
-        display_df_top = top_products[display_cols_top].rename(
-            columns={'Harga_rp': 'Harga', 'Omzet_rp': 'Omzet'}
-        )
-        st.dataframe(display_df_top, use_container_width=True, hide_index=True)
-
-        st.subheader(f"{section_counter}. Distribusi Omzet Brand")
-        section_counter += 1
-        brand_omzet_main = main_store_latest_overall.groupby('Brand')['Omzet'].sum().reset_index()
-        if not brand_omzet_main.empty:
-            fig_brand_pie = px.pie(brand_omzet_main.sort_values('Omzet', ascending=False).head(7), 
-                                 names='Brand', values='Omzet', title='Distribusi Omzet Top 7 Brand (Snapshot Terakhir)')
-            
-            fig_brand_pie.update_traces(
-                textposition='outside',
-                texttemplate='%{label}<br><b>Rp %{value:,.0f}</b><br>(%{percent})',
-                insidetextfont=dict(color='white')
-            )
-            fig_brand_pie.update_layout(showlegend=False)
-            
-            st.plotly_chart(fig_brand_pie, use_container_width=True)
-        else:
-            st.info("Tidak ada data omzet brand.")
-
-        st.subheader(f"{section_counter}. Ringkasan Kinerja Mingguan (WoW Growth)")
-        section_counter += 1
-        main_store_latest_weekly = main_store_df.loc[main_store_df.groupby(['Minggu', 'Nama Produk'])['Tanggal'].idxmax()]
-        weekly_summary_tab1 = main_store_latest_weekly.groupby('Minggu').agg(
-            Omzet=('Omzet', 'sum'), Penjualan_Unit=('Terjual per Bulan', 'sum')
-        ).reset_index().sort_values('Minggu')
-        weekly_summary_tab1['Pertumbuhan Omzet (WoW)'] = weekly_summary_tab1['Omzet'].pct_change().apply(format_wow_growth)
-        weekly_summary_tab1['Omzet'] = weekly_summary_tab1['Omzet'].apply(lambda x: f"Rp {x:,.0f}")
-        st.dataframe(
-            weekly_summary_tab1[['Minggu', 'Omzet', 'Penjualan_Unit', 'Pertumbuhan Omzet (WoW)']].style.applymap(
-                style_wow_growth, subset=['Pertumbuhan Omzet (WoW)']
-            ), use_container_width=True, hide_index=True
+        fig_brand_pie.update_traces(
+            textposition='outside',
+            texttemplate='%{label}<br><b>Rp %{value:,.0f}</b><br>(%{percent})',
+            insidetextfont=dict(color='white')
         )
-
-    with tab2:
-        st.header(f"Perbandingan Produk '{my_store_name}' dengan Kompetitor")
-        st.info("Perbandingan menggunakan data produk terbaru dari toko Anda yang cocok dengan data kompetitor terakhir.")
+        fig_brand_pie.update_layout(showlegend=False)
         
-        df_main_store_unfiltered = df[df['Toko'] == my_store_name]
-        latest_date_in_db_klik = df_main_store_unfiltered['Tanggal'].max()
-        latest_products_df = df_main_store_unfiltered[df_main_store_unfiltered['Tanggal'] == latest_date_in_db_klik].copy()
+        st.plotly_chart(fig_brand_pie, use_container_width=True)
+    else:
+        st.info("Tidak ada data omzet brand.")
+
+    st.subheader(f"{section_counter}. Ringkasan Kinerja Mingguan (WoW Growth)")
+    section_counter += 1
+    main_store_latest_weekly = main_store_df.loc[main_store_df.groupby(['Minggu', 'Nama Produk'], observed=True)['Tanggal'].idxmax()]
+    weekly_summary_tab1 = main_store_latest_weekly.groupby('Minggu').agg(
+        Omzet=('Omzet', 'sum'), Penjualan_Unit=('Terjual per Bulan', 'sum')
+    ).reset_index().sort_values('Minggu')
+    weekly_summary_tab1['Pertumbuhan Omzet (WoW)'] = weekly_summary_tab1['Omzet'].pct_change().apply(format_wow_growth)
+    weekly_summary_tab1['Minggu'] = weekly_summary_tab1['Minggu'].dt.date
+    st.dataframe(
+        weekly_summary_tab1[['Minggu', 'Omzet', 'Penjualan_Unit', 'Pertumbuhan Omzet (WoW)']].style.map(
+            style_wow_growth, subset=['Pertumbuhan Omzet (WoW)']
+        ), use_container_width=True, hide_index=True, column_config=rupiah_config('Omzet')
+    )
+
+
+@analysis_tab("⚖️ Perbandingan Harga")
+def render_tab_perbandingan():
+    """Perbandingan harga produk terpilih dan posisi harga seluruh katalog."""
+    st.header(f"Perbandingan Produk '{my_store_name}' dengan Kompetitor")
+    st.info("Perbandingan menggunakan data produk terbaru dari toko Anda yang cocok dengan data kompetitor terakhir.")
+    
+    latest_products_df = derived['my_latest_products']
+    
+    brand_list = sorted(latest_products_df['Brand'].unique())
+    selected_brand = st.selectbox("Filter berdasarkan Brand:", ["Semua Brand"] + brand_list, key="brand_select_compare")
+    
+    if selected_brand != "Semua Brand":
+        products_to_show_df = latest_products_df[latest_products_df['Brand'] == selected_brand]
+    else:
+        products_to_show_df = latest_products_df
         
-        brand_list = sorted(latest_products_df['Brand'].unique())
-        selected_brand = st.selectbox("Filter berdasarkan Brand:", ["Semua Brand"] + brand_list, key="brand_select_compare")
+    product_list = sorted(products_to_show_df['Nama Produk'].unique())
+    selected_product = st.selectbox("Pilih produk dari toko Anda:", product_list, key="product_select_compare")
+
+    comparison = get_price_comparison(data_cache_key, start_date, end_date, accuracy_cutoff, df, matches_df, selected_stores)
+    comparison_summary = comparison['summary']
+
+    if selected_product and selected_product in comparison_summary.index:
+        product_info = comparison_summary.loc[selected_product]
+        matches_for_product = comparison['offers'].get(selected_product, pd.DataFrame())
+        st.markdown(f"**Produk Pilihan Anda:** *{selected_product}*")
+
+        col1, col2, col3 = st.columns(3)
+        if pd.notna(product_info['Harga Rata-Rata']):
+            col1.metric("Harga Rata-Rata (Semua Toko)", f"Rp {int(product_info['Harga Rata-Rata']):,}")
+            col3.metric("Toko Omzet Tertinggi", f"{product_info['Toko Omzet Tertinggi']}", f"Rp {int(product_info['Omzet Tertinggi']):,}")
+        else:
+            col1.metric("Harga Rata-Rata (Semua Toko)", "N/A")
+            col3.metric("Toko Omzet Tertinggi", "N/A")
+
+        total_competitor_stores = comparison['total_competitor_stores']
+        col2.metric(
+            "Status di Kompetitor", 
+            f"Ready: {product_info['Ready']} | Habis: {product_info['Habis']}", 
+            help=f"Berdasarkan {total_competitor_stores} total toko kompetitor yang dipantau."
+        )
         
-        if selected_brand != "Semua Brand":
-            products_to_show_df = latest_products_df[latest_products_df['Brand'] == selected_brand]
+        st.divider()
+
+        st.subheader("Perbandingan Harga Produk (Termasuk Toko Anda)")
+        if matches_for_product.empty:
+            st.warning("Tidak ditemukan produk yang cocok di toko kompetitor berdasarkan filter akurasi Anda.")
         else:
-            products_to_show_df = latest_products_df
+            my_row = pd.DataFrame([{
+                'Nama Produk Tercantum': selected_product,
+                'Toko': f"{my_store_name} (Anda)",
+                'Harga': int(product_info['Harga']),
+                'Selisih Harga': 0,
+                'Posisi': "Basis",
+                'Terjual per Bulan': int(product_info['Terjual per Bulan']),
+                'Omzet': int(product_info['Omzet']),
+                'Skor Kemiripan (%)': 100
+            }])
+            price_diff = matches_for_product['Selisih Harga']
+            offer_rows = pd.DataFrame({
+                'Nama Produk Tercantum': matches_for_product['Produk Kompetitor'],
+                'Toko': matches_for_product['Toko Kompetitor'],
+                'Harga': matches_for_product['Harga Kompetitor'],
+                'Selisih Harga': price_diff,
+                'Posisi': np.select([price_diff > 0, price_diff < 0], ["Lebih Mahal", "Lebih Murah"], "Sama"),
+                'Terjual per Bulan': matches_for_product['Terjual per Bulan'],
+                'Omzet': matches_for_product['Omzet'],
+                'Skor Kemiripan (%)': matches_for_product['Skor Kemiripan'],
+            })
+            comparison_df = pd.concat([my_row, offer_rows], ignore_index=True)
+            comparison_df = comparison_df.sort_values(by='Harga', ascending=True, kind='stable').reset_index(drop=True)
+
+            ordered_cols = [
+                'Nama Produk Tercantum', 'Toko', 'Harga', 'Selisih Harga', 'Posisi',
+                'Terjual per Bulan', 'Omzet', 'Skor Kemiripan (%)'
+            ]
             
-        product_list = sorted(products_to_show_df['Nama Produk'].unique())
-        selected_product = st.selectbox("Pilih produk dari toko Anda:", product_list, key="product_select_compare")
+            show_table(comparison_df[ordered_cols], rupiah=['Harga', 'Selisih Harga', 'Omzet'], key="page_compare_offers")
 
-        if selected_product:
-            product_info_list = latest_products_df[latest_products_df['Nama Produk'] == selected_product]
-            
-            if not product_info_list.empty:
-                product_info = product_info_list.iloc[0]
-                st.markdown(f"**Produk Pilihan Anda:** *{product_info['Nama Produk']}*")
-                
-                matches_for_product = matches_df[
-                    (matches_df['Produk Toko Saya'] == selected_product) &
-                    (matches_df['Skor Kemiripan'] >= accuracy_cutoff)
-                ].sort_values(by='Skor Kemiripan', ascending=False)
+    st.divider()
+    st.subheader("Posisi Harga Seluruh Katalog")
+    st.caption("Produk Anda yang punya penawaran kompetitor, diurutkan dari yang paling mahal dibanding kompetitor termurah. "
+               "Persentil 100 = semua penawaran kompetitor lebih murah.")
+    overpriced = comparison_summary[comparison_summary['Jumlah Penawaran'] > 0]
+    if selected_brand != "Semua Brand":
+        overpriced = overpriced[overpriced['Brand'] == selected_brand]
+    if overpriced.empty:
+        st.info("Belum ada produk dengan penawaran kompetitor pada akurasi ini.")
+    else:
+        # Urutan diterapkan di server sebelum paginasi agar berlaku untuk seluruh katalog, bukan per halaman
+        sort_column = st.selectbox("Urutkan berdasarkan:", ['Selisih vs Termurah (%)', 'Selisih vs Termurah', 'Persentil Harga', 'Jumlah Penawaran'],
+                                   key="overpriced_sort")
+        overpriced = overpriced.sort_values(sort_column, ascending=False).reset_index()
+        show_table(
+            overpriced[['Nama Produk', 'Brand', 'Harga', 'Harga Termurah Kompetitor', 'Toko Termurah', 'Selisih vs Termurah',
+                        'Selisih vs Termurah (%)', 'Persentil Harga', 'Jumlah Penawaran', 'Ready', 'Habis']],
+            rupiah=['Harga', 'Harga Termurah Kompetitor', 'Selisih vs Termurah'], key="page_overpriced",
+            column_config={
+                'Selisih vs Termurah (%)': st.column_config.NumberColumn(format="%.1f%%"),
+                'Persentil Harga': st.column_config.ProgressColumn(min_value=0, max_value=100, format="%d"),
+            }
+        )
 
-                col1, col2, col3 = st.columns(3)
-                
-                all_occurrences = df_filtered[df_filtered['Nama Produk'] == selected_product]
-                if not all_occurrences.empty:
-                    avg_price = all_occurrences['Harga'].mean()
-                    col1.metric("Harga Rata-Rata (Semua Toko)", f"Rp {int(avg_price):,}")
-                    
-                    top_store_row = all_occurrences.loc[all_occurrences['Omzet'].idxmax()]
-                    top_store_name = top_store_row['Toko']
-                    top_omzet = top_store_row['Omzet']
-                    col3.metric("Toko Omzet Tertinggi", f"{top_store_name}", f"Rp {int(top_omzet):,}")
-                else:
-                    col1.metric("Harga Rata-Rata (Semua Toko)", "N/A")
-                    col3.metric("Toko Omzet Tertinggi", "N/A")
-
-                total_competitor_stores = len(competitor_df['Toko'].unique())
-                matched_product_names = matches_for_product['Produk Kompetitor'].unique()
-                matched_products_details = competitor_latest_overall[
-                    competitor_latest_overall['Nama Produk'].isin(matched_product_names)
-                ]
-                
-                ready_count = matched_products_details[matched_products_details['Status'] == 'Tersedia']['Toko'].nunique()
-                oot_count = total_competitor_stores - ready_count
-                
-                col2.metric(
-                    "Status di Kompetitor", 
-                    f"Ready: {ready_count} | Habis: {oot_count}", 
-                    help=f"Berdasarkan {total_competitor_stores} total toko kompetitor yang dipantau."
-                )
+
+@analysis_tab("🏆 Analisis Brand Kompetitor")
+def render_tab_brand_kompetitor():
+    """Omzet brand per toko kompetitor."""
+    st.header("Analisis Brand di Toko Kompetitor")
+    if competitor_df.empty:
+        st.warning("Tidak ada data kompetitor pada rentang tanggal ini.")
+    else:
+        competitor_list = sorted(competitor_df['Toko'].unique())
+        for competitor_store in competitor_list:
+            with st.expander(f"Analisis untuk Kompetitor: **{competitor_store}**"):
+                single_competitor_df = competitor_latest_overall[competitor_latest_overall['Toko'] == competitor_store]
+                brand_analysis = single_competitor_df.groupby('Brand', observed=True).agg(
+                    Total_Omzet=('Omzet', 'sum'), 
+                    Total_Unit_Terjual=('Terjual per Bulan', 'sum')
+                ).reset_index().sort_values("Total_Omzet", ascending=False)
                 
-                st.divider()
+                if not brand_analysis.empty:
+                    show_table(brand_analysis.head(10), rupiah=['Total_Omzet'])
 
-                st.subheader("Perbandingan Harga Produk (Termasuk Toko Anda)")
-                if matches_for_product.empty:
-                    st.warning("Tidak ditemukan produk yang cocok di toko kompetitor berdasarkan filter akurasi Anda.")
+                    fig_pie_comp = px.pie(brand_analysis.head(7), names='Brand', values='Total_Omzet', title=f'Distribusi Omzet Top 7 Brand di {competitor_store} (Snapshot Terakhir)')
+                    st.plotly_chart(fig_pie_comp, use_container_width=True)
                 else:
-                    my_product_info = product_info.copy()
-                    my_price = int(my_product_info['Harga'])
-                    my_terjual = my_product_info.get('Terjual per Bulan', 0)
-                    my_omzet = my_product_info.get('Omzet', 0)
-
-                    comparison_data = [{
-                        'Nama Produk Tercantum': my_product_info['Nama Produk'],
-                        'Toko': f"{my_store_name} (Anda)",
-                        'Harga_num': my_price,
-                        'Selisih Harga': "Rp 0 (Basis)",
-                        'Terjual per Bulan': int(my_terjual) if my_terjual else 0,
-                        'Omzet_num': int(my_omzet) if my_omzet else 0,
-                        'Skor Kemiripan (%)': 100
-                    }]
-
-                    for _, match in matches_for_product.iterrows():
-                        comp_price = int(match['Harga Kompetitor'])
-                        price_diff = comp_price - my_price
-                        
-                        diff_text = f" (Sama)"
-                        if price_diff > 0: diff_text = f" (Lebih Mahal)"
-                        elif price_diff < 0: diff_text = f" (Lebih Murah)"
-
-                        comp_details = competitor_latest_overall[
-                            (competitor_latest_overall['Nama Produk'] == match['Produk Kompetitor']) &
-                            (competitor_latest_overall['Toko'] == match['Toko Kompetitor'])
-                        ]
-                        
-                        terjual = comp_details['Terjual per Bulan'].iloc[0] if not comp_details.empty else 0
-                        omzet = comp_details['Omzet'].iloc[0] if not comp_details.empty else 0
-                        
-                        comparison_data.append({
-                            'Nama Produk Tercantum': match['Produk Kompetitor'],
-                            'Toko': match['Toko Kompetitor'],
-                            'Harga_num': comp_price,
-                            'Selisih Harga': f"Rp {price_diff:,}{diff_text}",
-                            'Terjual per Bulan': int(terjual) if terjual else 0,
-                            'Omzet_num': int(omzet) if omzet else 0,
-                            'Skor Kemiripan (%)': int(match['Skor Kemiripan'])
-                        })
-                    
-                    comparison_df = pd.DataFrame(comparison_data)
-                    comparison_df = comparison_df.sort_values(by='Harga_num', ascending=True).reset_index(drop=True)
+                    st.info("Tidak ada data brand untuk toko ini.")
+
+
+@analysis_tab("📦 Status Stok Produk")
+def render_tab_stok():
+    """Tren status stok mingguan per toko."""
+    st.header("Tren Status Stok Mingguan per Toko")
+    stock_trends = df_filtered.groupby(['Minggu', 'Toko', 'Status'], observed=True).size().unstack(fill_value=0).reset_index()
+    stock_trends.columns = [str(col) for col in stock_trends.columns]  # kolom dari Status (categorical) -> teks biasa
+    if 'Tersedia' not in stock_trends.columns: stock_trends['Tersedia'] = 0
+    if 'Habis' not in stock_trends.columns: stock_trends['Habis'] = 0
+    stock_trends_melted = stock_trends.melt(id_vars=['Minggu', 'Toko'], value_vars=['Tersedia', 'Habis'], var_name='Tipe Stok', value_name='Jumlah Produk')
+    
+    fig_stock_trends = px.line(stock_trends_melted, x='Minggu', y='Jumlah Produk', color='Toko', line_dash='Tipe Stok', markers=True, title='Jumlah Produk Tersedia vs. Habis per Minggu')
+    st.plotly_chart(fig_stock_trends, use_container_width=True)
+    st.dataframe(stock_trends.assign(Minggu=stock_trends['Minggu'].dt.date).set_index('Minggu'), use_container_width=True)
 
-                    comparison_df['Harga'] = comparison_df['Harga_num'].apply(lambda x: f"Rp {x:,}")
-                    comparison_df['Omzet'] = comparison_df['Omzet_num'].apply(lambda x: f"Rp {x:,}")
 
-                    ordered_cols = [
-                        'Nama Produk Tercantum', 'Toko', 'Harga', 'Selisih Harga',
-                        'Terjual per Bulan', 'Omzet', 'Skor Kemiripan (%)'
-                    ]
-                    
-                    st.dataframe(comparison_df[ordered_cols], use_container_width=True, hide_index=True)
+@analysis_tab("📈 Kinerja Penjualan")
+def render_tab_kinerja():
+    """Omzet mingguan dan per tanggal semua toko."""
+    st.header("Analisis Kinerja Penjualan (Semua Toko)")
+    
+    all_stores_latest_per_week = latest_entries_weekly.groupby(['Minggu', 'Toko'], observed=True)['Omzet'].sum().reset_index()
+    fig_weekly_omzet = px.line(all_stores_latest_per_week, x='Minggu', y='Omzet', color='Toko', markers=True, title='Perbandingan Omzet Mingguan Antar Toko (Berdasarkan Snapshot Terakhir)')
+    st.plotly_chart(fig_weekly_omzet, use_container_width=True)
+    
+    st.subheader("Tabel Rincian Omzet per Tanggal")
+    if not df_filtered.empty:
+        omzet_pivot = df_filtered.pivot_table(index='Toko', columns='Tanggal', values='Omzet', aggfunc='sum', observed=True)
+        omzet_pivot = omzet_pivot.where(omzet_pivot > 0)  # tanpa omzet -> sel kosong
+        omzet_pivot.columns = [col.strftime('%d %b %Y') for col in omzet_pivot.columns]
+        date_columns = list(omzet_pivot.columns)
+        omzet_pivot.reset_index(inplace=True)
+        st.info("Tanggal ditampilkan per jendela 14 hari (default: jendela terakhir); scroll ke samping di dalam jendela.")
+        show_wide_table(omzet_pivot, ['Toko'], date_columns, rupiah=True, key="omzet_pivot_window")
+    else:
+        st.warning("Tidak ada data untuk ditampilkan dalam tabel.")
 
-    with tab3:
-        st.header("Analisis Brand di Toko Kompetitor")
-        if competitor_df.empty:
-            st.warning("Tidak ada data kompetitor pada rentang tanggal ini.")
-        else:
-            competitor_list = sorted(competitor_df['Toko'].unique())
-            for competitor_store in competitor_list:
-                with st.expander(f"Analisis untuk Kompetitor: **{competitor_store}**"):
-                    single_competitor_df = competitor_latest_overall[competitor_latest_overall['Toko'] == competitor_store]
-                    brand_analysis = single_competitor_df.groupby('Brand').agg(
-                        Total_Omzet=('Omzet', 'sum'), 
-                        Total_Unit_Terjual=('Terjual per Bulan', 'sum')
-                    ).reset_index().sort_values("Total_Omzet", ascending=False)
-                    
-                    if not brand_analysis.empty:
-                        display_brand_analysis = brand_analysis.head(10).copy()
-                        display_brand_analysis['Total_Omzet'] = display_brand_analysis['Total_Omzet'].apply(lambda x: f"Rp {int(x):,.0f}")
-                        st.dataframe(display_brand_analysis, use_container_width=True, hide_index=True)
 
-                        fig_pie_comp = px.pie(brand_analysis.head(7), names='Brand', values='Total_Omzet', title=f'Distribusi Omzet Top 7 Brand di {competitor_store} (Snapshot Terakhir)')
-                        st.plotly_chart(fig_pie_comp, use_container_width=True)
-                    else:
-                        st.info("Tidak ada data brand untuk toko ini.")
-
-    with tab4:
-        st.header("Tren Status Stok Mingguan per Toko")
-        stock_trends = df_filtered.groupby(['Minggu', 'Toko', 'Status']).size().unstack(fill_value=0).reset_index()
-        if 'Tersedia' not in stock_trends.columns: stock_trends['Tersedia'] = 0
-        if 'Habis' not in stock_trends.columns: stock_trends['Habis'] = 0
-        stock_trends_melted = stock_trends.melt(id_vars=['Minggu', 'Toko'], value_vars=['Tersedia', 'Habis'], var_name='Tipe Stok', value_name='Jumlah Produk')
-        
-        fig_stock_trends = px.line(stock_trends_melted, x='Minggu', y='Jumlah Produk', color='Toko', line_dash='Tipe Stok', markers=True, title='Jumlah Produk Tersedia vs. Habis per Minggu')
-        st.plotly_chart(fig_stock_trends, use_container_width=True)
-        st.dataframe(stock_trends.set_index('Minggu'), use_container_width=True)
+@analysis_tab("📊 Analisis Mingguan")
+def render_tab_mingguan():
+    """Produk baru, restock, dan hilang antar dua minggu."""
+    st.header("Analisis Produk Baru Mingguan")
+    weeks = list(pd.DatetimeIndex(df_filtered['Minggu'].unique()).sort_values())
+    if len(weeks) < 2:
+        st.info("Butuh setidaknya 2 minggu data untuk melakukan perbandingan produk baru.")
+    else:
+        col1, col2 = st.columns(2)
+        week_before = col1.selectbox("Pilih Minggu Pembanding:", weeks, index=0, format_func=lambda w: str(w.date()))
+        week_after = col2.selectbox("Pilih Minggu Penentu:", weeks, index=len(weeks)-1, format_func=lambda w: str(w.date()))
 
-    with tab5:
-        st.header("Analisis Kinerja Penjualan (Semua Toko)")
-        
-        all_stores_latest_per_week = latest_entries_weekly.groupby(['Minggu', 'Toko'])['Omzet'].sum().reset_index()
-        fig_weekly_omzet = px.line(all_stores_latest_per_week, x='Minggu', y='Omzet', color='Toko', markers=True, title='Perbandingan Omzet Mingguan Antar Toko (Berdasarkan Snapshot Terakhir)')
-        st.plotly_chart(fig_weekly_omzet, use_container_width=True)
-        
-        st.subheader("Tabel Rincian Omzet per Tanggal")
-        if not df_filtered.empty:
-            omzet_pivot = df_filtered.pivot_table(index='Toko', columns='Tanggal', values='Omzet', aggfunc='sum').fillna(0)
-            omzet_pivot.columns = [col.strftime('%d %b %Y') for col in omzet_pivot.columns]
-            for col in omzet_pivot.columns:
-                omzet_pivot[col] = omzet_pivot[col].apply(lambda x: f"Rp {int(x):,}" if x > 0 else "-")
-            omzet_pivot.reset_index(inplace=True)
-            st.info("Anda bisa scroll tabel ini ke samping untuk melihat tanggal lainnya.")
-            st.dataframe(omzet_pivot, use_container_width=True, hide_index=True)
+        if week_before >= week_after:
+            st.error("Minggu Penentu harus setelah Minggu Pembanding.")
         else:
-            st.warning("Tidak ada data untuk ditampilkan dalam tabel.")
+            changes = availability_changes(derived['availability'], week_before, week_after, latest_entries_weekly)
+            if changes.empty:
+                st.info("Tidak ada perubahan ketersediaan produk di antara dua minggu ini.")
+            else:
+                change_counts = changes.groupby(['Toko', 'Perubahan']).size().unstack(fill_value=0)
+                st.dataframe(change_counts.reindex(columns=list(AVAILABILITY_CHANGES), fill_value=0), use_container_width=True)
+                st.caption("Baru = belum pernah tersedia sampai Minggu Pembanding · Restock = pernah tersedia, kosong di Minggu Pembanding · "
+                           "Hilang = tersedia di Minggu Pembanding, tidak di Minggu Penentu.")
+            all_stores = sorted(df_filtered['Toko'].unique())
+            changes_by_store = {store: frame for store, frame in changes.groupby('Toko')}
+            for store in all_stores:
+                with st.expander(f"Lihat Produk Baru di Toko: **{store}**"):
+                    store_changes = changes_by_store.get(store, changes.iloc[0:0])
+                    new_products_df = store_changes[store_changes['Perubahan'] != 'Hilang']
+                    dropped_df = store_changes[store_changes['Perubahan'] == 'Hilang']
+                    if new_products_df.empty:
+                        st.write("Tidak ada produk baru yang terdeteksi.")
+                    else:
+                        st.write(f"Ditemukan **{len(new_products_df)}** produk baru:")
+                        show_table(new_products_df[[col for col in ('Nama Produk', 'Perubahan', 'Harga', 'Stok', 'Brand') if col in new_products_df.columns]],
+                                   rupiah=['Harga'], key=f"page_new_{store}")
+                    if not dropped_df.empty:
+                        st.write(f"**{len(dropped_df)}** produk tidak lagi tersedia:")
+                        show_table(dropped_df[['Nama Produk', 'Terakhir Tersedia'] + [col for col in ('Harga', 'Brand') if col in dropped_df.columns]],
+                                   rupiah=['Harga'], key=f"page_dropped_{store}",
+                                   column_config={'Terakhir Tersedia': st.column_config.DateColumn(format="YYYY-MM-DD")})
+
+
+@analysis_tab("🔔 Perubahan Kompetitor")
+def render_tab_perubahan():
+    """Feed event harga turun/naik, restock, stok habis, dan listing baru kompetitor."""
+    st.header("Perubahan Harga & Stok Kompetitor")
+    if not os.path.exists(HISTORY_PATH):
+        st.info("Feed perubahan dibangun dari riwayat harga lokal, yang akan terisi setelah data dimuat / disinkronkan.")
+        return
+    feed = get_change_feed(data_cache_key, start_date, end_date, matches_df, selected_stores)
+    if feed.empty:
+        st.info("Belum ada perubahan terdeteksi dalam rentang ini. Perubahan dihitung setiap sinkronisasi terhadap snapshot sebelumnya.")
+        return
+    col1, col2 = st.columns([3, 1])
+    st.session_state.setdefault('change_kinds', list(CHANGE_EVENT_TYPES))
+    kinds = col1.multiselect("Jenis perubahan:", list(CHANGE_EVENT_TYPES), key="change_kinds")
+    matched_only = col2.checkbox("Hanya yang cocok dengan produk saya", key="change_matched_only")
+    feed = feed[feed['Perubahan'].isin(kinds)]
+    if matched_only: feed = feed[feed['Produk Toko Saya'].notna()]
+
+    counts = feed.groupby(['Toko', 'Perubahan'], observed=False).size().unstack(fill_value=0)
+    st.dataframe(counts.reindex(columns=kinds, fill_value=0), use_container_width=True)
+    st.caption("Hari terakhir bersifat sementara: event-nya dihitung ulang di sinkronisasi berikutnya jika sheet hari itu masih bertambah. "
+               "Produk Toko Saya diambil dari HASIL_MATCHING (satu baris per pasangan).")
+    show_table(feed, rupiah=['Harga Lama', 'Harga Baru', 'Harga Toko Saya'], key="page_change_feed",
+               column_config={'Tanggal': st.column_config.DateColumn(format="YYYY-MM-DD")})
 
-    with tab6:
-        st.header("Analisis Produk Baru Mingguan")
-        weeks = sorted(df_filtered['Minggu'].unique())
-        if len(weeks) < 2:
-            st.info("Butuh setidaknya 2 minggu data untuk melakukan perbandingan produk baru.")
-        else:
-            col1, col2 = st.columns(2)
-            week_before = col1.selectbox("Pilih Minggu Pembanding:", weeks, index=0)
-            week_after = col2.selectbox("Pilih Minggu Penentu:", weeks, index=len(weeks)-1)
 
-            if week_before >= week_after:
-                st.error("Minggu Penentu harus setelah Minggu Pembanding.")
-            else:
-                all_stores = sorted(df_filtered['Toko'].unique())
-                for store in all_stores:
-                    with st.expander(f"Lihat Produk Baru di Toko: **{store}**"):
-                        products_before = set(df_filtered[(df_filtered['Toko'] == store) & (df_filtered['Minggu'] == week_before) & (df_filtered['Status'] == 'Tersedia')]['Nama Produk'])
-                        products_after = set(df_filtered[(df_filtered['Toko'] == store) & (df_filtered['Minggu'] == week_after) & (df_filtered['Status'] == 'Tersedia')]['Nama Produk'])
-                        new_products = products_after - products_before
-                        
-                        if not new_products:
-                            st.write("Tidak ada produk baru yang terdeteksi.")
-                        else:
-                            st.write(f"Ditemukan **{len(new_products)}** produk baru:")
-                            new_products_df = df_filtered[df_filtered['Nama Produk'].isin(new_products) & (df_filtered['Toko'] == store) & (df_filtered['Minggu'] == week_after)].copy()
-                            new_products_df['Harga_fmt'] = new_products_df['Harga'].apply(lambda x: f"Rp {int(x):,.0f}")
-                            st.dataframe(new_products_df[['Nama Produk', 'Harga_fmt', 'Stok', 'Brand']].rename(columns={'Harga_fmt':'Harga'}), use_container_width=True, hide_index=True)
+# =========================================================================================
+# ================================ TAMPILAN KONTEN UTAMA ================================
+# =========================================================================================
+
+if app_mode == "Tab Analisis":
+    st.header("📈 Tampilan Analisis Penjualan & Kompetitor")
+    # st.tabs selalu menjalankan isi semua tab; navigasi radio membuat hanya tab terpilih yang dihitung.
+    # Ganti tab = satu rerun penuh ke server (bukan perpindahan instan di browser); pilihan tab lain dijaga
+    # lewat keep_tab_widget_state.
+    keep_tab_widget_state()
+    active_tab = st.radio("Pilih tab analisis:", list(ANALYSIS_TABS), horizontal=True, key="active_tab", label_visibility="collapsed")
+    ANALYSIS_TABS[active_tab]()
 
 elif app_mode == "HPP Produk":
     st.header("💰 Tampilan Analisis Harga Pokok Penjualan (HPP)")
@@ -641,41 +954,12 @@ elif app_mode == "HPP Produk":
         st.error("Sheet 'DATABASE' tidak ditemukan atau tidak memiliki kolom 'SKU'. Analisis HPP tidak dapat dilanjutkan.")
         st.stop()
 
-    # Pastikan kolom HPP ada dan bersihkan
-    if 'HPP (LATEST)' not in db_df.columns: db_df['HPP (LATEST)'] = np.nan
-    if 'HPP (AVERAGE)' not in db_df.columns: db_df['HPP (AVERAGE)'] = np.nan
-
-    # Konversi kolom HPP ke numerik, paksa error menjadi NaN (kosong)
-    db_df['HPP_LATEST_NUM'] = pd.to_numeric(db_df['HPP (LATEST)'], errors='coerce')
-    db_df['HPP_AVERAGE_NUM'] = pd.to_numeric(db_df['HPP (AVERAGE)'], errors='coerce')
-
-    # Logika fallback: Gunakan LATEST, jika kosong, gunakan AVERAGE
-    db_df['HPP'] = db_df['HPP_LATEST_NUM'].fillna(db_df['HPP_AVERAGE_NUM'])
-    
-    # Pilih hanya data HPP yang relevan dan bersih
-    hpp_data = db_df[['SKU', 'HPP']].copy()
-    hpp_data.dropna(subset=['SKU', 'HPP'], inplace=True)
-    hpp_data = hpp_data[hpp_data['SKU'] != '']
-    hpp_data.drop_duplicates(subset=['SKU'], keep='first', inplace=True)
-
-    # 2. GABUNGKAN DATA PENJUALAN TERBARU DENGAN DATA HPP
-    # Menggunakan data penjualan terbaru dari toko Anda
-    latest_db_klik = main_store_latest_overall.copy()
-    
-    # Gabungkan berdasarkan SKU. `how='left'` menjaga semua produk dari toko Anda.
-    merged_df = pd.merge(latest_db_klik, hpp_data, on='SKU', how='left')
-
-    # 3. HITUNG SELISIH DAN PISAHKAN DATA
-    merged_df['Selisih'] = merged_df['Harga'] - merged_df['HPP']
-
-    # Tabel 1: Jual lebih murah dari HPP (Rugi)
-    df_rugi = merged_df[merged_df['Selisih'] < 0].copy()
-
-    # Tabel 2: Jual lebih mahal dari HPP (Untung)
-    df_untung = merged_df[(merged_df['Selisih'] >= 0)].copy()
-
-    # Tabel 3: Produk tidak ditemukan HPP-nya di DATABASE
-    df_tidak_ditemukan = merged_df[merged_df['HPP'].isnull()].copy()
+    # 2. GABUNGKAN DATA PENJUALAN TERBARU TOKO ANDA DENGAN HPP PER SKU, LALU PISAHKAN
+    # HPP (LATEST), jika kosong HPP (AVERAGE); `how='left'` menjaga semua produk dari toko Anda.
+    # Rugi (Selisih < 0), Untung (Selisih >= 0), dan produk yang HPP-nya tidak ditemukan di DATABASE.
+    # Tabel yang sama dipakai oleh ekspor di sidebar.
+    hpp_views = get_hpp_tables(data_cache_key, df, db_df)
+    df_rugi, df_untung, df_tidak_ditemukan = hpp_views['rugi'], hpp_views['untung'], hpp_views['tidak_ditemukan']
 
     # 4. TAMPILKAN TABEL-TABEL HASIL ANALISIS
     
@@ -684,12 +968,7 @@ elif app_mode == "HPP Produk":
     if df_rugi.empty:
         st.success("👍 Mantap! Tidak ada produk yang dijual di bawah HPP.")
     else:
-        display_rugi = df_rugi[['Nama Produk', 'SKU', 'Harga', 'HPP', 'Selisih', 'Terjual per Bulan', 'Omzet']].copy()
-        display_rugi.rename(columns={'Terjual per Bulan': 'Terjual/Bln'}, inplace=True)
-        # Formatting
-        for col in ['Harga', 'HPP', 'Selisih', 'Omzet']:
-            display_rugi[col] = display_rugi[col].apply(format_rupiah)
-        st.dataframe(display_rugi, use_container_width=True, hide_index=True)
+        show_table(df_rugi, rupiah=['Harga', 'HPP', 'Selisih', 'Omzet'], key="page_hpp_rugi")
 
     st.divider()
 
@@ -698,12 +977,7 @@ elif app_mode == "HPP Produk":
     if df_untung.empty:
         st.warning("Tidak ada produk yang dijual di atas HPP.")
     else:
-        display_untung = df_untung[['Nama Produk', 'SKU', 'Harga', 'HPP', 'Selisih', 'Terjual per Bulan', 'Omzet']].copy()
-        display_untung.rename(columns={'Terjual per Bulan': 'Terjual/Bln'}, inplace=True)
-        # Formatting
-        for col in ['Harga', 'HPP', 'Selisih', 'Omzet']:
-            display_untung[col] = display_untung[col].apply(format_rupiah)
-        st.dataframe(display_untung, use_container_width=True, hide_index=True)
+        show_table(df_untung, rupiah=['Harga', 'HPP', 'Selisih', 'Omzet'], key="page_hpp_untung")
 
     st.divider()
     
@@ -713,11 +987,64 @@ elif app_mode == "HPP Produk":
         st.success("👍 Semua produk yang dijual berhasil dicocokkan dengan data HPP di DATABASE.")
     else:
         st.warning("Mohon untuk mengecek data produk lagi, sepertinya ada data yang tidak akurat atau SKU tidak cocok.")
-        display_tidak_ditemukan = df_tidak_ditemukan[['Nama Produk', 'SKU', 'Harga', 'Terjual per Bulan', 'Omzet']].copy()
-        display_tidak_ditemukan.rename(columns={'Terjual per Bulan': 'Terjual/Bln'}, inplace=True)
-        # Formatting
-        for col in ['Harga', 'Omzet']:
-            display_tidak_ditemukan[col] = display_tidak_ditemukan[col].apply(format_rupiah)
-        st.dataframe(display_tidak_ditemukan, use_container_width=True, hide_index=True)
+        show_table(df_tidak_ditemukan, rupiah=['Harga', 'Omzet'], key="page_hpp_tidak_ditemukan")
+
+    st.divider()
 
+    # --- MARGIN DARI WAKTU KE WAKTU (SEMUA SNAPSHOT HISTORIS, HPP SAAT INI) ---
+    st.subheader("📉 Margin terhadap HPP dari Waktu ke Waktu")
+    st.caption("Harga setiap snapshot toko Anda dibandingkan dengan HPP saat ini di DATABASE.")
+    margin_history = get_hpp_margin_history(data_cache_key, df, db_df)
+    weekly_exposure = margin_history['mingguan']
+    if weekly_exposure.empty:
+        st.info("Belum ada snapshot historis yang bisa dibandingkan dengan HPP.")
+    else:
+        fig_exposure = px.bar(weekly_exposure, x='Minggu', y='Potensi Rugi/Bulan', hover_data=['Produk di Bawah HPP', 'Produk ber-HPP'],
+                              title='Eksposur Mingguan di Bawah HPP ((HPP - Harga) x Terjual per Bulan)')
+        st.plotly_chart(fig_exposure, use_container_width=True)
+        per_sku = margin_history['per_sku']
+        sku_labels = per_sku.drop_duplicates('SKU', keep='last').set_index('SKU')['Nama Produk'].astype(str)
+        selected_sku = st.selectbox("Margin per SKU:", list(sku_labels.index), format_func=lambda sku: f"{sku} · {sku_labels[sku]}", key="hpp_margin_sku")
+        if selected_sku is not None:
+            sku_margin = per_sku[per_sku['SKU'] == selected_sku]
+            fig_margin = px.line(sku_margin, x='Tanggal', y='Margin (%)', markers=True, hover_data=['Harga', 'HPP', 'Selisih'],
+                                 title=f"Margin {sku_labels[selected_sku]} terhadap HPP")
+            fig_margin.add_hline(y=0, line_dash='dot', line_color='red')
+            st.plotly_chart(fig_margin, use_container_width=True)
 
+
+# ================================
+# PANEL DIAGNOSTIK (SIDEBAR, DIRENDER PALING AKHIR)
+# ================================
+# Dirender setelah semua tahap selesai agar rerun ini tercatat lengkap (rerun yang berhenti lewat st.stop /
+# st.rerun tetap tersimpan di riwayat dan bisa dipilih pada rerun berikutnya).
+def render_diagnostics_panel(runs, job=None):
+    with st.sidebar.expander("🩺 Panel Diagnostik", expanded=True):
+        reports = [run.to_dict() for run in runs]
+        if job is not None and job.get('diagnostics') is not None:
+            reports.append(job['diagnostics'].to_dict())
+        labels = [f"{report['label']} ({report['mulai'][11:]})" for report in reports]
+        chosen = st.selectbox("Catatan:", range(len(reports)), index=len(runs) - 1, format_func=lambda i: labels[i], key="diagnostics_pick")
+        report = reports[chosen]
+        api = report['api_sheets']
+        col1, col2 = st.columns(2)
+        col1.metric("Panggilan API Sheets", api['total_panggilan'])
+        col2.metric("Data diambil", f"{api['byte_diambil_perkiraan'] / 1e6:.2f} MB")
+        if report['tahap']:
+            st.markdown("**Waktu per tahap**")
+            st.dataframe(pd.DataFrame(report['tahap']).drop(columns=['Kedalaman']), use_container_width=True, hide_index=True)
+        if api['per_metode']:
+            st.dataframe(pd.DataFrame(list(api['per_metode'].items()), columns=['Metode API', 'Panggilan']), use_container_width=True, hide_index=True)
+        if report['memori_frame']:
+            st.markdown("**Memori DataFrame**")
+            st.dataframe(pd.DataFrame.from_dict(report['memori_frame'], orient='index').rename_axis('Frame').reset_index(),
+                         use_container_width=True, hide_index=True)
+        if report['cache']:
+            st.markdown("**Cache**")
+            st.dataframe(pd.DataFrame.from_dict(report['cache'], orient='index').rename_axis('Fungsi').reset_index(),
+                         use_container_width=True, hide_index=True)
+        st.download_button("⬇️ Ekspor Diagnostik (JSON)", data=json.dumps(reports, indent=2, ensure_ascii=False),
+                           file_name=f"diagnostik_{datetime.now():%Y%m%d_%H%M%S}.json", mime='application/json')
+
+if run_diagnostics is not None:
+    render_diagnostics_panel(st.session_state['diagnostics_runs'], job_registry['jobs'].get(SPREADSHEET_KEY))
@@ -0,0 +1,322 @@
+# ===================================================================================
+#  DATA SINTETIS & BENCHMARK PIPELINE
+#  Generator REKAP / DATABASE / HASIL_MATCHING (seeded) dengan bentuk persis seperti sheet asli,
+#  lalu pengukuran waktu tiap tahap pipeline untuk beberapa ukuran data:
+#      python benchmark.py --sizes 4x200x30 10x1000x60 --repeat 3 --out hasil_benchmark
+#      python benchmark.py --sizes 4x200x30 --write-sheets contoh_sheets.json   # lalu: pipeline.py --local
+#  Ukuran ditulis TOKOxPRODUKxHARI (toko termasuk DB KLIK, maksimal sebanyak toko di REKAP_SHEET_NAMES).
+# ===================================================================================
+
+import os
+import csv
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import tempfile
+import statistics
+from datetime import date, datetime, timedelta
+import numpy as np
+import pandas as pd
+import rapidfuzz
+from rapidfuzz import fuzz
+from pipeline import (
+    REKAP_SHEET_NAMES, MATCHING_SHEET_NAME, MATCH_RESULT_COLUMNS, MY_STORE_NAME, LocalSheetsClient,
+    load_all_data, build_rekap_df, normalize_rekap_df, compact_rekap_df,
+    latest_source_rows, derive_frames, match_catalog, build_blocking_index, brands_by_name, merge_hpp, name_tokens, normalize_product_name, normalized_names, hpp_index, hpp_margin_history,
+    build_price_comparison, availability_changes, detect_changes
+)
+
+# ================================
+# GENERATOR DATA SINTETIS
+# ================================
+SYNTHETIC_BRANDS = {
+    'LOGITECH': ['Mouse', 'Keyboard', 'Headset'], 'RAZER': ['Mouse', 'Keyboard', 'Headset'],
+    'ASUS': ['Monitor', 'Motherboard', 'VGA'], 'MSI': ['Monitor', 'Motherboard', 'VGA'],
+    'KINGSTON': ['RAM', 'SSD'], 'SAMSUNG': ['SSD', 'Monitor'], 'FANTECH': ['Mouse', 'Keyboard'],
+    'REXUS': ['Mouse', 'Keyboard', 'Headset'], 'GIGABYTE': ['Motherboard', 'VGA'], 'ADATA': ['RAM', 'SSD'],
+}
+SYNTHETIC_SPECS = {
+    'Mouse': ['Wireless', 'Gaming RGB', 'Lightspeed', 'Silent'], 'Keyboard': ['Mechanical', 'TKL', 'Wireless', 'Low Profile'],
+    'Headset': ['7.1 Surround', 'Wireless', 'USB'], 'Monitor': ['24 Inch 165Hz', '27 Inch IPS', '32 Inch Curved'],
+    'Motherboard': ['B650M', 'Z790', 'B760M DDR5'], 'VGA': ['RTX 4060 8GB', 'RTX 4070 12GB', 'RX 7600 8GB'],
+    'RAM': ['16GB DDR4 3200', '32GB DDR5 5600', '8GB DDR4 2666'], 'SSD': ['1TB NVMe', '512GB SATA', '2TB NVMe Gen4'],
+}
+SYNTHETIC_PRICE_RANGE = {
+    'Mouse': (80, 2_000), 'Keyboard': (150, 3_000), 'Headset': (150, 3_500), 'Monitor': (1_500, 9_000),
+    'Motherboard': (1_200, 8_000), 'VGA': (3_500, 15_000), 'RAM': (250, 2_500), 'SSD': (400, 4_000),
+}
+NAME_TAGS = ['[READY STOCK]', 'ORIGINAL', 'Garansi Resmi', 'BNIB', '- Hitam', 'Official']
+
+def synthetic_store_names(n_stores):
+    """DB KLIK + kompetitor, diambil dari REKAP_SHEET_NAMES agar load_all_data benar-benar memuatnya."""
+    stores = []
+    for sheet_name in REKAP_SHEET_NAMES:
+        if ' - REKAP - ' in sheet_name:
+            store = sheet_name.split(' - REKAP - ')[0]
+            if store not in stores: stores.append(store)
+    stores.remove(MY_STORE_NAME)
+    if not 1 <= n_stores <= len(stores) + 1:
+        raise ValueError(f"Jumlah toko harus 1-{len(stores) + 1} (dibatasi REKAP_SHEET_NAMES).")
+    return [MY_STORE_NAME] + stores[:n_stores - 1]
+
+def _synthetic_catalog(n_products, rnd):
+    catalog = []
+    for i in range(n_products):
+        brand = rnd.choice(list(SYNTHETIC_BRANDS))
+        category = rnd.choice(SYNTHETIC_BRANDS[brand])
+        model = f"{rnd.choice('GKMXPZ')}{100 + i}"
+        low, high = SYNTHETIC_PRICE_RANGE[category]
+        catalog.append({
+            'SKU': f"SKU-{i:06d}", 'Brand': brand, 'Kategori': category,
+            'Nama': f"{brand} {model} {category} {rnd.choice(SYNTHETIC_SPECS[category])}",
+            'Harga': rnd.randint(low, high) * 1000,
+        })
+    return catalog
+
+def _name_variant(name, rnd):
+    """Variasi nama ala marketplace: huruf besar/kecil, tag tambahan, singkatan, urutan token, tanpa brand."""
+    tokens = name.split()
+    style = rnd.random()
+    if style < 0.2: tokens = tokens[1:] + [tokens[0]]
+    elif style < 0.35: tokens = tokens[1:]
+    elif style < 0.5: tokens = [t.replace('Wireless', 'WL').replace('Mechanical', 'Mech') for t in tokens]
+    variant = ' '.join(tokens)
+    if rnd.random() < 0.5: variant = f"{variant} {rnd.choice(NAME_TAGS)}"
+    if rnd.random() < 0.3: variant = variant.upper()
+    elif rnd.random() < 0.2: variant = variant.title()
+    return variant
+
+def _messy_price(value, rnd):
+    """Format Harga seperti yang diketik penjual: titik/koma ribuan, awalan Rp, akhiran ,- ; sesekali kosong."""
+    style = rnd.random()
+    if style < 0.01: return rnd.choice(['', '-', 'Hubungi Kami'])
+    if style < 0.35: return f"Rp {value:,.0f}".replace(',', '.')
+    if style < 0.55: return f"Rp{value}"
+    if style < 0.75: return f"{value:,.0f}".replace(',', '.')
+    if style < 0.85: return f"Rp {value:,.0f}"
+    if style < 0.93: return f"{value:,.0f}".replace(',', '.') + ",-"
+    return str(value)
+
+def generate_sheets(n_stores=4, n_products=200, n_days=30, seed=0, start_date=date(2025, 1, 1)):
+    """
+    Nilai mentah semua sheet {judul: [baris, ...]} (baris pertama header), siap untuk LocalSpreadsheet:
+      - '<TOKO> - REKAP - READY/HABIS' : satu snapshot per hari per produk yang dijual toko itu
+        (NAMA, HARGA berformat acak, TERJUAL/BLN, TANGGAL dd/mm/yyyy, SKU, STOK, KATEGORI),
+      - 'DATABASE' : SKU, NAMA, HPP (LATEST) (kadang kosong), HPP (AVERAGE),
+      - 'HASIL_MATCHING' : pasangan nama toko sendiri x varian kompetitor dengan skor token_set_ratio >= 80.
+    Setiap toko menjual sebagian katalog dengan varian nama tetap, harga bergeser pelan dan status stok berubah.
+    """
+    rnd = random.Random(seed)
+    stores = synthetic_store_names(n_stores)
+    catalog = _synthetic_catalog(n_products, rnd)
+    header = ["NAMA", "HARGA", "TERJUAL/BLN", "TANGGAL", "SKU", "STOK", "KATEGORI"]
+    sheets = {}
+    listings = {}
+    for store in stores:
+        share = 0.85 if store == MY_STORE_NAME else rnd.uniform(0.4, 0.7)
+        listings[store] = [
+            {'product': product, 'name': product['Nama'] if store == MY_STORE_NAME else _name_variant(product['Nama'], rnd),
+             'price': int(product['Harga'] * rnd.uniform(0.9, 1.12)) // 100 * 100, 'ready': rnd.random() < 0.8,
+             'sold': rnd.randint(0, 300)}
+            for product in catalog if rnd.random() < share
+        ]
+        ready_rows, sold_out_rows = [header], [header]
+        for day in range(n_days):
+            day_text = (start_date + timedelta(days=day)).strftime('%d/%m/%Y')
+            for listing in listings[store]:
+                if rnd.random() < 0.05: listing['ready'] = not listing['ready']
+                if rnd.random() < 0.03: listing['price'] = max(1000, int(listing['price'] * rnd.uniform(0.95, 1.05)) // 100 * 100)
+                listing['sold'] = max(0, listing['sold'] + rnd.randint(-5, 5))
+                row = [listing['name'], _messy_price(listing['price'], rnd), str(listing['sold']) if rnd.random() > 0.02 else '',
+                       day_text, listing['product']['SKU'] if store == MY_STORE_NAME else '',
+                       str(rnd.randint(1, 50)) if listing['ready'] else '0', listing['product']['Kategori']]
+                (ready_rows if listing['ready'] else sold_out_rows).append(row)
+        sheets[f"{store} - REKAP - READY"] = ready_rows
+        sheets[f"{store} - REKAP - HABIS"] = sold_out_rows
+
+    database = [["SKU", "NAMA", "HPP (LATEST)", "HPP (AVERAGE)"]]
+    for product in catalog:
+        if rnd.random() < 0.05: continue  # SKU tanpa HPP -> tabel "tidak terdeteksi"
+        hpp = int(product['Harga'] * rnd.uniform(0.75, 1.02)) // 100 * 100
+        database.append([product['SKU'], product['Nama'], '' if rnd.random() < 0.1 else str(hpp), str(int(hpp * rnd.uniform(0.97, 1.03)))])
+    sheets["DATABASE"] = database
+
+    matching = [MATCH_RESULT_COLUMNS]
+    update_date = (start_date + timedelta(days=max(n_days - 1, 0))).strftime('%Y-%m-%d')
+    my_listings = {listing['product']['SKU']: listing for listing in listings[MY_STORE_NAME]}
+    for store in stores[1:]:
+        for listing in listings[store]:
+            mine = my_listings.get(listing['product']['SKU'])
+            if mine is None: continue
+            score = int(fuzz.token_set_ratio(mine['name'], listing['name']))
+            if score >= 80:
+                matching.append([mine['name'], str(mine['price']), listing['name'], str(listing['price']), store, str(score), update_date])
+    sheets[MATCHING_SHEET_NAME] = matching
+    return sheets
+
+def write_sheets(sheets, path):
+    """Simpan sebagai file .json (satu file) atau folder CSV, format yang dibaca LocalSheetsClient."""
+    if path.endswith('.json'):
+        with open(path, 'w', encoding='utf-8') as f: json.dump(sheets, f, ensure_ascii=False)
+        return path
+    os.makedirs(path, exist_ok=True)
+    for title, rows in sheets.items():
+        with open(os.path.join(path, title + '.csv'), 'w', encoding='utf-8', newline='') as f:
+            csv.writer(f).writerows(rows)
+    return path
+
+# ================================
+# BENCHMARK PER TAHAP
+# ================================
+def parse_size(text):
+    """'4x200x30' -> (toko, produk, hari)."""
+    try:
+        n_stores, n_products, n_days = (int(part) for part in text.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Ukuran '{text}' harus berformat TOKOxPRODUKxHARI, mis. 4x200x30.")
+    return n_stores, n_products, n_days
+
+def time_stage(func, repeat):
+    """Jalankan `func` sebanyak `repeat` kali. Return (daftar detik, hasil panggilan terakhir)."""
+    durations, result = [], None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        durations.append(time.perf_counter() - started)
+    return durations, result
+
+def benchmark_size(n_stores, n_products, n_days, repeat=3, seed=0, score_cutoff=88, workdir=None):
+    """
+    Ukur semua tahap untuk satu ukuran data. Return list dict per tahap (detik min/median/maks + metrik ukuran).
+    Tahap: muat data lewat klien lokal, normalisasi, snapshot terbaru & frame tab, pencocokan (dengan/tanpa
+    blocking), merge HPP dan agregasi tab Perbandingan Harga / Analisis Mingguan.
+    """
+    sheets = generate_sheets(n_stores, n_products, n_days, seed=seed)
+    rekap_values = {title: rows for title, rows in sheets.items() if 'REKAP' in title}
+    sheet_path = write_sheets(sheets, os.path.join(workdir or tempfile.mkdtemp(), f"sheets_{n_stores}x{n_products}x{n_days}.json"))
+    gc = LocalSheetsClient(sheet_path)
+    results = []
+
+    def record(stage, durations, **metrics):
+        results.append({
+            'ukuran': f"{n_stores}x{n_products}x{n_days}", 'toko': n_stores, 'produk': n_products, 'hari': n_days,
+            'tahap': stage, 'ulangan': len(durations), 'detik_min': round(min(durations), 4),
+            'detik_median': round(statistics.median(durations), 4), 'detik_maks': round(max(durations), 4), **metrics,
+        })
+
+    durations, (rekap_df, database_df, matches_df) = time_stage(lambda: load_all_data(gc, 'benchmark'), repeat)
+    n_rows = len(rekap_df)
+    record('muat_data (klien lokal)', durations, baris_rekap=n_rows,
+           memori_rekap_mb=round(rekap_df.memory_usage(deep=True).sum() / 1e6, 2))
+
+    durations, _ = time_stage(lambda: compact_rekap_df(normalize_rekap_df(build_rekap_df(rekap_values))), repeat)
+    record('normalisasi_rekap', durations, baris_rekap=n_rows)
+
+    durations, source_df = time_stage(lambda: latest_source_rows(rekap_df), repeat)
+    record('snapshot_terbaru', durations, baris_rekap=n_rows, baris_hasil=len(source_df))
+
+    start, end = rekap_df['Tanggal'].min().date(), rekap_df['Tanggal'].max().date()
+    durations, derived = time_stage(lambda: derive_frames(rekap_df, start, end), repeat)
+    record('frame_turunan_tab', durations, baris_rekap=n_rows)
+
+    my_rows = source_df[source_df['Toko'] == MY_STORE_NAME].reset_index(drop=True)
+    competitor_df = source_df[source_df['Toko'] != MY_STORE_NAME]
+    my_names = my_rows['Nama Produk'].astype(str).tolist()
+    competitor_names = competitor_df['Nama Produk'].astype(str).unique().tolist()
+    pairs_total = len(my_names) * len(competitor_names)
+
+    def normalize_cold():
+        normalize_product_name.cache_clear(); name_tokens.cache_clear()
+        return normalized_names(my_names + competitor_names)
+    durations, (_, unique_keys) = time_stage(normalize_cold, repeat)
+    record('normalisasi_nama', durations, nama=len(my_names) + len(competitor_names), nama_kanonik_unik=len(unique_keys))
+
+    # Sebelum: token_set_ratio atas nama mentah; sesudah: bentuk kanonik unik (memo sudah hangat)
+    durations, table = time_stage(lambda: match_catalog(my_names, competitor_names, score_cutoff, normalize=False), repeat)
+    record('pencocokan_penuh_nama_mentah', durations, pasangan_diskor=pairs_total, pasangan_cocok=len(table),
+           pasangan_per_detik=round(pairs_total / max(min(durations), 1e-9)))
+    durations, table = time_stage(lambda: match_catalog(my_names, competitor_names, score_cutoff), repeat)
+    record('pencocokan_penuh', durations, pasangan_diskor=pairs_total, pasangan_cocok=len(table),
+           pasangan_unik_diskor=table.attrs['unique_pairs_scored'], pasangan_per_detik=round(pairs_total / max(min(durations), 1e-9)))
+
+    def blocked_match():
+        blocking_index = build_blocking_index(competitor_names, brands_by_name(competitor_df, competitor_names))
+        return match_catalog(my_names, competitor_names, score_cutoff, blocking_index=blocking_index,
+                             my_brands=my_rows['Brand'].astype(str).tolist())
+    durations, table = time_stage(blocked_match, repeat)
+    pairs_scored = table.attrs.get('pairs_scored', pairs_total)
+    record('pencocokan_blocking', durations, pasangan_diskor=pairs_scored, pasangan_cocok=len(table),
+           pasangan_per_detik=round(pairs_scored / max(min(durations), 1e-9)))
+
+    durations, merged = time_stage(lambda: merge_hpp(derived['main_store_latest_overall'], database_df), repeat)
+    record('merge_hpp', durations, baris_hasil=len(merged), tanpa_hpp=int(merged['HPP'].isna().sum()))
+    index = hpp_index(database_df)
+    my_rekap_df = rekap_df[rekap_df['Toko'] == MY_STORE_NAME]
+    durations, margin = time_stage(lambda: hpp_margin_history(my_rekap_df, index), repeat)
+    record('margin_hpp_historis', durations, baris_hasil=len(margin['per_sku']), minggu=len(margin['mingguan']))
+
+    durations, comparison = time_stage(lambda: build_price_comparison(derived, matches_df, score_cutoff), repeat)
+    record('agregasi_perbandingan_harga', durations, baris_hasil=len(comparison['summary']), baris_matching=len(matches_df))
+
+    weeks = derived['availability']['weeks']
+    if len(weeks) >= 2:
+        durations, changes = time_stage(
+            lambda: availability_changes(derived['availability'], weeks[0], weeks[-1], derived['latest_entries_weekly']), repeat)
+        record('agregasi_ketersediaan_mingguan', durations, baris_hasil=len(changes), minggu=len(weeks))
+
+    # Feed perubahan: pengisian awal atas seluruh REKAP vs sinkronisasi rutin (hanya hari terakhir diproses ulang)
+    change_dir = tempfile.mkdtemp(dir=workdir)
+    def seed_changes():
+        path = os.path.join(change_dir, f"changes_{time.perf_counter_ns()}.sqlite")
+        return path, detect_changes(path, rekap_df)
+    durations, (change_path, stats) = time_stage(seed_changes, repeat)
+    record('deteksi_perubahan_awal', durations, baris_rekap=n_rows, baris_diproses=stats['Baris diproses'], event=stats['Total event'])
+    durations, stats = time_stage(lambda: detect_changes(change_path, rekap_df), repeat)
+    record('deteksi_perubahan_inkremental', durations, baris_rekap=n_rows, baris_diproses=stats['Baris diproses'], event=stats['Event baru'])
+    return results
+
+def run_benchmarks(sizes, repeat=3, seed=0, score_cutoff=88, out_dir='hasil_benchmark', progress=print):
+    """Jalankan benchmark_size untuk setiap ukuran, tulis results.json (dengan metadata lingkungan) & results.csv."""
+    os.makedirs(out_dir, exist_ok=True)
+    rows = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for n_stores, n_products, n_days in sizes:
+            progress(f"Ukuran {n_stores}x{n_products}x{n_days} ...")
+            for row in benchmark_size(n_stores, n_products, n_days, repeat=repeat, seed=seed, score_cutoff=score_cutoff, workdir=workdir):
+                rows.append(row)
+                progress(f"  {row['tahap']:<32} {row['detik_median']:>9.4f} s")
+    report = {
+        'dibuat': datetime.now().isoformat(timespec='seconds'),
+        'lingkungan': {'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+                       'rapidfuzz': rapidfuzz.__version__, 'cpu': os.cpu_count(), 'platform': platform.platform()},
+        'parameter': {'ulangan': repeat, 'seed': seed, 'cutoff': score_cutoff},
+        'hasil': rows,
+    }
+    with open(os.path.join(out_dir, 'results.json'), 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    pd.DataFrame(rows).to_csv(os.path.join(out_dir, 'results.csv'), index=False)
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark pipeline dengan data sintetis.")
+    parser.add_argument('--sizes', nargs='+', type=parse_size, default=[(4, 200, 30), (6, 1000, 30), (10, 2000, 60)],
+                        help="Daftar ukuran TOKOxPRODUKxHARI.")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cutoff', type=int, default=88, help="Skor minimum kemiripan untuk tahap pencocokan.")
+    parser.add_argument('--out', default='hasil_benchmark', help="Folder hasil (results.json & results.csv).")
+    parser.add_argument('--write-sheets', help="Hanya tulis data sintetis ukuran pertama ke file .json / folder CSV, tanpa benchmark.")
+    args = parser.parse_args(argv)
+
+    if args.write_sheets:
+        print(write_sheets(generate_sheets(*args.sizes[0], seed=args.seed), args.write_sheets))
+        return 0
+    run_benchmarks(args.sizes, repeat=args.repeat, seed=args.seed, score_cutoff=args.cutoff, out_dir=args.out)
+    print(f"Hasil ditulis ke {os.path.join(args.out, 'results.json')} dan results.csv")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
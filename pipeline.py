@@ -0,0 +1,2281 @@
+# ===================================================================================
+#  PIPELINE DATA & PENCOCOKAN HARGA (TANPA STREAMLIT)
+#  Muat sheet -> normalisasi -> snapshot -> pencocokan -> tulis HASIL_MATCHING.
+#  Dipakai oleh app.py dan bisa dijalankan langsung dari cron:
+#      python pipeline.py --key <SPREADSHEET_ID> --credentials service_account.json
+#      python pipeline.py --local data_sheets/ --dry-run
+# ===================================================================================
+
+import pandas as pd
+from rapidfuzz import process, fuzz
+import re
+import io
+import os
+import csv
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import functools
+import importlib.util
+import logging
+import random
+import argparse
+import requests
+import threading
+import weakref
+import contextvars
+import gspread
+from contextlib import closing, contextmanager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from gspread.utils import fill_gaps, numericise_all, rowcol_to_a1
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+logger = logging.getLogger("pipeline")
+
+def log_notify(level, message):
+    # Penerima pesan default: logging. app.py mengganti dengan st.warning / st.error
+    logger.log(logging.ERROR if level == 'error' else logging.WARNING, message)
+
+# ================================
+# DIAGNOSTIK (OPSIONAL)
+# ================================
+# Waktu per tahap, panggilan API Sheets, memori DataFrame dan hit/miss cache untuk satu rerun / satu proses.
+# Pencatat aktif diteruskan lewat ContextVar; tanpa pencatat aktif, diagnostic_stage & record_* hanya
+# membaca ContextVar lalu kembali, sehingga instrumentasi bisa tetap terpasang permanen.
+_active_diagnostics = contextvars.ContextVar('pipeline_diagnostics', default=None)
+_stage_path = contextvars.ContextVar('pipeline_stage_path', default=())
+
+class Diagnostics:
+    def __init__(self, label=''):
+        self.label, self.started_at = label, datetime.now()
+        self.stages, self.frames, self.api_calls, self.cache = [], {}, {}, {}
+        self.bytes_fetched = 0
+        self._lock = threading.Lock()  # job latar & skrip bisa mencatat bersamaan
+
+    def add_stage(self, path, seconds):
+        with self._lock: self.stages.append({'Tahap': ' › '.join(path), 'Kedalaman': len(path) - 1, 'Detik': round(seconds, 4)})
+
+    def add_api_call(self, method, payload_bytes=0):
+        with self._lock:
+            self.api_calls[method] = self.api_calls.get(method, 0) + 1
+            self.bytes_fetched += payload_bytes
+
+    def add_frame(self, name, frames):
+        frames = frames.values() if isinstance(frames, dict) else [frames]
+        frames = [frame for frame in frames if isinstance(frame, pd.DataFrame)]
+        self.frames[name] = {'Baris': sum(len(frame) for frame in frames),
+                             'Memori (MB)': round(sum(frame.memory_usage(deep=True).sum() for frame in frames) / 1e6, 2)}
+
+    def add_cache(self, name, miss):
+        with self._lock:
+            entry = self.cache.setdefault(name, {'Panggilan': 0, 'Miss': 0})
+            entry['Miss' if miss else 'Panggilan'] += 1
+
+    def to_dict(self):
+        """Ringkasan siap JSON."""
+        with self._lock:
+            return {
+                'label': self.label, 'mulai': self.started_at.isoformat(timespec='seconds'),
+                'tahap': list(self.stages),
+                'api_sheets': {'total_panggilan': sum(self.api_calls.values()), 'byte_diambil_perkiraan': self.bytes_fetched,
+                               'per_metode': dict(self.api_calls)},
+                'memori_frame': dict(self.frames),
+                'cache': {name: {**entry, 'Hit': max(entry['Panggilan'] - entry['Miss'], 0)} for name, entry in self.cache.items()},
+            }
+
+def activate_diagnostics(recorder):
+    """Jadikan `recorder` (atau None = mati) pencatat aktif untuk konteks/thread ini. Return token ContextVar."""
+    return _active_diagnostics.set(recorder)
+
+def current_diagnostics():
+    return _active_diagnostics.get()
+
+@contextmanager
+def use_diagnostics(recorder):
+    token = _active_diagnostics.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _active_diagnostics.reset(token)
+
+@contextmanager
+def diagnostic_stage(name):
+    """Catat waktu dinding sebuah tahap (juga bisa dipakai sebagai dekorator). Tahap bersarang dicatat dengan jalurnya."""
+    recorder = _active_diagnostics.get()
+    if recorder is None:
+        yield
+        return
+    path = _stage_path.get() + (name,)
+    token, started = _stage_path.set(path), time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.add_stage(path, time.perf_counter() - started)
+        _stage_path.reset(token)
+
+def record_frame(name, frames):
+    recorder = _active_diagnostics.get()
+    if recorder is not None: recorder.add_frame(name, frames)
+
+def record_cache(name, miss=False):
+    """Dipanggil sekali per panggilan fungsi ber-cache (miss=False) dan sekali lagi dari dalam isinya (miss=True)."""
+    recorder = _active_diagnostics.get()
+    if recorder is not None: recorder.add_cache(name, miss)
+
+# Metode klien/spreadsheet/worksheet gspread yang masing-masing memicu request HTTP
+SHEETS_API_METHODS = {
+    'open_by_key', 'worksheets', 'worksheet', 'add_worksheet', 'values_get', 'values_batch_get', 'values_batch_update',
+    'batch_update', 'get_all_values', 'get_all_records', 'update_cells', 'update', 'clear', 'resize', 'add_rows',
+}
+
+def _payload_bytes(result):
+    # Perkiraan ukuran data yang diterima: total panjang teks semua sel pada respons values
+    if isinstance(result, dict):
+        value_ranges = result.get('valueRanges', [result])
+        return sum(len(str(cell)) for vr in value_ranges for row in vr.get('values', []) for cell in row)
+    if isinstance(result, list) and result and isinstance(result[0], list):
+        return sum(len(str(cell)) for row in result for cell in row)
+    return 0
+
+class SheetsCallProxy:
+    """
+    Pembungkus klien / spreadsheet / worksheet gspread: setiap metode API dijalankan lewat
+    `around(nama_metode, fungsi, *args, **kwargs)`, dan spreadsheet/worksheet yang dikembalikan ikut dibungkus.
+    """
+    def __init__(self, target, around):
+        self._target, self._around = target, around
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name not in SHEETS_API_METHODS or not callable(attr): return attr
+        def call(*args, **kwargs):
+            result = self._around(name, attr, *args, **kwargs)
+            if isinstance(result, list) and result and hasattr(result[0], 'get_all_values'):
+                return [SheetsCallProxy(ws, self._around) for ws in result]
+            if hasattr(result, 'get_all_values') or hasattr(result, 'values_batch_get'):
+                return SheetsCallProxy(result, self._around)
+            return result
+        return call
+
+def instrument_client(gc, recorder):
+    """Klien yang menghitung panggilan API jika `recorder` aktif; tanpa recorder klien asli dikembalikan apa adanya."""
+    if recorder is None: return gc
+    def counted(method, func, *args, **kwargs):
+        result = func(*args, **kwargs)
+        recorder.add_api_call(method, _payload_bytes(result))
+        return result
+    return SheetsCallProxy(gc, counted)
+
+# ================================
+# KLIEN SHEETS: ANGGARAN KUOTA, RETRY & BACKOFF
+# ================================
+SHEETS_REQUESTS_PER_MINUTE = 60   # kuota baca default Sheets API per pengguna per menit
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+# Tidak idempoten: hanya diulang jika ditolak kuota (429 = request tidak dieksekusi), bukan pada 5xx
+NON_IDEMPOTENT_METHODS = {'batch_update', 'add_rows', 'add_worksheet'}
+
+def _error_status(exc):
+    """Kode status error Sheets (429, 503, ...), 'koneksi' untuk putus/timeout jaringan, None jika bukan error sementara."""
+    if isinstance(exc, gspread.exceptions.APIError): return exc.code
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout)): return 'koneksi'
+    return None
+
+def quota_exceeded_error(message="Quota exceeded for quota metric 'Read requests' (simulasi)."):
+    """APIError 429 seperti yang dilempar gspread saat kuota habis (untuk klien uji)."""
+    response = requests.Response()
+    response.status_code = 429
+    response._content = json.dumps({'error': {'code': 429, 'message': message, 'status': 'RESOURCE_EXHAUSTED'}}).encode()
+    return gspread.exceptions.APIError(response)
+
+class QuotaSheetsClient(SheetsCallProxy):
+    """
+    Klien Sheets bersama untuk pemuatan, pencocokan dan penulisan (bungkus gspread.Client / LocalSheetsClient):
+      - setiap request menunggu giliran dalam anggaran `requests_per_minute` (jendela geser 60 detik,
+        dibagi semua thread & sesi yang memakai objek ini),
+      - error sementara (429, 5xx, koneksi) diulang hingga `max_retries` kali dengan backoff eksponensial
+        ber-jitter; header Retry-After dihormati bila ada,
+      - semua spreadsheet & worksheet dibuka lewat satu klien dasar, jadi satu sesi HTTP dipakai ulang.
+    Statistik kumulatif: stats_snapshot().
+    """
+    def __init__(self, client, requests_per_minute=SHEETS_REQUESTS_PER_MINUTE, max_retries=5, base_delay=1.0,
+                 max_delay=32.0, sleep=time.sleep, clock=time.monotonic, seed=None):
+        super().__init__(client, self._call)
+        self.requests_per_minute, self.max_retries = requests_per_minute, max_retries
+        self.base_delay, self.max_delay = base_delay, max_delay
+        self._sleep, self._clock, self._random = sleep, clock, random.Random(seed)
+        self._lock, self._window = threading.Lock(), deque()
+        self.stats = {'Request': 0, 'Diulang': 0, 'Error 429': 0, 'Gagal setelah retry': 0,
+                      'Menunggu anggaran (detik)': 0.0, 'Backoff (detik)': 0.0}
+
+    def _count(self, key, amount=1):
+        with self._lock: self.stats[key] += amount
+
+    def stats_snapshot(self):
+        with self._lock: return {key: round(value, 2) if isinstance(value, float) else value for key, value in self.stats.items()}
+
+    def _acquire(self):
+        while True:
+            with self._lock:
+                now = self._clock()
+                while self._window and now - self._window[0] >= 60: self._window.popleft()
+                if len(self._window) < self.requests_per_minute:
+                    self._window.append(now)
+                    self.stats['Request'] += 1
+                    return
+                wait = 60 - (now - self._window[0])
+            self._count('Menunggu anggaran (detik)', wait)
+            self._sleep(wait)
+
+    def _backoff(self, attempt, exc):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt) * (0.5 + self._random.random() / 2)
+        retry_after = getattr(getattr(exc, 'response', None), 'headers', {}).get('Retry-After')
+        if retry_after and str(retry_after).isdigit(): delay = max(delay, float(retry_after))
+        return delay
+
+    def _call(self, method, func, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            self._acquire()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                status = _error_status(e)
+                if status == 429: self._count('Error 429')
+                retryable = status == 429 or (status in RETRYABLE_STATUS | {'koneksi'} and method not in NON_IDEMPOTENT_METHODS)
+                if not retryable: raise
+                if attempt == self.max_retries:
+                    self._count('Gagal setelah retry')
+                    raise
+                delay = self._backoff(attempt, e)
+                logger.warning("Sheets %s gagal (%s), ulang ke-%d dalam %.1f dtk", method, status, attempt + 1, delay)
+                self._count('Diulang')
+                self._count('Backoff (detik)', delay)
+                self._sleep(delay)
+
+# ================================
+# LAPISAN PENGAMBILAN DATA SHEET
+# ================================
+REKAP_SHEET_NAMES = [
+    "DATABASE", "DB KLIK - REKAP - READY", "DB KLIK - REKAP - HABIS",
+    "ABDITAMA - REKAP - READY", "ABDITAMA - REKAP - HABIS", "LEVEL99 - REKAP - READY", "LEVEL99 - REKAP - HABIS",
+    "JAYA PC - REKAP - READY", "JAYA PC - REKAP - HABIS", "MULTIFUNGSI - REKAP - READY", "MULTIFUNGSI - REKAP - HABIS",
+    "IT SHOP - REKAP - READY", "IT SHOP - REKAP - HABIS", "SURYA MITRA ONLINE - REKAP - READY", "SURYA MITRA ONLINE - REKAP - HABIS",
+    "GG STORE - REKAP - READY", "GG STORE - REKAP - HABIS", "TECH ISLAND - REKAP - READY", "TECH ISLAND - REKAP - HABIS",
+    "LOGITECH - REKAP - READY", "LOGITECH - REKAP - HABIS"
+]
+MATCHING_SHEET_NAME = "HASIL_MATCHING"
+MY_STORE_NAME = "DB KLIK"   # toko sendiri; semua toko lain di REKAP dianggap kompetitor
+REKAP_RENAME = {
+    'NAMA': 'Nama Produk', 'TERJUAL/BLN': 'Terjual per Bulan',
+    'TANGGAL': 'Tanggal', 'HARGA': 'Harga', 'BRAND': 'Brand',
+    'STOK': 'Stok', 'TOKO': 'Toko', 'STATUS': 'Status'
+}
+
+def _sheet_range(sheet_name):
+    # Notasi A1: nama sheet dibungkus kutip tunggal, kutip di dalam nama digandakan
+    return "'" + sheet_name.replace("'", "''") + "'"
+
+@diagnostic_stage("ambil_sheet")
+def fetch_ranges(spreadsheet, ranges, mode="batch", batch_size=10, max_workers=4, report_timing=False):
+    """
+    Mengambil banyak range A1 dengan sesedikit mungkin request HTTP.
+
+    `ranges` adalah dict {kunci: range_A1}; hasil dikembalikan dengan kunci yang sama.
+    mode="batch"   : range diambil per kelompok `batch_size` lewat satu `values_batch_get`.
+                     Jika satu batch gagal, kelompok itu diambil ulang per range via thread pool.
+    mode="threads" : setiap range diambil sendiri-sendiri lewat thread pool (`max_workers`).
+
+    Return: (values_by_key, errors, timings)
+      - values_by_key : {kunci: list baris (sudah dipadding seperti get_all_values)}
+      - errors        : {kunci: exception} untuk range yang gagal diambil
+      - timings       : list dict per range (hanya diisi jika report_timing=True). Pada mode
+                        batch, 'Detik' adalah durasi batch tempat range itu ikut diambil.
+    """
+    keys = list(ranges)
+    values_by_key, errors, timings = {}, {}, []
+
+    def store(key, values, seconds, label):
+        values_by_key[key] = fill_gaps(values) if values else []
+        if report_timing:
+            timings.append({'Sheet': key, 'Baris': len(values), 'Detik': round(seconds, 3), 'Mode': label})
+
+    def fetch_single(key):
+        start = time.perf_counter()
+        response = spreadsheet.values_get(ranges[key])
+        return response.get('values', []), time.perf_counter() - start
+
+    def fetch_threaded(chunk):
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunk)))) as pool:
+            futures = {pool.submit(fetch_single, key): key for key in chunk}
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    values, seconds = future.result()
+                    store(key, values, seconds, 'thread')
+                except Exception as e:
+                    errors[key] = e
+
+    if mode == "threads":
+        fetch_threaded(keys)
+    else:
+        for batch_no, i in enumerate(range(0, len(keys), batch_size), start=1):
+            chunk = keys[i:i + batch_size]
+            start = time.perf_counter()
+            try:
+                response = spreadsheet.values_batch_get([ranges[key] for key in chunk])
+            except Exception:
+                fetch_threaded(chunk)
+                continue
+            seconds = time.perf_counter() - start
+            for key, value_range in zip(chunk, response.get('valueRanges', [])):
+                store(key, value_range.get('values', []), seconds, f'batch #{batch_no}')
+
+    if report_timing:
+        order = {key: i for i, key in enumerate(keys)}
+        timings.sort(key=lambda t: order[t['Sheet']])
+    return values_by_key, errors, timings
+
+def degraded_sheets(errors):
+    """{sheet: alasan} untuk sheet yang tetap gagal setelah retry; datanya tidak ikut dalam analisis."""
+    return {name: f"{'Kuota habis (429)' if _error_status(e) == 429 else type(e).__name__}: {e}" for name, e in errors.items()}
+
+def fetch_sheet_values(spreadsheet, sheet_names, available_titles=None, **fetch_kwargs):
+    """
+    Mengambil isi penuh beberapa sheet lewat `fetch_ranges`. Sheet yang tidak ada di
+    spreadsheet dilewati tanpa error (sama seperti WorksheetNotFound).
+    Return: (values_by_sheet, errors, timings) dengan nama sheet sebagai kunci.
+    """
+    if available_titles is None:
+        available_titles = [ws.title for ws in spreadsheet.worksheets()]
+    available = set(available_titles)
+    ranges = {name: _sheet_range(name) for name in sheet_names if name in available}
+    return fetch_ranges(spreadsheet, ranges, **fetch_kwargs)
+
+def build_rekap_df(values_by_sheet, source_column=None):
+    """
+    Gabungkan nilai mentah semua sheet REKAP menjadi satu DataFrame dengan kolom Toko & Status.
+    Jika `source_column` diisi, nama sheet asal setiap baris disimpan di kolom tersebut.
+    """
+    rekap_list = []
+    for sheet_name, values in values_by_sheet.items():
+        if "REKAP" not in sheet_name.upper() or not values or len(values) < 2: continue
+        header, data = values[0], values[1:]
+        df_sheet = pd.DataFrame(data, columns=header)
+        if '' in df_sheet.columns: df_sheet = df_sheet.drop(columns=[''])
+        store_name_match = re.match(r"^(.*?) - REKAP", sheet_name, re.IGNORECASE)
+        df_sheet['Toko'] = store_name_match.group(1).strip() if store_name_match else "Toko Tak Dikenal"
+        if 'Status' not in df_sheet.columns:
+            df_sheet['Status'] = 'Tersedia' if "READY" in sheet_name.upper() else 'Habis'
+        if source_column: df_sheet[source_column] = sheet_name
+        rekap_list.append(df_sheet)
+    if not rekap_list: return pd.DataFrame()
+    rekap_df = pd.concat(rekap_list, ignore_index=True)
+    rekap_df.columns = [c if c == source_column else str(c).strip().upper() for c in rekap_df.columns]
+    return rekap_df.rename(columns=REKAP_RENAME)
+
+@diagnostic_stage("normalisasi_rekap")
+def normalize_rekap_df(rekap_df):
+    """Konversi tipe (Tanggal, Harga, Terjual), buang baris tidak valid, lengkapi Brand & Omzet."""
+    if 'Nama Produk' in rekap_df.columns:
+        rekap_df['Nama Produk'] = rekap_df['Nama Produk'].astype(str).str.strip()
+    if 'Tanggal' in rekap_df.columns:
+        rekap_df['Tanggal'] = pd.to_datetime(rekap_df['Tanggal'], errors='coerce', dayfirst=True)
+    if 'Harga' in rekap_df.columns:
+        rekap_df['Harga'] = pd.to_numeric(rekap_df['Harga'].astype(str).str.replace(r'[^\d]', '', regex=True), errors='coerce')
+    if 'Terjual per Bulan' in rekap_df.columns:
+        rekap_df['Terjual per Bulan'] = pd.to_numeric(rekap_df['Terjual per Bulan'], errors='coerce').fillna(0)
+    
+    rekap_df.dropna(subset=['Tanggal', 'Nama Produk', 'Harga', 'Toko'], inplace=True)
+    if 'Brand' not in rekap_df.columns or rekap_df['Brand'].isnull().all():
+        rekap_df['Brand'] = rekap_df['Nama Produk'].str.split(n=1).str[0].str.upper()
+    rekap_df['Omzet'] = (rekap_df['Harga'].fillna(0) * rekap_df.get('Terjual per Bulan', 0).fillna(0)).astype(int)
+    add_week_start(rekap_df)
+    return rekap_df
+
+# Kolom teks yang nilainya berulang di setiap tanggal -> categorical
+REKAP_CATEGORY_COLUMNS = ['Toko', 'Brand', 'Status', 'KATEGORI', 'Nama Produk']
+REKAP_DOWNCAST_COLUMNS = ['Harga', 'Terjual per Bulan']  # Omzet tetap int64 (hasil kali, rawan overflow)
+
+def add_week_start(rekap_df):
+    # Awal minggu W-SUN (Senin 00:00) dengan aritmetika tanggal, bukan to_period().apply per baris
+    tanggal = rekap_df['Tanggal'].dt.normalize()
+    rekap_df['Minggu'] = tanggal - pd.to_timedelta(tanggal.dt.dayofweek, unit='D')
+    return rekap_df
+
+def _memory_by_column(df):
+    usage = df.memory_usage(deep=True, index=False)
+    return {col: (str(df[col].dtype), int(usage[col])) for col in df.columns}
+
+@diagnostic_stage("pemadatan_rekap")
+def compact_rekap_df(rekap_df):
+    """
+    Tahap akhir normalisasi: kolom Minggu, teks berulang -> categorical, angka di-downcast.
+    Idempoten (aman untuk frame dari snapshot). Laporan memori sebelum/sesudah disimpan di
+    attrs['memory_report'] jika ada kolom yang berubah.
+    """
+    before = _memory_by_column(rekap_df)
+    if 'Minggu' not in rekap_df.columns: add_week_start(rekap_df)
+    for col in REKAP_CATEGORY_COLUMNS:
+        if col in rekap_df.columns and not isinstance(rekap_df[col].dtype, pd.CategoricalDtype):
+            rekap_df[col] = rekap_df[col].astype('category')
+    for col in REKAP_DOWNCAST_COLUMNS:
+        if col in rekap_df.columns and rekap_df[col].dtype.itemsize > 4:
+            # Minimal 32-bit (bukan int8/int16) agar aritmetika lanjutan tidak mudah overflow. Tidak pernah
+            # float32 (hanya presisi ~16,7 juta): nilai besar tetap int64, pecahan / kosong tetap float64.
+            values = rekap_df[col]
+            integral = values.notna().all() and (values % 1 == 0).all()
+            fits_int32 = integral and values.abs().max() < 2**31
+            rekap_df[col] = values.astype('int32' if fits_int32 else 'int64' if integral else 'float64')
+    after = _memory_by_column(rekap_df)
+    changed = [col for col in after if before.get(col) != after[col]]
+    if changed:
+        rekap_df.attrs['memory_report'] = {
+            'Sebelum (MB)': round(sum(size for _, size in before.values()) / 1e6, 2),
+            'Sesudah (MB)': round(sum(size for _, size in after.values()) / 1e6, 2),
+            'Kolom': [{'Kolom': col, 'Tipe Awal': before[col][0] if col in before else '-', 'Tipe Baru': after[col][0],
+                       'Awal (MB)': round(before[col][1] / 1e6, 2) if col in before else 0.0, 'Baru (MB)': round(after[col][1] / 1e6, 2)}
+                      for col in changed],
+        }
+    return rekap_df
+
+def parse_database_df(values):
+    if not values or len(values) < 2: return pd.DataFrame()
+    database_df = pd.DataFrame(values[1:], columns=values[0])
+    if '' in database_df.columns: database_df = database_df.drop(columns=[''])
+    return database_df
+
+def parse_matches_df(values):
+    """Setara get_all_records() pada HASIL_MATCHING. Return (matches_df, kolom_wajib_yang_hilang)."""
+    if not values or len(values) < 2: return pd.DataFrame(), []
+    matches_df = pd.DataFrame([numericise_all(row) for row in values[1:]], columns=values[0])
+    matches_df.columns = [str(c).strip() for c in matches_df.columns]
+    expected_cols = ['Produk Toko Saya', 'Produk Kompetitor', 'Harga Kompetitor']
+    missing_cols = [col for col in expected_cols if col not in matches_df.columns]
+    if missing_cols: return pd.DataFrame(), missing_cols
+    return matches_df, []
+
+# ================================
+# WATERMARK & SINKRONISASI INKREMENTAL REKAP
+# ================================
+SOURCE_SHEET_COL = '_Sheet'
+
+def _trim_row(row):
+    row = list(row)
+    while row and row[-1] == '': row.pop()
+    return row
+
+def sheet_watermark(values, max_tanggal, previous=None):
+    """
+    Watermark satu sheet REKAP: header, jumlah baris data, baris data terakhir (untuk memastikan
+    sheet memang hanya ditambah di bawah) dan Tanggal terbesar yang sudah dimuat.
+    `values` = [header] + baris baru; `previous` = watermark lama jika ini hasil delta.
+    """
+    header = _trim_row(values[0]) if values else []
+    new_rows = values[1:] if values else []
+    rows = (previous['rows'] if previous else 0) + len(new_rows)
+    last_row = fill_gaps([new_rows[-1]], cols=len(header))[0][:len(header)] if new_rows else (previous or {}).get('last_row', [])
+    dates = [d for d in (max_tanggal, (previous or {}).get('max_tanggal')) if d]
+    return {'header': header, 'rows': rows, 'last_row': last_row, 'max_tanggal': max(dates) if dates else None}
+
+def compute_sheet_watermarks(values_by_sheet, rekap_df, previous=None):
+    """Watermark untuk setiap sheet REKAP di `values_by_sheet`. `rekap_df` harus punya SOURCE_SHEET_COL."""
+    previous = previous or {}
+    max_dates = rekap_df.groupby(SOURCE_SHEET_COL)['Tanggal'].max() if not rekap_df.empty else pd.Series(dtype='datetime64[ns]')
+    watermarks = {}
+    for sheet_name, values in values_by_sheet.items():
+        if "REKAP" not in sheet_name.upper(): continue
+        max_tanggal = max_dates.get(sheet_name)
+        max_tanggal = max_tanggal.isoformat() if pd.notna(max_tanggal) else None
+        watermarks[sheet_name] = sheet_watermark(values, max_tanggal, previous.get(sheet_name))
+    return watermarks
+
+def fetch_rekap_delta(spreadsheet, watermarks, extra_sheets=()):
+    """
+    Ambil hanya baris REKAP setelah watermark, ditambah isi penuh `extra_sheets` (DATABASE,
+    HASIL_MATCHING), semuanya dalam batch yang sama.
+
+    Per sheet ber-watermark diambil dua range: header (baris 1) dan baris mulai dari baris data
+    terakhir yang sudah dimuat. Baris terakhir itu harus sama persis dengan watermark; jika header
+    berubah, sheet memendek, atau baris lama diedit, return None (wajib muat penuh).
+    Return: (values_by_sheet, full_sheets, errors) di mana values_by_sheet[rekap] = [header] + baris baru.
+    """
+    titles = [ws.title for ws in spreadsheet.worksheets()]
+    available = set(titles)
+    rekap_titles = [name for name in REKAP_SHEET_NAMES if "REKAP" in name.upper() and name in available]
+    if any(name not in available for name in watermarks):
+        return None  # sheet lama dihapus/diganti nama: baris lamanya harus dibuang lewat muat penuh
+
+    ranges, full_sheets = {}, []
+    for name in rekap_titles:
+        wm = watermarks.get(name)
+        if not wm or not wm['rows'] or not wm['header']:
+            ranges[(name, 'full')] = _sheet_range(name)
+            full_sheets.append(name)
+            continue
+        last_col = re.sub(r'\d', '', rowcol_to_a1(1, len(wm['header'])))
+        ranges[(name, 'header')] = f"{_sheet_range(name)}!1:1"
+        ranges[(name, 'delta')] = f"{_sheet_range(name)}!A{wm['rows'] + 1}:{last_col}"
+    for name in extra_sheets:
+        if name in available: ranges[(name, 'full')] = _sheet_range(name)
+
+    fetched, errors, _ = fetch_ranges(spreadsheet, ranges)
+    if any(key[1] != 'full' for key in errors):
+        return None
+
+    values_by_sheet = {}
+    for (name, part), values in fetched.items():
+        if part == 'full':
+            values_by_sheet[name] = values
+        elif part == 'delta':
+            wm = watermarks[name]
+            header = _trim_row(fetched.get((name, 'header'), [[]])[0]) if fetched.get((name, 'header')) else []
+            if header != wm['header']: return None
+            rows = fill_gaps(values, cols=len(header)) if values else []
+            if not rows or rows[0][:len(header)] != wm['last_row']: return None
+            values_by_sheet[name] = [header] + [row[:len(header)] for row in rows[1:]]
+    return values_by_sheet, full_sheets, {key[0]: e for key, e in errors.items()}
+
+@diagnostic_stage("sinkronisasi_inkremental")
+def sync_rekap_incremental(spreadsheet, cached_rekap_df, watermarks):
+    """
+    Tambahkan baris REKAP baru ke `cached_rekap_df` (sudah ternormalisasi) tanpa mengunduh ulang
+    riwayat. Hanya baris baru yang melewati normalize_rekap_df.
+    Return None jika harus muat penuh, selain itu dict berisi rekap_df, database_df, matches_df,
+    missing_cols, watermarks, errors dan stats {sheet: jumlah baris baru}.
+    """
+    delta = fetch_rekap_delta(spreadsheet, watermarks, extra_sheets=("DATABASE", MATCHING_SHEET_NAME))
+    if delta is None: return None
+    values_by_sheet, full_sheets, errors = delta
+
+    rekap_values = {name: values for name, values in values_by_sheet.items() if "REKAP" in name.upper()}
+    new_rows_df = build_rekap_df(rekap_values, source_column=SOURCE_SHEET_COL)
+    if not new_rows_df.empty:
+        new_rows_df = normalize_rekap_df(new_rows_df)
+    new_watermarks = dict(watermarks)
+    new_watermarks.update(compute_sheet_watermarks(
+        rekap_values, new_rows_df, previous={n: w for n, w in watermarks.items() if n not in full_sheets}
+    ))
+
+    rekap_df = cached_rekap_df
+    if not new_rows_df.empty:
+        new_rows_df = new_rows_df.drop(columns=[SOURCE_SHEET_COL])
+        needs_sort = not cached_rekap_df.empty and new_rows_df['Tanggal'].min() < cached_rekap_df['Tanggal'].max()
+        rekap_df = pd.concat([cached_rekap_df, new_rows_df], ignore_index=True)
+        if needs_sort: rekap_df = rekap_df.sort_values('Tanggal', kind='stable')
+        # concat categorical + teks biasa menghasilkan object: padatkan ulang
+        rekap_df = compact_rekap_df(rekap_df)
+    matches_df, missing_cols = parse_matches_df(values_by_sheet.get(MATCHING_SHEET_NAME))
+    return {
+        'rekap_df': rekap_df, 'database_df': parse_database_df(values_by_sheet.get("DATABASE")),
+        'matches_df': matches_df, 'missing_cols': missing_cols, 'watermarks': new_watermarks, 'errors': errors,
+        'stats': {name: max(len(values) - 1, 0) for name, values in rekap_values.items()},
+    }
+
+# ================================
+# FUNGSI MEMUAT SEMUA DATA
+# ================================
+@diagnostic_stage("load_all_data")
+def load_all_data(gc, spreadsheet_key, report_timing=False, notify=log_notify):
+    try:
+        spreadsheet = gc.open_by_key(spreadsheet_key)
+        # Satu kali ambil daftar sheet, lalu semua isi sheet (termasuk HASIL_MATCHING) diambil per batch
+        values_by_sheet, errors, timings = fetch_sheet_values(
+            spreadsheet, REKAP_SHEET_NAMES + [MATCHING_SHEET_NAME], report_timing=report_timing
+        )
+    except Exception as e:
+        notify('error', f"GAGAL KONEKSI/OPEN SPREADSHEET: {e}")
+        return None, None, None
+
+    for sheet_name, e in errors.items():
+        if sheet_name == MATCHING_SHEET_NAME: notify('warning', f"Gagal memuat 'HASIL_MATCHING': {e}")
+        else: notify('warning', f"Gagal baca sheet '{sheet_name}': {e}")
+
+    database_df = parse_database_df(values_by_sheet.get("DATABASE"))
+
+    rekap_df = build_rekap_df(values_by_sheet, source_column=SOURCE_SHEET_COL)
+    if rekap_df.empty:
+        notify('error', "Tidak ada data REKAP yang berhasil dimuat."); return None, None, None
+    rekap_df = normalize_rekap_df(rekap_df)
+    watermarks = compute_sheet_watermarks(values_by_sheet, rekap_df)
+    rekap_df = rekap_df.drop(columns=[SOURCE_SHEET_COL])
+
+    matches_df, missing_cols = parse_matches_df(values_by_sheet.get(MATCHING_SHEET_NAME))
+    if missing_cols:
+        notify('error', f"Header di sheet 'HASIL_MATCHING' salah! Kolom berikut tidak ditemukan: {', '.join(missing_cols)}")
+
+    rekap_df = compact_rekap_df(rekap_df.sort_values('Tanggal'))
+    rekap_df.attrs['sheet_watermarks'] = watermarks
+    rekap_df.attrs['degraded_sheets'] = degraded_sheets(errors)
+    if report_timing:
+        rekap_df.attrs['sheet_timings'] = timings
+    return rekap_df, database_df, matches_df
+
+# ================================
+# SNAPSHOT LOKAL (PARQUET)
+# ================================
+SNAPSHOT_FILES = {'rekap': 'rekap.parquet', 'database': 'database.parquet', 'matches': 'matches.parquet'}
+
+def _snapshot_dir(base_dir, spreadsheet_key):
+    # Satu folder per spreadsheet, nama di-hash agar kunci spreadsheet tidak tertulis di disk
+    return os.path.join(base_dir, hashlib.sha1(spreadsheet_key.encode('utf-8')).hexdigest()[:12])
+
+def _parquet_safe(df):
+    # Kolom object campuran angka/teks (hasil numericise HASIL_MATCHING) tidak bisa ditulis ke Parquet
+    df = df.copy()
+    df.attrs = {}
+    for col in df.columns[df.dtypes == object]:
+        types = set(map(type, df[col].dropna()))
+        if len(types) <= 1: continue
+        non_blank = df[col][df[col] != '']
+        if types <= {int, float, str} and pd.to_numeric(non_blank, errors='coerce').notna().all():
+            df[col] = pd.to_numeric(df[col].replace('', np.nan), errors='coerce')
+        else:
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+def _frame_hash(frame):
+    digest = hashlib.sha1(','.join(map(str, frame.columns)).encode('utf-8'))
+    if not frame.empty:
+        digest.update(pd.util.hash_pandas_object(frame, index=False).values.tobytes())
+    return digest.hexdigest()
+
+def compute_data_version(*frames):
+    """Versi data = hash isi semua frame; sama persis jika dan hanya jika datanya sama."""
+    return _version_from_hashes([_frame_hash(frame) for frame in frames])
+
+def _version_from_hashes(hashes):
+    return hashlib.sha1('|'.join(hashes).encode('utf-8')).hexdigest()[:16]
+
+def _write_snapshot_meta(target, meta):
+    # meta.json ditulis terakhir: snapshot baru dianggap sah setelah semua file lengkap
+    tmp_meta = os.path.join(target, 'meta.json.tmp')
+    with open(tmp_meta, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_meta, os.path.join(target, 'meta.json'))
+
+def _write_snapshot_frame(target, name, frame):
+    tmp_path = os.path.join(target, SNAPSHOT_FILES[name] + '.tmp')
+    frame.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, os.path.join(target, SNAPSHOT_FILES[name]))
+
+@diagnostic_stage("simpan_snapshot")
+def save_snapshot(base_dir, spreadsheet_key, rekap_df, database_df, matches_df, watermarks=None):
+    """
+    Simpan tiga DataFrame hasil normalisasi ke Parquet beserta meta.json (versi data, hash per
+    frame, watermark per sheet REKAP). Return versi data.
+    """
+    target = _snapshot_dir(base_dir, spreadsheet_key)
+    os.makedirs(target, exist_ok=True)
+    frames = {'rekap': _parquet_safe(rekap_df), 'database': _parquet_safe(database_df), 'matches': _parquet_safe(matches_df)}
+    for name, frame in frames.items():
+        _write_snapshot_frame(target, name, frame)
+    hashes = {name: _frame_hash(frame) for name, frame in frames.items()}
+    previous_meta = read_snapshot_meta(base_dir, spreadsheet_key) or {}
+    meta = {
+        'data_version': _version_from_hashes([hashes[name] for name in SNAPSHOT_FILES]),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'rows': {name: len(frame) for name, frame in frames.items()},
+        'frame_hashes': hashes,
+        'watermarks': watermarks or {},
+        # Tanggal_Update di sheet = tanggal baris terakhir berubah, jadi waktu pembaruan terakhir dicatat di sini
+        'matches_updated_at': previous_meta.get('matches_updated_at'),
+    }
+    _write_snapshot_meta(target, meta)
+    return meta['data_version']
+
+def replace_snapshot_matches(base_dir, spreadsheet_key, matches_df):
+    """Ganti hanya HASIL_MATCHING di snapshot (rekap & watermark tetap). Return versi baru atau None."""
+    meta = read_snapshot_meta(base_dir, spreadsheet_key)
+    if meta is None or 'frame_hashes' not in meta: return None
+    target = _snapshot_dir(base_dir, spreadsheet_key)
+    frame = _parquet_safe(matches_df)
+    _write_snapshot_frame(target, 'matches', frame)
+    meta.pop('age_minutes', None)
+    meta['frame_hashes']['matches'] = _frame_hash(frame)
+    meta['rows']['matches'] = len(frame)
+    meta['matches_updated_at'] = datetime.now().isoformat(timespec='seconds')
+    meta['data_version'] = _version_from_hashes([meta['frame_hashes'][name] for name in SNAPSHOT_FILES])
+    _write_snapshot_meta(target, meta)
+    return meta['data_version']
+
+def read_snapshot_meta(base_dir, spreadsheet_key):
+    meta_path = os.path.join(_snapshot_dir(base_dir, spreadsheet_key), 'meta.json')
+    if not os.path.exists(meta_path): return None
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        meta['age_minutes'] = (datetime.now() - datetime.fromisoformat(meta['created_at'])).total_seconds() / 60
+        return meta
+    except (OSError, ValueError, KeyError):
+        return None
+
+@diagnostic_stage("baca_snapshot")
+def load_snapshot(base_dir, spreadsheet_key, max_age_minutes=None):
+    """
+    Baca snapshot lokal. Return (rekap_df, database_df, matches_df, meta) atau None jika
+    snapshot tidak ada, rusak, atau lebih tua dari `max_age_minutes`.
+    """
+    meta = read_snapshot_meta(base_dir, spreadsheet_key)
+    if meta is None: return None
+    if max_age_minutes is not None and meta['age_minutes'] > max_age_minutes: return None
+    target = _snapshot_dir(base_dir, spreadsheet_key)
+    try:
+        frames = [pd.read_parquet(os.path.join(target, SNAPSHOT_FILES[name])) for name in ('rekap', 'database', 'matches')]
+    except Exception:
+        return None
+    frames[0] = compact_rekap_df(frames[0])  # snapshot lama (sebelum kolom Minggu / categorical)
+    return (*frames, meta)
+
+# ================================
+# RIWAYAT HARGA LOKAL (SQLITE, APPEND-ONLY)
+# ================================
+# Setiap sinkronisasi menambahkan baris REKAP ke history.sqlite di folder snapshot. Hari yang sudah
+# tersimpan tidak pernah diubah, jadi riwayat tetap utuh walau baris lama dihapus dari sheet.
+# Hanya hari terakhir per (Toko, Status) yang boleh diganti, karena sheet masih bisa menambah baris hari itu.
+HISTORY_FILE = 'history.sqlite'
+HISTORY_COLUMNS = {
+    'Tanggal': 'tanggal', 'Toko': 'toko', 'Status': 'status', 'Nama Produk': 'nama_produk', 'Harga': 'harga',
+    'Terjual per Bulan': 'terjual', 'Brand': 'brand', 'KATEGORI': 'kategori', 'SKU': 'sku', 'Stok': 'stok',
+}
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rekap_history (
+    tanggal INTEGER NOT NULL,   -- detik epoch (tanpa zona waktu, sama seperti kolom Tanggal)
+    toko TEXT NOT NULL, status TEXT NOT NULL, nama_produk TEXT NOT NULL,
+    harga INTEGER, terjual REAL, brand TEXT, kategori TEXT, sku TEXT, stok TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_history_tanggal ON rekap_history (tanggal, toko, nama_produk);
+CREATE INDEX IF NOT EXISTS idx_history_toko ON rekap_history (toko, status, tanggal);
+"""
+
+def history_path(base_dir, spreadsheet_key):
+    return os.path.join(_snapshot_dir(base_dir, spreadsheet_key), HISTORY_FILE)
+
+def _connect_history(path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    con = sqlite3.connect(path)
+    con.executescript(HISTORY_SCHEMA)
+    return con
+
+def _history_frame(rekap_df):
+    # Kolom REKAP -> kolom tabel; categorical -> teks, Tanggal -> detik epoch
+    present = [col for col in HISTORY_COLUMNS if col in rekap_df.columns]
+    frame = rekap_df[present].rename(columns=HISTORY_COLUMNS)
+    for col in frame.columns:
+        if isinstance(frame[col].dtype, pd.CategoricalDtype): frame[col] = frame[col].astype(object)
+    frame['tanggal'] = rekap_df['Tanggal'].to_numpy('datetime64[s]').astype(np.int64)
+    return frame
+
+def _epoch_seconds(value):
+    return int(pd.Timestamp(value).to_datetime64().astype('datetime64[s]').astype(np.int64))
+
+@diagnostic_stage("tambah_riwayat")
+def append_history(path, rekap_df):
+    """
+    Tambahkan baris REKAP baru ke riwayat. Per (Toko, Status) hanya baris pada/sesudah hari terakhir
+    yang tersimpan yang ditulis; hari terakhir itu selalu dihapus lalu ditulis ulang utuh (harga / status
+    bisa berubah tanpa jumlah baris berubah), hari sebelumnya tidak disentuh. Aman dipanggil berulang
+    dengan frame yang sama. Return dict statistik.
+    """
+    frame = _history_frame(rekap_df)
+    with closing(_connect_history(path)) as con, con:
+        stored = pd.read_sql("SELECT toko, status, MAX(tanggal) AS terakhir FROM rekap_history GROUP BY toko, status",
+                             con, dtype={'terakhir': 'float64'})
+        frame = frame.merge(stored, on=['toko', 'status'], how='left')
+        frame = frame[frame['tanggal'] >= frame['terakhir'].fillna(-np.inf)]
+        boundary = frame.loc[frame['terakhir'].notna(), ['toko', 'status', 'terakhir']].drop_duplicates()
+        replaced = 0
+        for toko, status, last_day in boundary.itertuples(index=False):
+            replaced += con.execute("DELETE FROM rekap_history WHERE toko = ? AND status = ? AND tanggal >= ?",
+                                    (toko, status, int(last_day))).rowcount
+        rows = frame.drop(columns=['terakhir'])
+        rows.to_sql('rekap_history', con, if_exists='append', index=False, chunksize=5000)
+        total = con.execute("SELECT COUNT(*) FROM rekap_history").fetchone()[0]
+    return {'Baris ditulis': len(rows), 'Baris hari terakhir diganti': replaced, 'Total baris riwayat': total}
+
+def history_bounds(path):
+    """(tanggal_awal, tanggal_akhir, daftar toko, jumlah baris) riwayat, atau None jika belum ada."""
+    if not os.path.exists(path): return None
+    with closing(_connect_history(path)) as con:
+        first, last, rows = con.execute("SELECT MIN(tanggal), MAX(tanggal), COUNT(*) FROM rekap_history").fetchone()
+        stores = [row[0] for row in con.execute("SELECT DISTINCT toko FROM rekap_history ORDER BY toko")]
+    if not rows: return None
+    return pd.to_datetime(first, unit='s'), pd.to_datetime(last, unit='s'), stores, rows
+
+@diagnostic_stage("baca_riwayat")
+def query_history(path, start_date=None, end_date=None, stores=None):
+    """
+    Ambil hanya jendela yang diminta dari riwayat: filter tanggal (inklusif, sama seperti derive_frames)
+    dan toko dijalankan di SQLite lewat indeks. Return frame REKAP ternormalisasi & padat (Omzet, Minggu).
+    """
+    clauses, params = [], []
+    if start_date is not None: clauses.append("tanggal >= ?"); params.append(_epoch_seconds(start_date))
+    if end_date is not None: clauses.append("tanggal <= ?"); params.append(_epoch_seconds(end_date))
+    if stores: clauses.append(f"toko IN ({', '.join('?' * len(stores))})"); params.extend(stores)
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+    with closing(_connect_history(path)) as con:
+        frame = pd.read_sql(f"SELECT * FROM rekap_history{where} ORDER BY tanggal, rowid", con, params=params)
+    # Kolom selalu lengkap sesuai skema tabel, walau isinya kosong semua di jendela ini (mis. SKU toko tanpa SKU)
+    rekap_df = frame.rename(columns={v: k for k, v in HISTORY_COLUMNS.items()}).reindex(columns=list(HISTORY_COLUMNS))
+    rekap_df['Tanggal'] = pd.to_datetime(rekap_df['Tanggal'], unit='s')
+    for col in ('Harga', 'Terjual per Bulan'): rekap_df[col] = pd.to_numeric(rekap_df[col], errors='coerce')
+    rekap_df['Terjual per Bulan'] = rekap_df['Terjual per Bulan'].fillna(0)
+    if not rekap_df.empty and rekap_df['Brand'].isnull().all():
+        rekap_df['Brand'] = rekap_df['Nama Produk'].str.split(n=1).str[0].str.upper()
+    rekap_df['Omzet'] = (rekap_df['Harga'].fillna(0) * rekap_df['Terjual per Bulan']).astype(int)
+    return compact_rekap_df(add_week_start(rekap_df))
+
+def _record_history(snapshot_dir, spreadsheet_key, rekap_df, notify=log_notify):
+    path = history_path(snapshot_dir, spreadsheet_key)
+    try:
+        rekap_df.attrs['history_stats'] = append_history(path, rekap_df)
+        rekap_df.attrs['change_stats'] = detect_changes(path, rekap_df)
+    except Exception as e:
+        notify('warning', f"Riwayat harga lokal tidak dapat diperbarui: {e}")
+
+def ensure_history(snapshot_dir, spreadsheet_key, rekap_df, notify=log_notify):
+    # Snapshot yang dibuat sebelum ada riwayat: isi riwayat sekali dari snapshot itu
+    if not os.path.exists(history_path(snapshot_dir, spreadsheet_key)):
+        _record_history(snapshot_dir, spreadsheet_key, rekap_df, notify)
+
+# ================================
+# DETEKSI PERUBAHAN HARGA & STOK (EVENT LOG INKREMENTAL)
+# ================================
+# Disimpan di history.sqlite yang sama. product_state = kondisi terakhir tiap (Toko, Nama Produk) per
+# hari yang sudah "tutup" (state_day); setiap sinkronisasi hanya membaca baris REKAP sesudah state_day,
+# membandingkannya dengan product_state lewat diff berkunci yang vektor, dan menulis ulang event sejak
+# state_day. Hari terakhir dianggap sementara (sheet masih bisa menambah baris hari itu): event-nya
+# dihitung ulang di sinkronisasi berikutnya dan baru dimasukkan ke product_state setelah ada hari baru.
+CHANGE_EVENT_TYPES = ('Harga Turun', 'Harga Naik', 'Restock', 'Stok Habis', 'Listing Baru')
+CHANGE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS product_state (
+    toko TEXT NOT NULL, nama_produk TEXT NOT NULL, tanggal INTEGER NOT NULL, harga REAL, status TEXT,
+    PRIMARY KEY (toko, nama_produk)
+);
+CREATE TABLE IF NOT EXISTS change_meta (kunci TEXT PRIMARY KEY, nilai INTEGER);
+CREATE TABLE IF NOT EXISTS change_events (
+    tanggal INTEGER NOT NULL, toko TEXT NOT NULL, nama_produk TEXT NOT NULL, jenis TEXT NOT NULL,
+    harga_lama REAL, harga_baru REAL, status_lama TEXT, status_baru TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_events_tanggal ON change_events (tanggal, toko);
+"""
+CHANGE_KEY = ['toko', 'nama_produk']
+
+def _latest_per_day(frame):
+    # Satu baris per (toko, nama, hari); jika produk ada di sheet READY & HABIS di hari yang sama, Tersedia menang
+    frame = frame.assign(_ready=frame['status'] == 'Tersedia')
+    frame = frame.sort_values(CHANGE_KEY + ['tanggal', '_ready'], kind='stable')
+    return frame.drop_duplicates(CHANGE_KEY + ['tanggal'], keep='last').drop(columns=['_ready'])
+
+@diagnostic_stage("deteksi_perubahan")
+def detect_changes(path, rekap_df):
+    """
+    Tambahkan event perubahan (CHANGE_EVENT_TYPES) untuk baris REKAP sesudah hari yang sudah diproses.
+    Biaya sebanding dengan jumlah baris baru + jumlah produk, bukan seluruh riwayat. Hari pertama yang
+    pernah diproses hanya mengisi kondisi awal (tanpa event Listing Baru). Aman dipanggil berulang.
+    """
+    with closing(_connect_history(path)) as con, con:
+        con.executescript(CHANGE_SCHEMA)
+        row = con.execute("SELECT nilai FROM change_meta WHERE kunci = 'state_day'").fetchone()
+        state_day = row[0] if row else None
+        if state_day is not None: rekap_df = rekap_df[rekap_df['Tanggal'] > pd.Timestamp(state_day, unit='s')]
+        frame = _history_frame(rekap_df)[['tanggal', 'toko', 'nama_produk', 'harga', 'status']].dropna(subset=CHANGE_KEY)
+        new = _latest_per_day(frame)
+        if new.empty:
+            return {'Baris diproses': 0, 'Event baru': 0, 'Total event': con.execute("SELECT COUNT(*) FROM change_events").fetchone()[0]}
+        state = pd.read_sql("SELECT toko, nama_produk, tanggal, harga, status FROM product_state", con,
+                            dtype={'tanggal': 'int64', 'harga': 'float64'})
+        combined = pd.concat([state.assign(_new=False), new.assign(_new=True)], ignore_index=True)
+        combined = combined.sort_values(CHANGE_KEY + ['tanggal'], kind='stable').reset_index(drop=True)
+        groups = combined.groupby(CHANGE_KEY, sort=False)
+        combined['harga_lama'], combined['status_lama'] = groups['harga'].shift(), groups['status'].shift()
+        seen_before = groups.cumcount() > 0
+        seed_day = new['tanggal'].min() if state.empty else None
+
+        rows = combined[combined['_new']]
+        seen_before = seen_before[combined['_new']]
+        kinds = {
+            'Harga Turun': seen_before & (rows['harga'] < rows['harga_lama']),
+            'Harga Naik': seen_before & (rows['harga'] > rows['harga_lama']),
+            'Restock': seen_before & (rows['status_lama'] == 'Habis') & (rows['status'] == 'Tersedia'),
+            'Stok Habis': seen_before & (rows['status_lama'] == 'Tersedia') & (rows['status'] == 'Habis'),
+            'Listing Baru': ~seen_before & (rows['tanggal'] != seed_day),
+        }
+        events = pd.concat([rows[mask].assign(jenis=kind) for kind, mask in kinds.items()], ignore_index=True)
+        events = events.rename(columns={'harga': 'harga_baru', 'status': 'status_baru'})[
+            ['tanggal', 'toko', 'nama_produk', 'jenis', 'harga_lama', 'harga_baru', 'status_lama', 'status_baru']]
+        # Event sejak state_day ditulis ulang (hari sementara dari sinkronisasi sebelumnya ikut diganti)
+        con.execute("DELETE FROM change_events WHERE tanggal > ?", (state_day if state_day is not None else -1,))
+        events.to_sql('change_events', con, if_exists='append', index=False, chunksize=5000)
+
+        # Hari yang sudah tutup (< hari terakhir) masuk ke product_state
+        last_day = int(new['tanggal'].max())
+        closed = combined[combined['_new'] & (combined['tanggal'] < last_day)]
+        if not closed.empty:
+            closed = closed.drop_duplicates(CHANGE_KEY, keep='last')[['toko', 'nama_produk', 'tanggal', 'harga', 'status']]
+            con.executemany("INSERT OR REPLACE INTO product_state VALUES (?, ?, ?, ?, ?)",
+                            closed.astype(object).where(closed.notna(), None).itertuples(index=False, name=None))
+            con.execute("INSERT OR REPLACE INTO change_meta VALUES ('state_day', ?)", (int(closed['tanggal'].max()),))
+        total = con.execute("SELECT COUNT(*) FROM change_events").fetchone()[0]
+    return {'Baris diproses': len(new), 'Event baru': len(events), 'Total event': total}
+
+@diagnostic_stage("baca_event_perubahan")
+def change_feed(path, matches_df=None, start_date=None, end_date=None, stores=None, kinds=None, my_store_name=MY_STORE_NAME):
+    """
+    Event perubahan toko kompetitor dalam rentang (filter di SQLite), terbaru dulu, digabung dengan
+    HASIL_MATCHING (Produk Kompetitor + Toko Kompetitor) sehingga terlihat produk toko sendiri yang
+    terdampak; satu baris per (event x produk sendiri yang cocok), tanpa pasangan = kolom kosong.
+    """
+    if not os.path.exists(path): return pd.DataFrame()
+    clauses, params = ["toko != ?"], [my_store_name]
+    if start_date is not None: clauses.append("tanggal >= ?"); params.append(_epoch_seconds(start_date))
+    if end_date is not None: clauses.append("tanggal <= ?"); params.append(_epoch_seconds(end_date))
+    if stores: clauses.append(f"toko IN ({', '.join('?' * len(stores))})"); params.extend(stores)
+    if kinds: clauses.append(f"jenis IN ({', '.join('?' * len(kinds))})"); params.extend(kinds)
+    with closing(_connect_history(path)) as con:
+        con.executescript(CHANGE_SCHEMA)
+        events = pd.read_sql(f"SELECT * FROM change_events WHERE {' AND '.join(clauses)} ORDER BY tanggal DESC, rowid",
+                             con, params=params, dtype={'harga_lama': 'float64', 'harga_baru': 'float64'})
+    feed = pd.DataFrame({
+        'Tanggal': pd.to_datetime(events['tanggal'], unit='s'), 'Toko': events['toko'], 'Produk Kompetitor': events['nama_produk'],
+        'Perubahan': events['jenis'], 'Harga Lama': events['harga_lama'], 'Harga Baru': events['harga_baru'],
+        'Perubahan Harga (%)': ((events['harga_baru'] / events['harga_lama'] - 1) * 100).round(1),
+        'Status Lama': events['status_lama'], 'Status Baru': events['status_baru'],
+    })
+    feed['Perubahan'] = pd.Categorical(feed['Perubahan'], categories=CHANGE_EVENT_TYPES)
+    if matches_df is None or matches_df.empty or not {'Produk Kompetitor', 'Toko Kompetitor', 'Produk Toko Saya'} <= set(matches_df.columns):
+        return feed.assign(**{'Produk Toko Saya': None, 'Harga Toko Saya': np.nan, 'Skor Kemiripan': np.nan})
+    affected = matches_df[['Produk Kompetitor', 'Toko Kompetitor', 'Produk Toko Saya', 'Harga Toko Saya', 'Skor Kemiripan']].astype(
+        {'Produk Kompetitor': str, 'Toko Kompetitor': str}).drop_duplicates(['Produk Kompetitor', 'Toko Kompetitor', 'Produk Toko Saya'])
+    affected = affected.rename(columns={'Toko Kompetitor': 'Toko'})
+    return feed.merge(affected, on=['Produk Kompetitor', 'Toko'], how='left', sort=False)
+
+def _sync_from_snapshot(gc, spreadsheet_key, snapshot_dir, snapshot, notify=log_notify):
+    # Sinkronisasi delta di atas snapshot lama; None jika gagal / wajib muat penuh
+    rekap_df, _, _, meta = snapshot
+    if not meta.get('watermarks'): return None
+    try:
+        spreadsheet = gc.open_by_key(spreadsheet_key)
+        result = sync_rekap_incremental(spreadsheet, rekap_df, meta['watermarks'])
+    except Exception as e:
+        notify('warning', f"Sinkronisasi inkremental gagal, beralih ke muat penuh: {e}")
+        return None
+    if result is None: return None
+    for sheet_name, e in result['errors'].items():
+        notify('warning', f"Gagal baca sheet '{sheet_name}': {e}")
+    if result['missing_cols']:
+        notify('error', f"Header di sheet 'HASIL_MATCHING' salah! Kolom berikut tidak ditemukan: {', '.join(result['missing_cols'])}")
+    rekap_df, database_df, matches_df = result['rekap_df'], result['database_df'], result['matches_df']
+    rekap_df.attrs['sync_stats'] = result['stats']
+    rekap_df.attrs['degraded_sheets'] = degraded_sheets(result['errors'])
+    data_version = _persist_dataset(snapshot_dir, spreadsheet_key, rekap_df, database_df, matches_df, result['watermarks'], notify)
+    return rekap_df, database_df, matches_df, data_version
+
+def _persist_dataset(snapshot_dir, spreadsheet_key, rekap_df, database_df, matches_df, watermarks, notify=log_notify):
+    # Data dengan sheet gagal hanya dipakai di memori (attrs['degraded_sheets'] ikut): tidak disimpan sebagai
+    # snapshot bersama / riwayat, karena snapshot tidak membawa attrs dan sesi lain akan menganggapnya lengkap.
+    if rekap_df.attrs.get('degraded_sheets'):
+        notify('warning', f"{len(rekap_df.attrs['degraded_sheets'])} sheet gagal dimuat; snapshot & riwayat lokal tidak diperbarui.")
+        return compute_data_version(rekap_df, database_df, matches_df)
+    try:
+        data_version = save_snapshot(snapshot_dir, spreadsheet_key, rekap_df, database_df, matches_df, watermarks)
+    except Exception as e:
+        notify('warning', f"Snapshot lokal tidak dapat disimpan: {e}")
+        data_version = compute_data_version(rekap_df, database_df, matches_df)
+    _record_history(snapshot_dir, spreadsheet_key, rekap_df, notify)
+    return data_version
+
+@diagnostic_stage("load_dataset")
+def load_dataset(gc, spreadsheet_key, snapshot_dir, max_age_minutes, force_refresh=False, report_timing=False,
+                 incremental=True, notify=log_notify):
+    """
+    Sumber data utama aplikasi. Urutan:
+      1. snapshot lokal jika masih dalam TTL (kecuali force_refresh),
+      2. sinkronisasi inkremental: hanya baris REKAP setelah watermark yang diunduh & dinormalisasi,
+      3. muat penuh dari Google Sheets.
+    Langkah 2 & 3 memperbarui snapshot dan menambahkan baris baru ke riwayat lokal (history.sqlite),
+    kecuali ada sheet yang gagal dimuat (data itu hanya dikembalikan, lihat _persist_dataset).
+    Return (rekap_df, database_df, matches_df, data_version).
+    """
+    snapshot = load_snapshot(snapshot_dir, spreadsheet_key)
+    if snapshot is not None and not force_refresh and snapshot[3]['age_minutes'] <= max_age_minutes:
+        rekap_df, database_df, matches_df, meta = snapshot
+        ensure_history(snapshot_dir, spreadsheet_key, rekap_df, notify)
+        return rekap_df, database_df, matches_df, meta['data_version']
+    if snapshot is not None and incremental:
+        synced = _sync_from_snapshot(gc, spreadsheet_key, snapshot_dir, snapshot, notify)
+        if synced is not None: return synced
+
+    rekap_df, database_df, matches_df = load_all_data(gc, spreadsheet_key, report_timing=report_timing, notify=notify)
+    if rekap_df is None or rekap_df.empty or database_df is None:
+        return rekap_df, database_df, matches_df, None
+    data_version = _persist_dataset(snapshot_dir, spreadsheet_key, rekap_df, database_df, matches_df,
+                                    rekap_df.attrs.get('sheet_watermarks'), notify)
+    return rekap_df, database_df, matches_df, data_version
+
+# ================================
+# FUNGSI UNTUK PROSES UPDATE HARGA
+# ================================
+@diagnostic_stage("sumber_update")
+def load_source_data_for_update(gc, spreadsheet_key):
+    # Memakai lapisan pengambilan yang sama dengan load_all_data (batch, bukan loop per sheet).
+    # Sheet yang tetap gagal dicatat di attrs['degraded_sheets'] (juga pada frame kosong).
+    spreadsheet = gc.open_by_key(spreadsheet_key)
+    rekap_titles = [s.title for s in spreadsheet.worksheets() if "REKAP" in s.title.upper()]
+    values_by_sheet, errors, _ = fetch_sheet_values(spreadsheet, rekap_titles, available_titles=rekap_titles)
+
+    source_df = pd.DataFrame()
+    rekap_df = build_rekap_df(values_by_sheet)
+    required_cols = ['Tanggal', 'Nama Produk', 'Toko', 'Harga']
+    if not rekap_df.empty and all(col in rekap_df.columns for col in required_cols):
+        rekap_df['Tanggal'] = pd.to_datetime(rekap_df['Tanggal'], errors='coerce', dayfirst=True)
+        rekap_df['Harga'] = pd.to_numeric(rekap_df['Harga'].astype(str).str.replace(r'[^\d]', '', regex=True), errors='coerce')
+        rekap_df.dropna(subset=required_cols, inplace=True)
+        idx = rekap_df.groupby(['Toko', 'Nama Produk'])['Tanggal'].idxmax()
+        source_df = rekap_df.loc[idx].reset_index(drop=True)
+    source_df.attrs['degraded_sheets'] = degraded_sheets(errors)
+    return source_df
+
+# ================================
+# NORMALISASI NAMA PRODUK (SEKALI PER NAMA UNIK)
+# ================================
+# Nama dari sheet hanya di-strip; untuk pencocokan & blocking, nama diseragamkan dulu: huruf besar,
+# tanda baca -> spasi, satuan digabung ("16 GB" -> "16GB", 27" -> "27INCH"), singkatan umum diganti
+# kepanjangannya, dan tag marketplace ([READY], ORIGINAL, BNIB, ...) dibuang. Normalisasi di-memo per nama
+# (lru_cache se-proses), jadi rerun, job pembaruan & uji recall berikutnya tidak menormalisasi ulang. Scorer
+# (token_set_ratio) tetap memecah token setiap pasangan yang dinilai; penghematannya dari dedup nama kanonik.
+NAME_NORMALIZATION_VERSION = 2   # naikkan jika aturan di bawah berubah (cache skor pasangan ikut dibangun ulang)
+NAME_CACHE_SIZE = 200_000
+# Hanya tag yang tidak pernah jadi bagian identitas produk. NEW / BARU / HOT / BEST / FREE / PO sengaja
+# tidak dibuang: bisa bagian nama atau model ("New 3DS", "Hot Swap", "Free Size", kode model "PO").
+NAME_NOISE_TOKENS = {
+    'READY', 'STOCK', 'STOK', 'ORIGINAL', 'ORI', 'GARANSI', 'RESMI', 'OFFICIAL', 'BNIB',
+    'PROMO', 'MURAH', 'TERMURAH', 'SALE', 'SELLER', 'ONGKIR',
+}
+NAME_ALIASES = {'WL': 'WIRELESS', 'WRLS': 'WIRELESS', 'MECH': 'MECHANICAL', 'KB': 'KEYBOARD', 'INC': 'INCH'}
+NAME_UNITS = ('GB', 'TB', 'MB', 'HZ', 'MHZ', 'GHZ', 'W', 'WATT', 'MM', 'CM', 'INCH', 'MAH', 'DPI', 'RPM', 'K')
+_UNIT_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s+(' + '|'.join(NAME_UNITS) + r')\b')
+_INCH_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s*(?:"|\'\')')
+_DECIMAL_COMMA_PATTERN = re.compile(r'(?<=\d),(?=\d)')
+_SEPARATOR_PATTERN = re.compile(r'[^A-Z0-9.]+|\.(?!\d)|(?<!\d)\.')
+
+@functools.lru_cache(maxsize=NAME_CACHE_SIZE)
+def name_tokens(name):
+    """Token ternormalisasi sebuah nama produk, urutan asli dipertahankan (token pertama = kandidat brand)."""
+    text = _INCH_PATTERN.sub(r'\1INCH ', str(name).upper())
+    text = _SEPARATOR_PATTERN.sub(' ', _DECIMAL_COMMA_PATTERN.sub('.', text))
+    text = _UNIT_PATTERN.sub(r'\1\2', ' '.join(NAME_ALIASES.get(token, token) for token in text.split()))
+    return tuple(token for token in text.split() if token not in NAME_NOISE_TOKENS)
+
+@functools.lru_cache(maxsize=NAME_CACHE_SIZE)
+def normalize_product_name(name):
+    """
+    Bentuk kanonik untuk scorer: token unik terurut, dipisah spasi. token_set_ratio atas bentuk ini sama
+    dengan atas token_set nama ternormalisasi, dan nama yang hanya beda tag/format jadi satu string.
+    """
+    return ' '.join(sorted(set(name_tokens(name))))
+
+def normalized_names(names):
+    """(posisi tiap nama di daftar unik, daftar bentuk kanonik unik) untuk dedup sebelum penskoran."""
+    keys = [normalize_product_name(name) for name in names]
+    unique = list(dict.fromkeys(keys))
+    position = {key: pos for pos, key in enumerate(unique)}
+    return np.fromiter((position[key] for key in keys), dtype=np.int64, count=len(keys)), unique
+
+def name_cache_stats():
+    info = normalize_product_name.cache_info()
+    return {'Nama di cache': info.currsize, 'Hit': info.hits, 'Miss': info.misses}
+
+# ================================
+# MESIN PENCOCOKAN (MATCHING ENGINE)
+# ================================
+MATCH_LIMIT = 5
+
+def _empty_match_table():
+    return pd.DataFrame({'my_pos': np.array([], dtype=np.int64), 'comp_pos': np.array([], dtype=np.int64), 'score': np.array([], dtype=np.float32)})
+
+def _top_matches(rows, cols, vals, score_cutoff, limit):
+    # Seleksi vektor: buang skor < cutoff, urutkan (produk, skor turun, posisi kompetitor naik),
+    # lalu ambil `limit` pertama per produk (limit=None = semua pasangan >= cutoff)
+    keep = vals >= score_cutoff
+    rows, cols, vals = rows[keep], cols[keep], vals[keep]
+    if not len(rows): return _empty_match_table()
+    order = np.lexsort((cols, -vals, rows))
+    rows, cols, vals = rows[order], cols[order], vals[order]
+    if limit is not None:
+        group_start = np.r_[0, np.flatnonzero(np.diff(rows)) + 1]
+        rank = np.arange(len(rows)) - np.repeat(group_start, np.diff(np.r_[group_start, len(rows)]))
+        rows, cols, vals = rows[rank < limit], cols[rank < limit], vals[rank < limit]
+    return pd.DataFrame({'my_pos': rows.astype(np.int64), 'comp_pos': cols.astype(np.int64), 'score': vals.astype(np.float32)})
+
+@diagnostic_stage("pencocokan")
+def match_catalog(my_names, competitor_names, score_cutoff, limit=MATCH_LIMIT, chunk_size=512, workers=-1,
+                  progress=None, blocking_index=None, my_brands=None, normalize=True):
+    """
+    Mencocokkan seluruh katalog toko sendiri dengan semua nama produk kompetitor sekaligus.
+
+    Dengan `normalize` (default), kedua daftar dipetakan ke bentuk kanonik normalize_product_name
+    (sekali per nama, di-memo) dan hanya bentuk kanonik unik yang diskor; skor lalu disebar kembali ke
+    posisi asli. normalize=False = skor atas nama mentah (pembanding di benchmark).
+
+    Tanpa `blocking_index`, skor dihitung per blok `chunk_size` produk dengan `process.cdist`
+    (token_set_ratio, `workers` core; -1 = semua core) sehingga memori matriks tetap terbatas.
+    Dengan `blocking_index` (lihat build_blocking_index), hanya pasangan yang berbagi blok
+    (brand / token model) yang diskor, lewat `process.cpdist`.
+    Pasangan >= score_cutoff dipilih secara vektor, `limit` teratas per produk (None = semua).
+    Urutan & isi identik dengan process.extract(..., limit=limit, score_cutoff=score_cutoff) per produk
+    atas string yang diskor: skor menurun, skor sama diurutkan menurut posisi di `competitor_names`.
+
+    `progress(done)` dipanggil setelah setiap blok dengan jumlah produk yang sudah diproses.
+    Return DataFrame kolom my_pos, comp_pos (posisi di list input) dan score (float);
+    attrs['pairs_scored'] = jumlah pasangan (posisi) yang dinilai, attrs['unique_pairs_scored'] =
+    jumlah panggilan scorer setelah dedup nama kanonik.
+    """
+    if len(my_names) == 0 or len(competitor_names) == 0: return _empty_match_table()
+    if normalize:
+        my_key_pos, my_keys = normalized_names(my_names)
+        comp_key_pos, comp_keys = normalized_names(competitor_names)
+    else:
+        my_key_pos, my_keys = np.arange(len(my_names)), list(my_names)
+        comp_key_pos, comp_keys = np.arange(len(competitor_names)), list(competitor_names)
+    parts, pairs_scored, unique_pairs_scored = [], 0, 0
+    for start in range(0, len(my_names), chunk_size):
+        block = my_names[start:start + chunk_size]
+        block_key_pos = my_key_pos[start:start + chunk_size]
+        if blocking_index is None:
+            # Skor per pasangan kanonik unik, lalu disebar ke matriks blok x semua kompetitor
+            block_keys, block_inverse = np.unique(block_key_pos, return_inverse=True)
+            unique_scores = process.cdist([my_keys[k] for k in block_keys], comp_keys, scorer=fuzz.token_set_ratio,
+                                          score_cutoff=score_cutoff, dtype=np.float32, workers=workers)
+            scores = unique_scores[block_inverse][:, comp_key_pos]
+            rows, cols = np.nonzero(scores >= score_cutoff)
+            vals = scores[rows, cols]
+            pairs_scored += scores.size
+            unique_pairs_scored += unique_scores.size
+        else:
+            block_brands = my_brands[start:start + chunk_size] if my_brands is not None else None
+            rows, cols = blocking_candidates(blocking_index, block, block_brands, len(competitor_names))
+            pair_keys, pair_inverse = np.unique(block_key_pos[rows] * len(comp_keys) + comp_key_pos[cols], return_inverse=True)
+            vals = process.cpdist([my_keys[k] for k in pair_keys // len(comp_keys)], [comp_keys[k] for k in pair_keys % len(comp_keys)],
+                                  scorer=fuzz.token_set_ratio, score_cutoff=score_cutoff,
+                                  dtype=np.float32, workers=workers)[pair_inverse] if len(rows) else np.array([], dtype=np.float32)
+            pairs_scored += len(rows)
+            unique_pairs_scored += len(pair_keys)
+        part = _top_matches(rows, cols, vals, score_cutoff, limit)
+        part['my_pos'] += start
+        parts.append(part)
+        if progress: progress(min(start + chunk_size, len(my_names)))
+    result = pd.concat(parts, ignore_index=True)
+    result.attrs['pairs_scored'], result.attrs['unique_pairs_scored'] = pairs_scored, unique_pairs_scored
+    return result
+
+# ================================
+# INDEKS BLOCKING KANDIDAT
+# ================================
+def blocking_keys(name, brands=None):
+    """
+    Kunci blok sebuah nama produk (dari token ternormalisasi name_tokens):
+      - 'B:<brand>' dari kolom Brand (jika ada) dan dari token pertama nama (fallback load_all_data),
+      - 'M:<token>' untuk token model yang mengandung huruf+angka (G502, RTX4060, 16GB),
+      - 'M:<angka>' untuk deret angka >= 3 digit di dalam token (502, 4060) agar
+        "RTX4060" dan "RTX 4060" tetap satu blok.
+    """
+    tokens = [part for token in name_tokens(name) for part in token.split('.')]
+    keys = {'B:' + tokens[0]} if tokens else set()
+    if brands is not None:
+        for brand in ([brands] if isinstance(brands, str) else brands):
+            brand_key = re.sub(r'[^A-Z0-9]', '', str(brand).upper()) if pd.notna(brand) else ''
+            if brand_key: keys.add('B:' + brand_key)
+    for token in tokens:
+        if len(token) >= 3 and not token.isdigit() and not token.isalpha():
+            keys.add('M:' + token)
+        keys.update('M:' + digits for digits in re.findall(r'\d{3,}', token))
+    return keys
+
+def build_blocking_index(competitor_names, competitor_brands=None):
+    """Indeks terbalik {kunci blok: array posisi di competitor_names}. Dibangun sekali per update."""
+    index = {}
+    for pos, name in enumerate(competitor_names):
+        brands = competitor_brands[pos] if competitor_brands is not None else None
+        for key in blocking_keys(name, brands):
+            index.setdefault(key, []).append(pos)
+    return {key: np.asarray(positions, dtype=np.int64) for key, positions in index.items()}
+
+def blocking_candidates(blocking_index, my_names, my_brands, n_competitors):
+    """
+    Pasangan kandidat (posisi produk, posisi kompetitor) yang berbagi minimal satu blok.
+    Produk tanpa kunci blok sama sekali tetap dibandingkan dengan semua kompetitor.
+    """
+    rows, cols = [], []
+    for pos, name in enumerate(my_names):
+        keys = blocking_keys(name, my_brands[pos] if my_brands is not None else None)
+        hits = [blocking_index[key] for key in keys if key in blocking_index]
+        if not keys:
+            candidates = np.arange(n_competitors, dtype=np.int64)
+        elif hits:
+            candidates = np.unique(np.concatenate(hits))
+        else:
+            continue
+        rows.append(np.full(len(candidates), pos, dtype=np.int64))
+        cols.append(candidates)
+    if not rows: return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return np.concatenate(rows), np.concatenate(cols)
+
+def brands_by_name(source_df, names):
+    # Semua nilai Brand yang pernah dipakai tiap nama produk (nama sama bisa muncul di beberapa toko)
+    if 'Brand' not in source_df.columns: return None
+    brand_sets = {}
+    pairs = pd.DataFrame({'name': source_df['Nama Produk'].to_numpy(), 'brand': source_df['Brand'].to_numpy()}).dropna().drop_duplicates()
+    for name, brand in zip(pairs['name'], pairs['brand']):
+        brand_sets.setdefault(name, set()).add(brand)
+    return [brand_sets.get(name, set()) for name in names]
+
+def blocking_recall_report(my_names, competitor_names, score_cutoff, my_brands=None, competitor_brands=None, limit=MATCH_LIMIT):
+    """
+    Bandingkan pencocokan dengan dan tanpa blocking pada data yang sama.
+    Return (ringkasan dict, DataFrame pasangan >= cutoff yang hilang karena blocking).
+    Hasil blocking selalu subset hasil penuh, jadi recall = jumlah pasangan blocking / penuh.
+    """
+    start = time.perf_counter()
+    full = match_catalog(my_names, competitor_names, score_cutoff, limit=None)
+    full_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    index = build_blocking_index(competitor_names, competitor_brands)
+    blocked = match_catalog(my_names, competitor_names, score_cutoff, limit=None, blocking_index=index, my_brands=my_brands)
+    blocked_seconds = time.perf_counter() - start
+
+    def top(table):
+        return table[table.groupby('my_pos').cumcount() < limit]
+    def pair_set(table):
+        return set(zip(table['my_pos'], table['comp_pos']))
+    missed = full.merge(blocked[['my_pos', 'comp_pos']], how='left', on=['my_pos', 'comp_pos'], indicator=True)
+    missed = missed[missed['_merge'] == 'left_only']
+    full_top, blocked_top = pair_set(top(full)), pair_set(top(blocked))
+    summary = {
+        'Pasangan >= cutoff (tanpa blocking)': len(full),
+        'Pasangan >= cutoff (dengan blocking)': len(blocked),
+        'Recall semua pasangan >= cutoff': len(blocked) / len(full) if len(full) else 1.0,
+        f'Recall top-{limit} (isi HASIL_MATCHING)': len(full_top & blocked_top) / len(full_top) if full_top else 1.0,
+        'Perbandingan dihitung (tanpa blocking)': full.attrs.get('pairs_scored', 0),
+        'Perbandingan dihitung (dengan blocking)': blocked.attrs.get('pairs_scored', 0),
+        'Waktu tanpa blocking (detik)': round(full_seconds, 3),
+        'Waktu dengan blocking (detik)': round(blocked_seconds, 3),
+    }
+    missed_df = pd.DataFrame({
+        'Produk Toko Saya': [my_names[i] for i in missed['my_pos']],
+        'Produk Kompetitor': [competitor_names[j] for j in missed['comp_pos']],
+        'Skor Kemiripan': missed['score'].astype(int).tolist(),
+    })
+    return summary, missed_df
+
+# ================================
+# CACHE SKOR PASANGAN (PERSISTEN)
+# ================================
+# Skor disimpan untuk semua pasangan >= PAIR_CACHE_MIN_SCORE (batas bawah slider akurasi),
+# sehingga cutoff berapa pun di atasnya bisa dihitung ulang dari cache tanpa pencocokan ulang.
+PAIR_CACHE_MIN_SCORE = 80
+PAIR_CACHE_SCORER = f"token_set_ratio/norm{NAME_NORMALIZATION_VERSION}"
+PAIR_CACHE_FILE, PAIR_CACHE_META = 'pair_scores.parquet', 'pair_scores.json'
+
+def pair_cache_dir(base_dir, spreadsheet_key):
+    """Folder cache skor pasangan untuk satu spreadsheet (di samping snapshot lokalnya)."""
+    return _snapshot_dir(base_dir, spreadsheet_key)
+
+def _empty_pair_cache(floor, use_blocking):
+    return {
+        'pairs': pd.DataFrame({'my_name': pd.Series(dtype=object), 'comp_name': pd.Series(dtype=object), 'score': pd.Series(dtype=np.float32)}),
+        'my_names': set(), 'comp_names': set(), 'floor': floor, 'blocking': use_blocking, 'scorer': PAIR_CACHE_SCORER,
+    }
+
+def load_pair_cache(cache_dir):
+    """Baca cache skor pasangan dari `cache_dir`; None jika belum ada atau rusak."""
+    meta_path = os.path.join(cache_dir, PAIR_CACHE_META)
+    if not os.path.exists(meta_path): return None
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        pairs = pd.read_parquet(os.path.join(cache_dir, PAIR_CACHE_FILE))
+    except Exception:
+        return None
+    return {'pairs': pairs, 'my_names': set(meta['my_names']), 'comp_names': set(meta['comp_names']),
+            'floor': meta['floor'], 'blocking': meta['blocking'], 'scorer': meta.get('scorer')}
+
+def save_pair_cache(cache_dir, cache):
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = os.path.join(cache_dir, PAIR_CACHE_FILE + '.tmp')
+    cache['pairs'].to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, os.path.join(cache_dir, PAIR_CACHE_FILE))
+    meta = {'my_names': sorted(cache['my_names']), 'comp_names': sorted(cache['comp_names']),
+            'floor': cache['floor'], 'blocking': cache['blocking'], 'scorer': cache['scorer'],
+            'updated_at': datetime.now().isoformat(timespec='seconds')}
+    tmp_meta = os.path.join(cache_dir, PAIR_CACHE_META + '.tmp')
+    with open(tmp_meta, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(tmp_meta, os.path.join(cache_dir, PAIR_CACHE_META))
+
+def _scored_pairs(my_names, competitor_names, floor, use_blocking, my_brand_map, comp_brand_map, progress=None):
+    # Semua pasangan >= floor antara dua list nama, sebagai tabel nama-nama (bukan posisi).
+    # Return (tabel, jumlah pasangan yang benar-benar diskor)
+    if not my_names or not competitor_names: return _empty_pair_cache(floor, use_blocking)['pairs'], 0
+    blocking_index, my_brands = None, None
+    if use_blocking:
+        comp_brands = [comp_brand_map.get(name, set()) for name in competitor_names] if comp_brand_map is not None else None
+        blocking_index = build_blocking_index(competitor_names, comp_brands)
+        my_brands = [my_brand_map.get(name) for name in my_names] if my_brand_map is not None else None
+    table = match_catalog(my_names, competitor_names, floor, limit=None, progress=progress,
+                          blocking_index=blocking_index, my_brands=my_brands)
+    return pd.DataFrame({
+        'my_name': np.asarray(my_names, dtype=object)[table['my_pos'].to_numpy()],
+        'comp_name': np.asarray(competitor_names, dtype=object)[table['comp_pos'].to_numpy()],
+        'score': table['score'].to_numpy(dtype=np.float32),
+    }), table.attrs.get('pairs_scored', 0)
+
+@diagnostic_stage("pencocokan_cache_skor")
+def update_pair_cache(cache, my_names, competitor_names, score_cutoff, use_blocking=True,
+                      my_brand_map=None, comp_brand_map=None, progress=None):
+    """
+    Lengkapi cache untuk daftar nama saat ini. Hanya yang belum pernah diskor yang dihitung:
+    (nama toko baru x semua kompetitor) dan (nama toko lama x nama kompetitor baru).
+    Nama yang sudah tidak ada dibuang dari cache. Cache dibangun ulang penuh jika mode blocking,
+    scorer, atau batas skor minimum tidak cocok. Return (cache, stats).
+    """
+    floor = min(PAIR_CACHE_MIN_SCORE, score_cutoff)
+    if cache is None or cache['blocking'] != use_blocking or cache['scorer'] != PAIR_CACHE_SCORER or cache['floor'] > floor:
+        cache = _empty_pair_cache(floor, use_blocking)
+    floor = cache['floor']
+    current_my, current_comp = set(my_names), set(competitor_names)
+    new_my = [name for name in dict.fromkeys(my_names) if name not in cache['my_names']]
+    known_my = [name for name in dict.fromkeys(my_names) if name in cache['my_names']]
+    new_comp = [name for name in competitor_names if name not in cache['comp_names']]
+
+    pairs = cache['pairs']
+    pairs = pairs[pairs['my_name'].isin(current_my) & pairs['comp_name'].isin(current_comp)]
+    total = len(new_my) + (len(known_my) if new_comp else 0)
+    new_pairs, scored_new_my = _scored_pairs(new_my, list(competitor_names), floor, use_blocking, my_brand_map, comp_brand_map,
+                                             progress=(lambda done: progress(done, total)) if progress else None)
+    comp_pairs, scored_new_comp = _scored_pairs(known_my, new_comp, floor, use_blocking, my_brand_map, comp_brand_map,
+                                                progress=(lambda done: progress(len(new_my) + done, total)) if progress else None)
+    cache = dict(cache, pairs=pd.concat([pairs, new_pairs, comp_pairs], ignore_index=True), my_names=current_my, comp_names=current_comp)
+    stats = {'Produk baru/berubah': len(new_my), 'Nama kompetitor baru/berubah': len(new_comp),
+             'Pasangan diskor': scored_new_my + scored_new_comp, 'Pasangan di cache': len(cache['pairs'])}
+    return cache, stats
+
+def match_table_from_cache(cache, my_names, competitor_names, score_cutoff, limit=MATCH_LIMIT):
+    """Top-`limit` per produk >= score_cutoff dari cache, format sama dengan match_catalog."""
+    pairs = cache['pairs']
+    pairs = pairs[pairs['score'] >= score_cutoff]
+    merged = pairs.merge(pd.DataFrame({'my_name': my_names, 'my_pos': np.arange(len(my_names))}), on='my_name') \
+                  .merge(pd.DataFrame({'comp_name': competitor_names, 'comp_pos': np.arange(len(competitor_names))}), on='comp_name')
+    return _top_matches(merged['my_pos'].to_numpy(), merged['comp_pos'].to_numpy(),
+                        merged['score'].to_numpy(dtype=np.float32), score_cutoff, limit)
+
+MATCH_RESULT_COLUMNS = ['Produk Toko Saya', 'Harga Toko Saya', 'Produk Kompetitor', 'Harga Kompetitor',
+                        'Toko Kompetitor', 'Skor Kemiripan', 'Tanggal_Update']
+
+@diagnostic_stage("susun_hasil_matching")
+def assemble_match_results(match_table, my_rows, competitor_df, competitor_names, update_date=None):
+    """
+    Susun baris HASIL_MATCHING dari tabel ringkas (my_pos, comp_pos, score) dengan satu merge
+    terhadap baris kompetitor terbaru: satu baris per (pasangan cocok x toko yang menjual nama itu).
+    Urutan baris sama dengan urutan tabel pencocokan, lalu urutan baris di `competitor_df`.
+    """
+    if match_table.empty: return pd.DataFrame(columns=MATCH_RESULT_COLUMNS)
+    my_pos = match_table['my_pos'].to_numpy()
+    hits = pd.DataFrame({
+        'Produk Toko Saya': my_rows['Nama Produk'].to_numpy()[my_pos],
+        'Harga Toko Saya': my_rows['Harga'].to_numpy()[my_pos].astype(np.int64),
+        'Produk Kompetitor': np.asarray(competitor_names, dtype=object)[match_table['comp_pos'].to_numpy()],
+        'Skor Kemiripan': match_table['score'].to_numpy().astype(np.int64),
+    })
+    offers = pd.DataFrame({
+        'Produk Kompetitor': competitor_df['Nama Produk'].to_numpy(),
+        'Harga Kompetitor': competitor_df['Harga'].to_numpy().astype(np.int64),
+        'Toko Kompetitor': competitor_df['Toko'].to_numpy(),
+    })
+    results_df = hits.merge(offers, on='Produk Kompetitor', how='inner', sort=False)
+    results_df['Tanggal_Update'] = (update_date or datetime.now()).strftime('%Y-%m-%d')
+    return results_df[MATCH_RESULT_COLUMNS]
+
+# ================================
+# PENULISAN HASIL_MATCHING (UPSERT BERBASIS DIFF)
+# ================================
+MATCH_KEY_COLUMNS = ['Produk Toko Saya', 'Produk Kompetitor', 'Toko Kompetitor']
+
+def _cell_text(value):
+    # Bentuk kanonik untuk membandingkan isi sheet (UNFORMATTED_VALUE) dengan hasil baru
+    if value is None or (isinstance(value, float) and np.isnan(value)): return ''
+    if isinstance(value, (float, np.floating)) and float(value).is_integer(): return str(int(value))
+    return str(value).strip()
+
+def _contiguous_runs(row_numbers):
+    # [2, 3, 4, 9, 10] -> [(2, 4), (9, 10)]
+    runs = []
+    for row in sorted(row_numbers):
+        if runs and row == runs[-1][1] + 1: runs[-1][1] = row
+        else: runs.append([row, row])
+    return [tuple(run) for run in runs]
+
+def plan_matching_upsert(existing_values, results_df):
+    """
+    Bandingkan isi sheet saat ini dengan hasil baru berdasarkan kunci MATCH_KEY_COLUMNS.
+    Baris dianggap berubah jika salah satu kolom selain Tanggal_Update berbeda; Tanggal_Update
+    pada sheet jadi berarti "terakhir berubah". Slot baris yang dihapus dipakai ulang untuk baris
+    baru; sisanya ditambah di bawah atau dihapus.
+    Return dict: full_rewrite, writes {nomor_baris: nilai}, deletes [nomor_baris], stats.
+    """
+    width = len(MATCH_RESULT_COLUMNS)
+    new_rows = results_df[MATCH_RESULT_COLUMNS].drop_duplicates(subset=MATCH_KEY_COLUMNS).astype(object).to_numpy().tolist()
+    header = [_cell_text(v) for v in existing_values[0]] if existing_values else []
+    while header and header[-1] == '': header.pop()
+    if header != MATCH_RESULT_COLUMNS:
+        stats = {'Baris baru': len(new_rows), 'Baris berubah': 0, 'Baris dihapus': max(len(existing_values) - 1, 0),
+                 'Baris tetap': 0, 'Sel ditulis': (len(new_rows) + 1) * width}
+        return {'full_rewrite': True, 'writes': {}, 'deletes': [], 'stats': stats}
+
+    key_idx = [MATCH_RESULT_COLUMNS.index(c) for c in MATCH_KEY_COLUMNS]
+    compare_idx = [i for i, c in enumerate(MATCH_RESULT_COLUMNS) if c != 'Tanggal_Update']
+    existing = {}
+    free_rows = []
+    for row_number, row in enumerate(existing_values[1:], start=2):
+        row = list(row) + [''] * (width - len(row))
+        key = tuple(_cell_text(row[i]) for i in key_idx)
+        if key in existing or not any(key): free_rows.append(row_number)  # duplikat / baris kosong
+        else: existing[key] = (row_number, [_cell_text(row[i]) for i in compare_idx])
+
+    writes, additions, unchanged = {}, [], 0
+    for row in new_rows:
+        key = tuple(_cell_text(row[i]) for i in key_idx)
+        if key in existing:
+            row_number, old_values = existing.pop(key)
+            if [_cell_text(row[i]) for i in compare_idx] != old_values: writes[row_number] = row
+            else: unchanged += 1
+        else:
+            additions.append(row)
+    changed = len(writes)
+    free_rows = sorted(free_rows + [row_number for row_number, _ in existing.values()])
+    deleted = len(free_rows) - min(len(free_rows), len(additions)) if free_rows else 0
+    next_row = len(existing_values) + 1
+    for row in additions:
+        if free_rows: writes[free_rows.pop(0)] = row
+        else: writes[next_row] = row; next_row += 1
+    stats = {'Baris baru': len(additions), 'Baris berubah': changed, 'Baris dihapus': deleted,
+             'Baris tetap': unchanged, 'Sel ditulis': len(writes) * width}
+    return {'full_rewrite': False, 'writes': writes, 'deletes': free_rows, 'stats': stats}
+
+@diagnostic_stage("tulis_hasil_matching")
+def write_matching_results(spreadsheet, results_df, dry_run=False, chunk_rows=500):
+    """
+    Tulis hasil ke HASIL_MATCHING sebagai upsert: hanya baris baru/berubah yang ditulis
+    (values_batch_update per `chunk_rows` baris) dan baris usang dihapus dalam satu batch_update,
+    sehingga sheet tidak pernah kosong bagi pembaca. Sheet belum ada / header berbeda -> tulis penuh.
+    dry_run=True hanya menghitung rencana. Return stats (termasuk 'Sel ditulis' dan 'Request').
+    """
+    try:
+        worksheet = spreadsheet.worksheet(MATCHING_SHEET_NAME)
+        response = spreadsheet.values_get(_sheet_range(MATCHING_SHEET_NAME), params={'valueRenderOption': 'UNFORMATTED_VALUE'})
+        existing_values = response.get('values', [])
+    except gspread.exceptions.WorksheetNotFound:
+        worksheet, existing_values = None, []
+    plan = plan_matching_upsert(existing_values, results_df)
+    stats = dict(plan['stats'])
+    if plan['full_rewrite']:
+        # Sheet dikosongkan / dibuat, lalu header + semua baris ditulis lewat jalur batch yang sama
+        rows = [MATCH_RESULT_COLUMNS] + results_df[MATCH_RESULT_COLUMNS].drop_duplicates(subset=MATCH_KEY_COLUMNS).astype(object).to_numpy().tolist()
+        plan['writes'] = dict(enumerate(rows, start=1))
+        if not dry_run:
+            if worksheet is None:
+                worksheet = spreadsheet.add_worksheet(title=MATCHING_SHEET_NAME, rows=len(rows), cols=len(MATCH_RESULT_COLUMNS))
+            else:
+                worksheet.clear()
+    extra_requests = 1 if plan['full_rewrite'] else 0
+
+    last_col = re.sub(r'\d', '', rowcol_to_a1(1, len(MATCH_RESULT_COLUMNS)))
+    data = [{'range': f"{_sheet_range(MATCHING_SHEET_NAME)}!A{start}:{last_col}{end}",
+             'values': [plan['writes'][row] for row in range(start, end + 1)]}
+            for start, end in _contiguous_runs(plan['writes'])]
+    batches, current, current_rows = [], [], 0
+    for item in data:
+        if current and current_rows + len(item['values']) > chunk_rows:
+            batches.append(current); current, current_rows = [], 0
+        current.append(item); current_rows += len(item['values'])
+    if current: batches.append(current)
+    delete_requests = [
+        {'deleteDimension': {'range': {'sheetId': worksheet.id, 'dimension': 'ROWS', 'startIndex': start - 1, 'endIndex': end}}}
+        for start, end in reversed(_contiguous_runs(plan['deletes']))
+    ]
+    needed_rows = max(plan['writes'], default=0)
+    row_count = worksheet.row_count if worksheet is not None else needed_rows
+    stats['Request'] = extra_requests + len(batches) + (1 if delete_requests else 0) + (1 if needed_rows > row_count else 0)
+    if dry_run: return stats
+
+    if needed_rows > worksheet.row_count:
+        worksheet.add_rows(needed_rows - worksheet.row_count)
+    for batch in batches:
+        # RAW: nama seperti "0123", "1/2" atau "=..." disimpan apa adanya (bukan angka / tanggal / rumus),
+        # sehingga terbaca kembali sama persis oleh plan_matching_upsert dan baris itu tidak ditulis ulang terus
+        spreadsheet.values_batch_update({'valueInputOption': 'RAW', 'data': batch})
+    if delete_requests:
+        # Dihapus dari bawah ke atas agar nomor baris yang belum dihapus tidak bergeser
+        spreadsheet.batch_update({'requests': delete_requests})
+    return stats
+
+@diagnostic_stage("pembaruan_perbandingan_harga")
+def run_price_comparison_update(gc, spreadsheet_key, score_cutoff=88, use_blocking=True, pair_cache_dir=None,
+                                source_df=None, dry_run=False, progress=None):
+    """
+    Cocokkan katalog toko sendiri (MY_STORE_NAME) dengan kompetitor lalu tulis ke HASIL_MATCHING.
+    Tidak memakai elemen Streamlit sehingga aman dijalankan di thread latar (lihat submit_update_job).
+
+    Dengan `pair_cache_dir`, hanya nama baru/berubah yang diskor; sisanya diambil dari cache skor.
+    `source_df` (snapshot terbaru per Toko & Nama Produk) bisa diberikan agar tidak mengunduh ulang sumber.
+    dry_run=True hanya menghitung jumlah sel/request yang akan ditulis.
+    `progress(persen, teks)` dipanggil selama proses berjalan.
+
+    Jika ada sheet sumber yang gagal dimuat (`source_df.attrs['degraded_sheets']`), pembaruan dibatalkan:
+    toko dari sheet itu tidak ada di hasil, dan upsert akan menghapus barisnya dari HASIL_MATCHING.
+
+    Return dict: status ('sukses' | 'kosong' | 'dry_run' | 'gagal'), message, results_df
+    (None jika tidak ada yang dipublikasikan), write_stats, notes (peringatan tambahan),
+    degraded_sheets ({sheet: alasan} sheet sumber yang gagal dimuat).
+    """
+    progress = progress or (lambda pct, text: None)
+    outcome = {'status': 'gagal', 'message': '', 'results_df': None, 'write_stats': None, 'notes': [], 'degraded_sheets': {}}
+    progress(0, "Memulai pembaruan perbandingan harga...")
+    if source_df is None:
+        try:
+            source_df = load_source_data_for_update(gc, spreadsheet_key)
+        except Exception as e:
+            outcome['message'] = f"Gagal memuat data sumber untuk update: {e}"; return outcome
+    if source_df is not None and source_df.attrs.get('degraded_sheets'):
+        outcome['degraded_sheets'] = dict(source_df.attrs['degraded_sheets'])
+        outcome['notes'].extend(f"Sheet gagal dimuat: {name} — {reason}" for name, reason in outcome['degraded_sheets'].items())
+        outcome['message'] = (f"Pembaruan dibatalkan: {len(outcome['degraded_sheets'])} sheet sumber gagal dimuat. "
+                              "HASIL_MATCHING tidak diubah agar baris toko tersebut tidak terhapus; coba lagi beberapa saat lagi.")
+        return outcome
+    if source_df is None or source_df.empty:
+        outcome['message'] = "Gagal memuat data sumber untuk update. Batal."; return outcome
+    my_store_df = source_df[source_df['Toko'] == MY_STORE_NAME]
+    competitor_df = source_df[source_df['Toko'] != MY_STORE_NAME]
+    if my_store_df.empty or competitor_df.empty:
+        outcome['message'] = "Data toko Anda atau kompetitor tidak cukup."; return outcome
+    competitor_products_list = competitor_df['Nama Produk'].unique().tolist()
+    my_rows = my_store_df.reset_index(drop=True)
+    my_names = my_rows['Nama Produk'].tolist()
+    total = len(my_rows)
+    if pair_cache_dir is not None:
+        my_brand_map = dict(zip(my_names, my_rows['Brand'])) if 'Brand' in my_rows.columns else None
+        comp_brands = brands_by_name(competitor_df, competitor_products_list)
+        comp_brand_map = dict(zip(competitor_products_list, comp_brands)) if comp_brands is not None else None
+        cache, cache_stats = update_pair_cache(
+            load_pair_cache(pair_cache_dir), my_names, competitor_products_list, score_cutoff, use_blocking,
+            my_brand_map, comp_brand_map,
+            progress=lambda done, todo: progress(int((done / max(todo, 1)) * 80), f"Mencocokkan produk baru {done}/{todo}")
+        )
+        try:
+            save_pair_cache(pair_cache_dir, cache)
+        except Exception as e:
+            outcome['notes'].append(f"Cache skor tidak dapat disimpan: {e}")
+        match_table = match_table_from_cache(cache, my_names, competitor_products_list, score_cutoff)
+        outcome['notes'].append(f"Cache skor: {cache_stats['Produk baru/berubah']} produk & {cache_stats['Nama kompetitor baru/berubah']} nama kompetitor baru diskor.")
+    else:
+        blocking_index, my_brands = None, None
+        if use_blocking:
+            # Indeks blok dibangun sekali per update: hanya pasangan se-brand / se-token model yang diskor
+            blocking_index = build_blocking_index(competitor_products_list, brands_by_name(competitor_df, competitor_products_list))
+            my_brands = my_rows['Brand'].tolist() if 'Brand' in my_rows.columns else None
+        match_table = match_catalog(
+            my_names, competitor_products_list, score_cutoff,
+            progress=lambda done: progress(int((done / total) * 80), f"Mencocokkan produk {done}/{total}"),
+            blocking_index=blocking_index, my_brands=my_brands
+        )
+    results_df = assemble_match_results(match_table, my_rows, competitor_df, competitor_products_list)
+    progress(90, "Menyimpan hasil..." if not dry_run else "Menghitung rencana penulisan...")
+    try:
+        spreadsheet = gc.open_by_key(spreadsheet_key)
+        write_stats = write_matching_results(spreadsheet, results_df, dry_run=dry_run)
+    except Exception as e:
+        outcome['message'] = f"Gagal menyimpan hasil: {e}"; return outcome
+    outcome['write_stats'] = write_stats
+    progress(100, "Selesai")
+    if dry_run:
+        outcome.update(status='dry_run', message=f"Dry-run: {write_stats['Sel ditulis']} sel akan ditulis dalam {write_stats['Request']} request. Tidak ada yang diubah.")
+    elif not results_df.empty:
+        outcome.update(status='sukses', results_df=results_df,
+                       message=f"Selesai: {len(results_df)} baris hasil; {write_stats['Baris baru']} baru, {write_stats['Baris berubah']} berubah, "
+                               f"{write_stats['Baris dihapus']} dihapus ({write_stats['Sel ditulis']} sel ditulis).")
+    else:
+        outcome.update(status='kosong', results_df=pd.DataFrame(), message="Tidak ditemukan pasangan produk yang cocok.")
+    return outcome
+
+# ================================
+# DATASET BERSAMA (SE-PROSES, READ-ONLY)
+# ================================
+# Satu salinan REKAP / DATABASE / HASIL_MATCHING per versi data untuk semua sesi dashboard. Sesi hanya
+# menyimpan referensi ke SharedDataset (bukan salinan frame); frame-nya tidak boleh diubah in-place.
+# Registri memegang versi terbaru secara kuat, versi lama hanya lewat weakref: begitu tidak ada sesi
+# (atau cache frame turunan) yang masih mereferensikannya, memorinya dilepas oleh garbage collector.
+class SessionToken:
+    """Penanda satu sesi (disimpan di session state); hilang bersama sesinya."""
+    __slots__ = ('__weakref__',)
+
+class SharedDataset:
+    """Satu versi data yang dibagi antar-sesi. `sessions` = token sesi yang sedang memakainya."""
+    def __init__(self, version, df, db_df, matches_df):
+        self.version, self.df, self.db_df, self.matches_df = version, df, db_df, matches_df
+        self.sessions = weakref.WeakSet()
+        self._memory_mb = None
+
+    def with_matches(self, version, matches_df):
+        # Versi baru yang hanya mengganti HASIL_MATCHING: REKAP & DATABASE tetap objek yang sama
+        return SharedDataset(version, self.df, self.db_df, matches_df)
+
+    def memory_mb(self):
+        if self._memory_mb is None:
+            self._memory_mb = {name: round(float(frame.memory_usage(deep=True).sum()) / 1e6, 2)
+                               for name, frame in (('REKAP', self.df), ('DATABASE', self.db_df), ('HASIL_MATCHING', self.matches_df))}
+        return self._memory_mb
+
+class DatasetRegistry:
+    """Registri versi data se-proses. Aman dipakai dari beberapa thread (satu thread per sesi Streamlit)."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._live = weakref.WeakValueDictionary()
+        self._latest = None
+
+    def get(self, version):
+        return self._live.get(version) if version else None
+
+    def publish(self, dataset):
+        """
+        Daftarkan `dataset` sebagai versi terbaru. Jika versinya sudah hidup (sesi lain memuat data yang sama),
+        objek yang sudah ada yang dikembalikan dan frame milik `dataset` dibuang. Versi None tidak dibagi.
+        """
+        with self._lock:
+            existing = self.get(dataset.version)
+            if existing is not None: dataset = existing
+            elif dataset.version: self._live[dataset.version] = dataset
+            self._latest = dataset
+        return dataset
+
+    def attach(self, dataset, token):
+        # Satu sesi hanya memakai satu versi: lepas token dari versi lain
+        with self._lock:
+            for other in list(self._live.values()):
+                if other is not dataset: other.sessions.discard(token)
+            dataset.sessions.add(token)
+        return dataset
+
+    def stats(self):
+        with self._lock:
+            datasets = list(self._live.values())
+            latest = self._latest
+        return [{'Versi': dataset.version, 'Sesi': len(dataset.sessions), 'Terbaru': dataset is latest,
+                 **{f"{name} (MB)": mb for name, mb in dataset.memory_mb().items()}} for dataset in datasets]
+
+# ================================
+# FRAME TURUNAN UNTUK TAMPILAN
+# ================================
+@diagnostic_stage("frame_turunan")
+def derive_frames(rekap_df, start_date=None, end_date=None, my_store_name=MY_STORE_NAME, window_df=None):
+    """
+    Semua frame turunan yang dipakai tab dashboard, dihitung sekali per (versi data, rentang tanggal).
+    start_date/end_date None = seluruh data (mode HPP). `window_df` = jendela yang sudah difilter di sumbernya
+    (query_history); jika diberikan, dipakai langsung sebagai df_filtered. Frame hasil dibagi antar-sesi:
+    jangan diubah in-place.
+    """
+    if window_df is not None:
+        df_filtered = window_df
+    elif start_date is not None and end_date is not None:
+        in_range = (rekap_df['Tanggal'] >= pd.to_datetime(start_date)) & (rekap_df['Tanggal'] <= pd.to_datetime(end_date))
+        df_filtered = rekap_df if in_range.all() else rekap_df[in_range]
+    else:
+        # Seluruh data: frame sumber dipakai langsung (read-only), tanpa salinan kedua
+        df_filtered = rekap_df
+    # Minggu sudah dihitung saat load (compact_rekap_df); groupby categorical hanya atas kombinasi yang ada
+    latest_entries_overall = df_filtered.loc[df_filtered.groupby(['Toko', 'Nama Produk'], observed=True)['Tanggal'].idxmax()]
+    my_store_all = rekap_df[rekap_df['Toko'] == my_store_name]
+    return {
+        'df_filtered': df_filtered,
+        'main_store_df': df_filtered[df_filtered['Toko'] == my_store_name],
+        'competitor_df': df_filtered[df_filtered['Toko'] != my_store_name],
+        'latest_entries_weekly': df_filtered.loc[df_filtered.groupby(['Minggu', 'Toko', 'Nama Produk'], observed=True)['Tanggal'].idxmax()],
+        'latest_entries_overall': latest_entries_overall,
+        'main_store_latest_overall': latest_entries_overall[latest_entries_overall['Toko'] == my_store_name],
+        'competitor_latest_overall': latest_entries_overall[latest_entries_overall['Toko'] != my_store_name],
+        # Produk toko sendiri pada tanggal data terakhirnya (tab Perbandingan, tidak ikut filter tanggal)
+        'my_latest_products': my_store_all[my_store_all['Tanggal'] == my_store_all['Tanggal'].max()],
+        'availability': build_availability_index(df_filtered),
+    }
+
+# ================================
+# INDEKS KETERSEDIAAN PRODUK (TAB 6)
+# ================================
+AVAILABILITY_CHANGES = ('Baru', 'Restock', 'Hilang')
+
+@diagnostic_stage("indeks_ketersediaan")
+def build_availability_index(df_filtered):
+    """
+    Satu pass grouped atas baris Tersedia: untuk setiap (Toko, Nama Produk) minggu pertama & terakhir
+    tersedia, plus matriks boolean keberadaan [produk x minggu]. Cukup untuk menjawab produk baru,
+    hilang dan restock antara dua minggu mana pun tanpa memindai ulang df_filtered.
+    """
+    weeks = pd.DatetimeIndex(df_filtered['Minggu'].unique()).sort_values()
+    available = df_filtered.loc[df_filtered['Status'] == 'Tersedia', ['Toko', 'Nama Produk', 'Minggu']]
+    grouped = available.groupby(['Toko', 'Nama Produk'], observed=True)['Minggu']
+    seen = grouped.agg(['min', 'max'])
+    presence = np.zeros((len(seen), len(weeks)), dtype=bool)
+    presence[grouped.ngroup().to_numpy(), weeks.get_indexer(available['Minggu'])] = True
+    return {
+        'weeks': weeks,
+        'toko': seen.index.get_level_values('Toko').astype(object).to_numpy(),
+        'nama_produk': seen.index.get_level_values('Nama Produk').astype(object).to_numpy(),
+        'first_seen': seen['min'].to_numpy(), 'last_seen': seen['max'].to_numpy(),
+        'presence': presence,
+    }
+
+def availability_changes(index, week_a, week_b, weekly_rows=None):
+    """
+    Perubahan ketersediaan dari minggu A ke minggu B untuk semua toko sekaligus:
+      - 'Baru'    : tersedia di B, belum pernah tersedia sampai minggu A (first_seen > A)
+      - 'Restock' : tersedia di B, tidak tersedia di A, tetapi pernah tersedia sebelum A
+      - 'Hilang'  : tersedia di A, tidak tersedia di B
+    Baru + Restock = "tersedia di B tetapi tidak di A". Jika `weekly_rows` (latest_entries_weekly)
+    diberikan, detail baris (Harga, Stok, Brand) diambil dari minggu B (Baru/Restock) atau A (Hilang).
+    """
+    weeks, presence = index['weeks'], index['presence']
+    in_a, in_b = presence[:, weeks.get_loc(week_a)], presence[:, weeks.get_loc(week_b)]
+    appeared = in_b & ~in_a
+    is_new = appeared & (index['first_seen'] > np.datetime64(week_a))
+    change = np.select([is_new, appeared, in_a & ~in_b], list(AVAILABILITY_CHANGES), default='')
+    keep = change != ''
+    changes = pd.DataFrame({
+        'Toko': index['toko'][keep], 'Nama Produk': index['nama_produk'][keep], 'Perubahan': change[keep],
+        'Pertama Tersedia': index['first_seen'][keep], 'Terakhir Tersedia': index['last_seen'][keep],
+    })
+    changes['Minggu'] = np.where(changes['Perubahan'] == 'Hilang', np.datetime64(week_a), np.datetime64(week_b))
+    changes['Minggu'] = changes['Minggu'].astype('datetime64[ns]')
+    if weekly_rows is not None and not changes.empty:
+        detail_cols = [col for col in ('Harga', 'Stok', 'Brand') if col in weekly_rows.columns]
+        rows = weekly_rows.loc[weekly_rows['Minggu'].isin([week_a, week_b]), ['Toko', 'Nama Produk', 'Minggu'] + detail_cols]
+        rows = rows.astype({'Toko': object, 'Nama Produk': object})
+        changes = changes.merge(rows, on=['Toko', 'Nama Produk', 'Minggu'], how='left')
+    return changes.sort_values(['Toko', 'Perubahan', 'Nama Produk'], kind='stable').reset_index(drop=True)
+
+# ================================
+# TABEL PERBANDINGAN HARGA (TAB 2)
+# ================================
+@diagnostic_stage("perbandingan_harga")
+def build_price_comparison(derived, matches_df, score_cutoff):
+    """
+    Prahitung tab Perbandingan Harga untuk seluruh katalog toko sendiri (sekali per versi data,
+    rentang tanggal & cutoff). Return dict:
+      - 'summary' : satu baris per produk toko sendiri (index = Nama Produk): harga, rata-rata harga
+                    semua toko, toko omzet tertinggi, ready/habis di kompetitor, penawaran termurah,
+                    selisih & persentil harga (0 = kita termurah, 100 = semua kompetitor lebih murah)
+      - 'offers'  : {Nama Produk: DataFrame penawaran kompetitor yang cocok, urut skor} untuk lookup O(1)
+      - 'total_competitor_stores'
+    """
+    my_latest = derived['my_latest_products'].drop_duplicates('Nama Produk')
+    names = my_latest['Nama Produk'].astype(object)
+    summary = pd.DataFrame({
+        'Brand': my_latest['Brand'].astype(object).to_numpy() if 'Brand' in my_latest.columns else None,
+        'Harga': my_latest['Harga'].to_numpy(np.int64),
+        'Terjual per Bulan': my_latest.get('Terjual per Bulan', pd.Series(0, index=my_latest.index)).fillna(0).to_numpy(np.int64),
+        'Omzet': my_latest['Omzet'].fillna(0).to_numpy(np.int64),
+    }, index=pd.Index(names.to_numpy(), name='Nama Produk'))
+
+    # Rata-rata harga & toko omzet tertinggi dari semua kemunculan nama ini di rentang terpilih
+    df_filtered = derived['df_filtered']
+    occurrences = df_filtered[df_filtered['Nama Produk'].isin(summary.index)]
+    if not occurrences.empty:
+        by_name = occurrences.groupby(occurrences['Nama Produk'].astype(object))
+        top_rows = occurrences.loc[by_name['Omzet'].idxmax()]
+        summary['Harga Rata-Rata'] = by_name['Harga'].mean()
+        summary['Toko Omzet Tertinggi'] = pd.Series(top_rows['Toko'].astype(object).to_numpy(), index=top_rows['Nama Produk'].astype(object).to_numpy())
+        summary['Omzet Tertinggi'] = pd.Series(top_rows['Omzet'].to_numpy(), index=top_rows['Nama Produk'].astype(object).to_numpy())
+    else:
+        summary['Harga Rata-Rata'], summary['Toko Omzet Tertinggi'], summary['Omzet Tertinggi'] = np.nan, None, np.nan
+
+    competitor_latest = derived['competitor_latest_overall']
+    total_competitor_stores = derived['competitor_df']['Toko'].nunique()
+    comp_details = pd.DataFrame({
+        'Produk Kompetitor': competitor_latest['Nama Produk'].astype(object).to_numpy(),
+        'Toko Kompetitor': competitor_latest['Toko'].astype(object).to_numpy(),
+        'Terjual per Bulan': competitor_latest['Terjual per Bulan'].fillna(0).to_numpy(np.int64),
+        'Omzet': competitor_latest['Omzet'].fillna(0).to_numpy(np.int64),
+        'Status': competitor_latest['Status'].astype(object).to_numpy(),
+    }).drop_duplicates(['Produk Kompetitor', 'Toko Kompetitor'])
+
+    offers = pd.DataFrame(columns=['Produk Toko Saya', 'Produk Kompetitor', 'Toko Kompetitor', 'Harga Kompetitor', 'Skor Kemiripan'])
+    if matches_df is not None and not matches_df.empty and set(offers.columns) <= set(matches_df.columns):
+        scores = pd.to_numeric(matches_df['Skor Kemiripan'], errors='coerce')
+        offers = matches_df.loc[(scores >= score_cutoff) & matches_df['Produk Toko Saya'].isin(summary.index), offers.columns].copy()
+        offers['Harga Kompetitor'] = pd.to_numeric(offers['Harga Kompetitor'], errors='coerce').fillna(0).astype(np.int64)
+        offers['Skor Kemiripan'] = pd.to_numeric(offers['Skor Kemiripan'], errors='coerce').astype(np.int64)
+    offers = offers.merge(comp_details[['Produk Kompetitor', 'Toko Kompetitor', 'Terjual per Bulan', 'Omzet']],
+                          on=['Produk Kompetitor', 'Toko Kompetitor'], how='left')
+    offers[['Terjual per Bulan', 'Omzet']] = offers[['Terjual per Bulan', 'Omzet']].fillna(0).astype(np.int64)
+    offers['Selisih Harga'] = offers['Harga Kompetitor'] - offers['Produk Toko Saya'].map(summary['Harga']).astype(np.int64)
+    offers = offers.sort_values('Skor Kemiripan', ascending=False, kind='stable')
+
+    # Ready = jumlah toko yang menjual (status Tersedia) salah satu nama kompetitor yang cocok
+    ready_rows = comp_details.loc[comp_details['Status'] == 'Tersedia', ['Produk Kompetitor', 'Toko Kompetitor']]
+    matched_names = offers[['Produk Toko Saya', 'Produk Kompetitor']].drop_duplicates()
+    ready = matched_names.merge(ready_rows, on='Produk Kompetitor').groupby('Produk Toko Saya')['Toko Kompetitor'].nunique()
+    summary['Ready'] = ready.reindex(summary.index).fillna(0).astype(np.int64)
+    summary['Habis'] = total_competitor_stores - summary['Ready']
+
+    grouped = offers.groupby('Produk Toko Saya', sort=False)
+    cheapest = offers.loc[grouped['Harga Kompetitor'].idxmin()] if not offers.empty else offers
+    cheapest = cheapest.set_index('Produk Toko Saya')
+    summary['Jumlah Penawaran'] = grouped.size().reindex(summary.index).fillna(0).astype(np.int64)
+    summary['Harga Termurah Kompetitor'] = pd.to_numeric(cheapest['Harga Kompetitor'].reindex(summary.index), errors='coerce')
+    summary['Toko Termurah'] = cheapest['Toko Kompetitor'].reindex(summary.index)
+    summary['Selisih vs Termurah'] = summary['Harga'] - summary['Harga Termurah Kompetitor']
+    summary['Selisih vs Termurah (%)'] = (summary['Selisih vs Termurah'] / summary['Harga Termurah Kompetitor'] * 100).round(1)
+    cheaper = (offers['Selisih Harga'] < 0).groupby(offers['Produk Toko Saya']).mean()
+    summary['Persentil Harga'] = (pd.to_numeric(cheaper.reindex(summary.index), errors='coerce') * 100).round(0)
+
+    return {
+        'summary': summary,
+        'offers': {name: frame for name, frame in grouped},
+        'total_competitor_stores': total_competitor_stores,
+    }
+
+# ================================
+# ANALISIS HPP (SHEET DATABASE)
+# ================================
+def hpp_by_sku(database_df):
+    """HPP per SKU dari sheet DATABASE: HPP (LATEST), jika kosong pakai HPP (AVERAGE). Satu baris per SKU."""
+    latest = pd.to_numeric(database_df.get('HPP (LATEST)', pd.Series(np.nan, index=database_df.index)), errors='coerce')
+    average = pd.to_numeric(database_df.get('HPP (AVERAGE)', pd.Series(np.nan, index=database_df.index)), errors='coerce')
+    hpp_data = pd.DataFrame({'SKU': database_df['SKU'], 'HPP': latest.fillna(average)})
+    hpp_data = hpp_data.dropna(subset=['SKU', 'HPP'])
+    hpp_data = hpp_data[hpp_data['SKU'] != '']
+    return hpp_data.drop_duplicates(subset=['SKU'], keep='first')
+
+@diagnostic_stage("indeks_hpp")
+def hpp_index(database_df):
+    """Indeks SKU -> HPP untuk lookup vektor; dibangun sekali per versi data."""
+    if database_df is None or database_df.empty or 'SKU' not in database_df.columns:
+        return pd.Series(dtype='float64', index=pd.Index([], name='SKU'), name='HPP')
+    return hpp_by_sku(database_df).set_index('SKU')['HPP']
+
+HPP_POSITIONS = ['Rugi', 'Untung', 'Tidak Ditemukan']
+
+def classify_hpp(rekap_df, index):
+    """
+    Satu lookup vektor SKU -> HPP untuk semua baris (boleh banyak snapshot sekaligus): tambah kolom HPP,
+    Selisih = Harga - HPP, Margin (%) = Selisih / Harga, dan Posisi HPP (Rugi / Untung / Tidak Ditemukan).
+    """
+    hpp = rekap_df['SKU'].map(index)
+    selisih = rekap_df['Harga'] - hpp
+    position = np.select([hpp.isna(), selisih < 0], ['Tidak Ditemukan', 'Rugi'], 'Untung')
+    return rekap_df.assign(
+        HPP=hpp, Selisih=selisih, **{'Margin (%)': (selisih / rekap_df['Harga'].where(rekap_df['Harga'] > 0) * 100).round(2),
+                                     'Posisi HPP': pd.Categorical(position, categories=HPP_POSITIONS)}
+    )
+
+@diagnostic_stage("merge_hpp")
+def merge_hpp(my_latest_df, database_df, index=None):
+    """Snapshot terbaru toko sendiri + HPP per SKU (semua produk tetap ada) + Selisih = Harga - HPP."""
+    return classify_hpp(my_latest_df, hpp_index(database_df) if index is None else index)
+
+HPP_TABLE_COLUMNS = ['Nama Produk', 'SKU', 'Harga', 'HPP', 'Selisih', 'Terjual per Bulan', 'Omzet']
+HPP_TABLE_NAMES = {'Rugi': 'rugi', 'Untung': 'untung', 'Tidak Ditemukan': 'tidak_ditemukan'}
+
+def hpp_tables(merged_df):
+    """Tiga tabel tampilan HPP dari merge_hpp, dipisah sekali lewat kolom Posisi HPP."""
+    groups = dict(tuple(merged_df.groupby('Posisi HPP', observed=False)))
+    tables = {}
+    for position, name in HPP_TABLE_NAMES.items():
+        columns = [col for col in HPP_TABLE_COLUMNS if position != 'Tidak Ditemukan' or col not in ('HPP', 'Selisih')]
+        tables[name] = groups.get(position, merged_df.iloc[:0])[columns].rename(columns={'Terjual per Bulan': 'Terjual/Bln'})
+    return tables
+
+@diagnostic_stage("margin_hpp_historis")
+def hpp_margin_history(my_rekap_df, index):
+    """
+    Margin terhadap HPP untuk semua snapshot historis toko sendiri (HPP = indeks saat ini).
+    Return {'per_sku': baris ber-HPP per Tanggal & SKU, 'mingguan': eksposur di bawah HPP per Minggu}.
+    Eksposur mingguan memakai snapshot terakhir tiap produk dalam minggu itu (sama seperti ringkasan WoW);
+    Potensi Rugi/Bulan = jumlah (HPP - Harga) x Terjual per Bulan untuk produk yang dijual di bawah HPP.
+    """
+    classified = classify_hpp(my_rekap_df[['Tanggal', 'Minggu', 'Nama Produk', 'SKU', 'Harga', 'Terjual per Bulan']], index)
+    per_sku = classified[classified['Posisi HPP'] != 'Tidak Ditemukan'].drop(columns=['Posisi HPP']).sort_values(['SKU', 'Tanggal'])
+    if classified.empty:
+        weekly = pd.DataFrame(columns=['Minggu', 'Produk di Bawah HPP', 'Produk ber-HPP', 'Potensi Rugi/Bulan'])
+        return {'per_sku': per_sku, 'mingguan': weekly}
+    weekly_latest = classified.loc[classified.groupby(['Minggu', 'Nama Produk'], observed=True)['Tanggal'].idxmax()]
+    under = weekly_latest['Posisi HPP'] == 'Rugi'
+    weekly = weekly_latest.assign(
+        under=under, has_hpp=weekly_latest['HPP'].notna(),
+        exposure=(-weekly_latest['Selisih'] * weekly_latest['Terjual per Bulan']).where(under, 0),
+    ).groupby('Minggu').agg(**{
+        'Produk di Bawah HPP': ('under', 'sum'), 'Produk ber-HPP': ('has_hpp', 'sum'), 'Potensi Rugi/Bulan': ('exposure', 'sum'),
+    }).reset_index()
+    return {'per_sku': per_sku, 'mingguan': weekly}
+
+# ================================
+# EKSPOR BERTAHAP (CSV / PARQUET / XLSX)
+# ================================
+# Frame ditulis per potongan `chunk_rows` baris langsung ke buffer biner hasil, jadi tidak ada salinan
+# teks CSV / workbook utuh di samping DataFrame-nya; XLSX ditulis baris per baris (constant_memory /
+# write_only). Hasilnya bytes karena st.download_button hanya menerima bytes / BytesIO / file biasa.
+EXPORT_CHUNK_ROWS = 50_000
+EXPORT_FORMATS = {
+    'CSV': ('csv', 'text/csv'),
+    'Parquet': ('parquet', 'application/vnd.apache.parquet'),
+    'XLSX': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
+XLSX_MAX_ROWS = 1_048_576  # termasuk baris header
+XLSX_ENGINES = ('xlsxwriter', 'openpyxl')  # opsional; tanpa keduanya XLSX tidak ditawarkan
+
+def xlsx_engine():
+    return next((engine for engine in XLSX_ENGINES if importlib.util.find_spec(engine) is not None), None)
+
+def export_formats():
+    """Format ekspor yang bisa dipakai di lingkungan ini."""
+    return [name for name in EXPORT_FORMATS if name != 'XLSX' or xlsx_engine() is not None]
+
+def _chunks(df, chunk_rows):
+    for start in range(0, max(len(df), 1), chunk_rows):
+        yield start, df.iloc[start:start + chunk_rows]
+
+def _export_csv(df, out, chunk_rows):
+    for start, chunk in _chunks(df, chunk_rows):
+        out.write(chunk.to_csv(index=False, header=start == 0).encode('utf-8'))
+
+def _parquet_schema(df):
+    # Skema dari seluruh frame (bukan potongan pertama); kolom object yang tak bisa ditebak tipenya
+    # (mis. kosong semua) dijadikan string. Categorical tetap dictionary (kategori sama di semua potongan).
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    for i, field in enumerate(schema):
+        if pa.types.is_null(field.type) and df[field.name].dtype == object:
+            schema = schema.set(i, field.with_type(pa.string()))
+    return schema
+
+def _export_parquet(df, out, chunk_rows):
+    schema = _parquet_schema(df)
+    writer = pq.ParquetWriter(out, schema)
+    try:
+        for _, chunk in _chunks(df, chunk_rows):
+            writer.write_table(pa.Table.from_pandas(chunk, preserve_index=False, schema=schema))
+    finally:
+        writer.close()
+
+def _export_xlsx(df, out, chunk_rows, sheet_name='Data'):
+    if len(df) + 1 > XLSX_MAX_ROWS:
+        raise ValueError(f"{len(df):,} baris melebihi batas XLSX ({XLSX_MAX_ROWS - 1:,}); pakai CSV atau Parquet.")
+    engine = xlsx_engine()
+    if engine is None: raise ValueError("XLSX butuh paket xlsxwriter atau openpyxl.")
+    # Baris per baris (bukan pd.ExcelWriter, yang menulis per kolom dan menahan seluruh workbook di memori)
+    rows = (row for _, chunk in _chunks(df, chunk_rows)
+            for row in chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None))
+    if engine == 'xlsxwriter':
+        import xlsxwriter
+        workbook = xlsxwriter.Workbook(out, {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd'})
+        try:
+            worksheet = workbook.add_worksheet(sheet_name)
+            worksheet.write_row(0, 0, [str(col) for col in df.columns])
+            for row_number, row in enumerate(rows, start=1): worksheet.write_row(row_number, 0, row)
+        finally:
+            workbook.close()
+    else:
+        import openpyxl
+        workbook = openpyxl.Workbook(write_only=True)
+        worksheet = workbook.create_sheet(sheet_name)
+        worksheet.append([str(col) for col in df.columns])
+        for row in rows: worksheet.append(row)
+        workbook.save(out)
+
+EXPORT_WRITERS = {'csv': _export_csv, 'parquet': _export_parquet, 'xlsx': _export_xlsx}
+
+@diagnostic_stage("ekspor")
+def export_frame(df, fmt, chunk_rows=EXPORT_CHUNK_ROWS):
+    """
+    Tulis `df` ke format EXPORT_FORMATS[fmt] secara bertahap. Return bytes yang bisa langsung diberikan
+    ke st.download_button (juga sebagai hasil callable untuk unduhan tertunda) atau disimpan ke disk.
+    """
+    extension, _ = EXPORT_FORMATS[fmt]
+    with io.BytesIO() as out:
+        EXPORT_WRITERS[extension](df, out, chunk_rows)
+        return out.getvalue()
+
+# ================================
+# KLIEN SHEETS LOKAL (CSV / JSON)
+# ================================
+# Pengganti gspread untuk uji & proses offline. Hanya subset API yang dipakai pipeline ini:
+# open_by_key, worksheets, worksheet, add_worksheet, values_get, values_batch_get,
+# values_batch_update, batch_update (deleteDimension) serta resize/clear/add_rows/update_cells.
+# Sumber berupa folder berisi '<judul sheet>.csv' atau satu file .json {judul sheet: [baris, ...]}.
+def _column_number(letters):
+    number = 0
+    for ch in letters: number = number * 26 + ord(ch) - 64
+    return number
+
+def _split_a1(a1_range):
+    # "'Judul ''sheet'''!A5:G" -> ("Judul 'sheet'", "A5:G")
+    if a1_range.startswith("'"):
+        i = 1
+        while i < len(a1_range):
+            if a1_range[i] == "'":
+                if a1_range[i + 1:i + 2] == "'": i += 2; continue
+                break
+            i += 1
+        title, rest = a1_range[1:i].replace("''", "'"), a1_range[i + 1:]
+        return title, rest[1:]
+    title, _, cells = a1_range.partition('!')
+    return title, cells
+
+def _a1_bounds(cells):
+    # "A5:G" -> (baris_awal, kolom_awal, baris_akhir, kolom_akhir); None = sampai ujung sheet
+    if not cells: return 1, 1, None, None
+    parts = [re.fullmatch(r'([A-Z]*)(\d*)', part.upper()).groups() for part in cells.split(':')]
+    (c1, r1), (c2, r2) = parts[0], parts[-1]
+    return (int(r1) if r1 else 1, _column_number(c1) if c1 else 1,
+            int(r2) if r2 else None, _column_number(c2) if c2 else None)
+
+class LocalWorksheet:
+    def __init__(self, spreadsheet, sheet_id, title, values):
+        self.spreadsheet, self.id, self.title, self.values = spreadsheet, sheet_id, title, values
+        self._rows = len(values)
+
+    @property
+    def row_count(self): return max(self._rows, len(self.values), 1)
+
+    @property
+    def col_count(self): return max((len(row) for row in self.values), default=1)
+
+    def get_all_values(self): return fill_gaps(self.values) if self.values else []
+
+    def write_cell(self, row, col, value):
+        while len(self.values) < row: self.values.append([])
+        target = self.values[row - 1]
+        while len(target) < col: target.append('')
+        target[col - 1] = '' if value is None else str(value)
+
+    def clear(self):
+        self.values = []
+        self.spreadsheet.save()
+
+    def resize(self, rows=None, cols=None):
+        if rows is not None: self.values, self._rows = self.values[:rows], rows
+        if cols is not None: self.values = [row[:cols] for row in self.values]
+        self.spreadsheet.save()
+
+    def add_rows(self, rows):
+        self._rows = self.row_count + rows
+
+    def update_cells(self, cell_list, value_input_option=None):
+        for cell in cell_list: self.write_cell(cell.row, cell.col, cell.value)
+        self.spreadsheet.save()
+
+LOCAL_BATCH_REQUESTS = {'deleteDimension': '_delete_dimension'}   # jenis request batch_update -> metode LocalSpreadsheet
+
+class LocalSpreadsheet:
+    def __init__(self, path):
+        self.path, self.title = path, os.path.basename(os.path.normpath(path))
+        if path.endswith('.json'):
+            with open(path, encoding='utf-8') as f: sheets = json.load(f)
+        else:
+            sheets = {}
+            for filename in sorted(os.listdir(path)):
+                if not filename.endswith('.csv'): continue
+                with open(os.path.join(path, filename), encoding='utf-8', newline='') as f:
+                    sheets[filename[:-4]] = list(csv.reader(f))
+        self._sheets = {title: LocalWorksheet(self, i, title, [[str(v) for v in row] for row in rows])
+                        for i, (title, rows) in enumerate(sheets.items())}
+
+    def save(self):
+        if self.path.endswith('.json'):
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({title: ws.values for title, ws in self._sheets.items()}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            return
+        for title, ws in self._sheets.items():
+            with open(os.path.join(self.path, title + '.csv'), 'w', encoding='utf-8', newline='') as f:
+                csv.writer(f).writerows(ws.values)
+
+    def worksheets(self): return list(self._sheets.values())
+
+    def worksheet(self, title):
+        if title not in self._sheets: raise gspread.exceptions.WorksheetNotFound(title)
+        return self._sheets[title]
+
+    def add_worksheet(self, title, rows, cols):
+        self._sheets[title] = LocalWorksheet(self, len(self._sheets), title, [])
+        self.save()
+        return self._sheets[title]
+
+    def values_get(self, range_name, params=None):
+        title, cells = _split_a1(range_name)
+        row1, col1, row2, col2 = _a1_bounds(cells)
+        rows = [[v for v in row[col1 - 1:col2]] for row in self.worksheet(title).values[row1 - 1:row2]]
+        # Seperti API: sel kosong di ujung baris dan baris kosong di ujung range tidak dikirim
+        rows = [_trim_row(row) for row in rows]
+        while rows and not rows[-1]: rows.pop()
+        return {'range': range_name, 'values': rows} if rows else {'range': range_name}
+
+    def values_batch_get(self, ranges, params=None):
+        return {'valueRanges': [self.values_get(range_name, params) for range_name in ranges]}
+
+    def values_batch_update(self, body):
+        for item in body['data']:
+            title, cells = _split_a1(item['range'])
+            ws = self.worksheet(title)
+            row1, col1, _, _ = _a1_bounds(cells)
+            for r, row in enumerate(item['values']):
+                for c, value in enumerate(row): ws.write_cell(row1 + r, col1 + c, value)
+        self.save()
+
+    def _delete_dimension(self, ws, rng):
+        if rng.get('dimension', 'ROWS') == 'ROWS':
+            del ws.values[rng['startIndex']:rng['endIndex']]
+        else:
+            for row in ws.values: del row[rng['startIndex']:rng['endIndex']]
+
+    def batch_update(self, body):
+        # Hanya jenis request yang dikirim pipeline (LOCAL_BATCH_REQUESTS); semua dicek dulu agar, seperti
+        # API, satu request yang tidak dikenal membatalkan seluruh batch tanpa perubahan sebagian.
+        sheets_by_id = {ws.id: ws for ws in self._sheets.values()}
+        for request in body['requests']:
+            unsupported = [kind for kind in request if kind not in LOCAL_BATCH_REQUESTS]
+            if unsupported:
+                raise ValueError(f"Request batch_update {', '.join(unsupported)} tidak didukung klien lokal; "
+                                 f"yang didukung: {', '.join(LOCAL_BATCH_REQUESTS)}.")
+        for request in body['requests']:
+            for kind, params in request.items():
+                getattr(self, LOCAL_BATCH_REQUESTS[kind])(sheets_by_id[params['range']['sheetId']], params['range'])
+        self.save()
+
+class FlakySheetsClient(SheetsCallProxy):
+    """
+    Klien uji offline: setiap metode API ditunda `latency` detik dan dengan peluang `error_rate`
+    melempar APIError 429 (kuota habis) sebelum dijalankan. Dipakai untuk menguji QuotaSheetsClient.
+    """
+    def __init__(self, client, error_rate=0.2, latency=0.0, seed=0):
+        super().__init__(client, self._maybe_fail)
+        self.error_rate, self.latency, self.injected = error_rate, latency, 0
+        self._random, self._lock = random.Random(seed), threading.Lock()
+
+    def _maybe_fail(self, method, func, *args, **kwargs):
+        if self.latency: time.sleep(self.latency)
+        with self._lock:
+            fail = self._random.random() < self.error_rate
+            if fail: self.injected += 1
+        if fail: raise quota_exceeded_error()
+        return func(*args, **kwargs)
+
+class LocalSheetsClient:
+    """Pengganti gspread.Client: setiap open_by_key membuka sumber lokal yang sama (kunci diabaikan)."""
+    def __init__(self, path):
+        self.path = path
+
+    def open_by_key(self, key):
+        return LocalSpreadsheet(self.path)
+
+# ================================
+# PROSES BATCH (CRON / CLI)
+# ================================
+def latest_source_rows(rekap_df):
+    """Baris terbaru per Toko & Nama Produk dari REKAP yang sudah dimuat (sumber pencocokan tanpa unduh ulang)."""
+    return rekap_df.loc[rekap_df.groupby(['Toko', 'Nama Produk'], observed=True)['Tanggal'].idxmax()].reset_index(drop=True)
+
+def run_batch(gc, spreadsheet_key, snapshot_dir, score_cutoff=91, use_blocking=True, use_pair_cache=True,
+              dry_run=False, incremental=True, match=True, notify=log_notify, progress=None):
+    """
+    Satu putaran lengkap tanpa Streamlit: sinkronkan data (inkremental bila ada snapshot),
+    cocokkan harga dari data yang baru dimuat, tulis HASIL_MATCHING, lalu perbarui snapshot
+    sehingga dashboard cukup membaca hasilnya. Return dict ringkasan (siap di-dump ke JSON).
+    """
+    started = time.perf_counter()
+    rekap_df, database_df, matches_df, data_version = load_dataset(
+        gc, spreadsheet_key, snapshot_dir, max_age_minutes=0, force_refresh=True, incremental=incremental, notify=notify
+    )
+    if rekap_df is None or rekap_df.empty or database_df is None:
+        return {'status': 'gagal', 'message': "Gagal memuat data.", 'detik': round(time.perf_counter() - started, 2)}
+    record_frame('REKAP', rekap_df); record_frame('DATABASE', database_df); record_frame('HASIL_MATCHING', matches_df)
+    summary = {
+        'status': 'sukses', 'message': "Data disinkronkan.", 'data_version': data_version,
+        'baris_rekap': len(rekap_df), 'sinkronisasi': rekap_df.attrs.get('sync_stats'),
+        'memori_rekap_mb': round(rekap_df.memory_usage(deep=True).sum() / 1e6, 2),
+        'riwayat': rekap_df.attrs.get('history_stats'), 'perubahan': rekap_df.attrs.get('change_stats'),
+        'sheet_gagal': rekap_df.attrs.get('degraded_sheets') or {},
+    }
+    if match:
+        outcome = run_price_comparison_update(
+            gc, spreadsheet_key, score_cutoff=score_cutoff, use_blocking=use_blocking,
+            pair_cache_dir=pair_cache_dir(snapshot_dir, spreadsheet_key) if use_pair_cache else None,
+            source_df=latest_source_rows(rekap_df), dry_run=dry_run, progress=progress
+        )
+        if outcome['results_df'] is not None:
+            try:
+                summary['data_version'] = replace_snapshot_matches(snapshot_dir, spreadsheet_key, outcome['results_df']) or data_version
+            except Exception as e:
+                outcome['notes'].append(f"Snapshot lokal tidak dapat diperbarui: {e}")
+        summary.update(status=outcome['status'], message=outcome['message'], penulisan=outcome['write_stats'], catatan=outcome['notes'],
+                       sheet_gagal={**summary['sheet_gagal'], **outcome['degraded_sheets']}, cache_nama=name_cache_stats())
+    summary['detik'] = round(time.perf_counter() - started, 2)
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sinkronisasi data & pembaruan HASIL_MATCHING tanpa Streamlit.")
+    parser.add_argument('--key', default=os.environ.get('SOURCE_SPREADSHEET_ID'), help="ID spreadsheet (default: $SOURCE_SPREADSHEET_ID).")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--credentials', default=os.environ.get('GOOGLE_APPLICATION_CREDENTIALS'),
+                        help="File JSON service account Google (default: $GOOGLE_APPLICATION_CREDENTIALS).")
+    source.add_argument('--local', help="Folder CSV / file JSON pengganti Google Sheets.")
+    parser.add_argument('--snapshot-dir', default=os.environ.get('SNAPSHOT_DIR', '.snapshot'))
+    parser.add_argument('--cutoff', type=int, default=91, help="Skor minimum kemiripan (80-100).")
+    parser.add_argument('--no-blocking', action='store_true', help="Bandingkan semua pasangan produk.")
+    parser.add_argument('--no-pair-cache', action='store_true', help="Skor ulang semua pasangan tanpa cache skor.")
+    parser.add_argument('--full-reload', action='store_true', help="Abaikan watermark, muat ulang semua sheet.")
+    parser.add_argument('--skip-match', action='store_true', help="Hanya sinkronkan data & snapshot.")
+    parser.add_argument('--dry-run', action='store_true', help="Hitung rencana penulisan tanpa mengubah sheet.")
+    parser.add_argument('--requests-per-minute', type=int, default=SHEETS_REQUESTS_PER_MINUTE, help="Anggaran request Sheets per menit.")
+    parser.add_argument('--max-retries', type=int, default=5, help="Batas pengulangan error sementara (429 / 5xx).")
+    parser.add_argument('--simulate-429', type=float, default=0.0, metavar='PELUANG',
+                        help="Hanya dengan --local: suntikkan error 429 dengan peluang ini per request.")
+    parser.add_argument('--simulate-latency', type=float, default=0.0, metavar='DETIK', help="Hanya dengan --local: jeda per request.")
+    parser.add_argument('--diagnostics', metavar='FILE_JSON', help="Tulis waktu per tahap, panggilan API & memori ke file JSON.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if args.local:
+        gc, key = LocalSheetsClient(args.local), args.key or 'local'
+        if args.simulate_429 or args.simulate_latency:
+            gc = FlakySheetsClient(gc, error_rate=args.simulate_429, latency=args.simulate_latency)
+    else:
+        if not args.key or not args.credentials:
+            parser.error("--key dan --credentials (atau --local) wajib diisi.")
+        gc, key = gspread.service_account(filename=args.credentials), args.key
+    gc = QuotaSheetsClient(gc, requests_per_minute=args.requests_per_minute, max_retries=args.max_retries)
+
+    last_logged = [-10]
+    def report(pct, text):
+        if pct - last_logged[0] >= 10 or pct == 100:
+            last_logged[0] = pct
+            logger.info("%3d%% %s", pct, text)
+
+    recorder = Diagnostics('batch') if args.diagnostics else None
+    with use_diagnostics(recorder):
+        summary = run_batch(
+            instrument_client(gc, recorder), key, args.snapshot_dir, score_cutoff=args.cutoff, use_blocking=not args.no_blocking,
+            use_pair_cache=not args.no_pair_cache, dry_run=args.dry_run, incremental=not args.full_reload,
+            match=not args.skip_match, progress=report
+        )
+    summary['kuota_sheets'] = gc.stats_snapshot()
+    if recorder is not None:
+        with open(args.diagnostics, 'w', encoding='utf-8') as f:
+            json.dump(recorder.to_dict(), f, indent=2, ensure_ascii=False)
+    print(json.dumps(summary, indent=2, ensure_ascii=False, default=str))
+    return 1 if summary['status'] == 'gagal' else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
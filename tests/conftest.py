@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(TESTS_DIR), TESTS_DIR]
+
+from benchmark import generate_sheets, write_sheets
+
+
+@pytest.fixture
+def sheets_path(tmp_path):
+    """Spreadsheet sintetis kecil (3 toko x 40 produk x 4 hari) sebagai file JSON untuk LocalSheetsClient."""
+    return write_sheets(generate_sheets(n_stores=3, n_products=40, n_days=4, seed=1), str(tmp_path / 'sheets.json'))
@@ -0,0 +1,57 @@
+"""Klien & jam palsu bersama untuk uji offline."""
+from pipeline import LocalSheetsClient, LocalSpreadsheet, QuotaSheetsClient, quota_exceeded_error
+
+
+class FakeClock:
+    """Jam palsu untuk QuotaSheetsClient: waktu hanya maju lewat sleep, jadi uji tidak benar-benar menunggu."""
+    def __init__(self):
+        self.now, self.sleeps = 0.0, []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def quota_client(client, clock, **kwargs):
+    return QuotaSheetsClient(client, sleep=clock.sleep, clock=clock, seed=0, **kwargs)
+
+
+class ExhaustedSpreadsheet(LocalSpreadsheet):
+    """Satu sheet yang selalu ditolak kuota (429), baik lewat batch maupun per range."""
+    failing = 'ABDITAMA - REKAP - READY'
+
+    def values_get(self, range_name, params=None):
+        if self.failing in range_name: raise quota_exceeded_error()
+        return super().values_get(range_name, params)
+
+    def values_batch_get(self, ranges, params=None):
+        if any(self.failing in range_name for range_name in ranges): raise quota_exceeded_error()
+        return super().values_batch_get(ranges, params)
+
+
+class ExhaustedSheetsClient(LocalSheetsClient):
+    def open_by_key(self, key):
+        return ExhaustedSpreadsheet(self.path)
+
+
+class RecordingSpreadsheet(LocalSpreadsheet):
+    """Mencatat setiap range yang dibaca, untuk memastikan sinkronisasi hanya mengambil delta."""
+    def __init__(self, path, ranges):
+        super().__init__(path)
+        self.ranges = ranges
+
+    def values_get(self, range_name, params=None):
+        self.ranges.append(range_name)
+        return super().values_get(range_name, params)
+
+
+class RecordingSheetsClient(LocalSheetsClient):
+    def __init__(self, path):
+        super().__init__(path)
+        self.ranges = []
+
+    def open_by_key(self, key):
+        return RecordingSpreadsheet(self.path, self.ranges)
@@ -0,0 +1,65 @@
+import os
+import shutil
+import time
+
+import gspread
+import pytest
+from streamlit.testing.v1 import AppTest
+
+import pipeline
+from pipeline import LocalSheetsClient, read_snapshot_meta
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+
+
+@pytest.fixture
+def open_session(sheets_path, tmp_path, monkeypatch):
+    # Sesi dashboard di atas spreadsheet lokal; kunci unik per uji karena registri job & dataset se-proses
+    monkeypatch.setattr(gspread, 'service_account_from_dict', lambda info: LocalSheetsClient(sheets_path))
+    key, snapshot_dir = f"offline-{tmp_path.name}", str(tmp_path / 'snap')
+    def open_session():
+        at = AppTest.from_file(APP_PATH, default_timeout=120)
+        at.secrets['gcp_service_account'] = {}
+        at.secrets['SOURCE_SPREADSHEET_ID'], at.secrets['SNAPSHOT_DIR'] = key, snapshot_dir
+        at.run()
+        if not at.session_state['data_loaded']: at.button[0].click().run()
+        return at
+    open_session.key, open_session.snapshot_dir = key, snapshot_dir
+    return open_session
+
+def wait_for_publication(at, seq, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        at.run()
+        if 'matches_seq' in at.session_state and at.session_state['matches_seq'] >= seq: return
+        time.sleep(0.2)
+    raise AssertionError("hasil job tidak dipublikasikan")
+
+
+def test_background_update_is_adopted_by_every_session_without_resaving(open_session, monkeypatch):
+    first, second = open_session(), open_session()
+    assert not first.exception and first.session_state['dataset'] is second.session_state['dataset']
+    saves = []
+    monkeypatch.setattr(pipeline, 'save_snapshot', lambda *args, **kwargs: saves.append(args))
+
+    next(b for b in first.sidebar.button if b.label == "Jalankan Pembaruan Manual").click().run()
+    wait_for_publication(first, 1); wait_for_publication(second, 1)
+    dataset = first.session_state['dataset']
+    assert dataset is second.session_state['dataset']
+    assert dataset.version == read_snapshot_meta(open_session.snapshot_dir, open_session.key)['data_version']
+    assert saves == []   # snapshot hanya diperbarui job (replace_snapshot_matches), bukan per sesi
+    assert not first.exception and not second.exception
+
+
+def test_update_without_snapshot_still_shares_one_dataset(open_session, monkeypatch):
+    first, second = open_session(), open_session()
+    base_version = first.session_state['dataset'].version
+    shutil.rmtree(open_session.snapshot_dir)   # snapshot hilang / tidak bisa ditulis: job tidak punya data_version
+    saves = []
+    monkeypatch.setattr(pipeline, 'save_snapshot', lambda *args, **kwargs: saves.append(args))
+
+    next(b for b in first.sidebar.button if b.label == "Jalankan Pembaruan Manual").click().run()
+    wait_for_publication(first, 1); wait_for_publication(second, 1)
+    dataset = first.session_state['dataset']
+    assert dataset is second.session_state['dataset'] and dataset.version.startswith(f"{base_version}+")
+    assert saves == [] and read_snapshot_meta(open_session.snapshot_dir, open_session.key) is None
@@ -0,0 +1,28 @@
+import json
+import os
+
+import pandas as pd
+
+from benchmark import generate_sheets, run_benchmarks, write_sheets
+from pipeline import MATCHING_SHEET_NAME, LocalSheetsClient, load_all_data
+
+
+def test_generated_sheets_are_deterministic_and_loadable(tmp_path):
+    sheets = generate_sheets(n_stores=3, n_products=30, n_days=3, seed=5)
+    assert sheets == generate_sheets(n_stores=3, n_products=30, n_days=3, seed=5)
+    assert sheets != generate_sheets(n_stores=3, n_products=30, n_days=3, seed=6)
+    for path in (str(tmp_path / 'sheets.json'), str(tmp_path / 'csv')):
+        rekap_df, database_df, matches_df = load_all_data(LocalSheetsClient(write_sheets(sheets, path)), 'offline')
+        assert set(rekap_df['Toko'].astype(str)) == {'DB KLIK', 'ABDITAMA', 'LEVEL99'}
+        assert rekap_df['Tanggal'].dt.normalize().nunique() == 3 and rekap_df['Harga'].notna().all()
+        assert len(database_df) > 0 and len(matches_df) == len(sheets[MATCHING_SHEET_NAME]) - 1
+
+
+def test_run_benchmarks_writes_every_stage(tmp_path):
+    out_dir = str(tmp_path / 'hasil')
+    run_benchmarks([(2, 20, 8)], repeat=1, out_dir=out_dir, progress=lambda text: None)
+    with open(os.path.join(out_dir, 'results.json'), encoding='utf-8') as f: report = json.load(f)
+    stages = [row['tahap'] for row in report['hasil']]
+    assert {'muat_data (klien lokal)', 'pencocokan_penuh', 'pencocokan_blocking', 'deteksi_perubahan_inkremental'} <= set(stages)
+    assert all(row['detik_min'] <= row['detik_median'] <= row['detik_maks'] for row in report['hasil'])
+    assert pd.read_csv(os.path.join(out_dir, 'results.csv'))['tahap'].tolist() == stages
@@ -0,0 +1,60 @@
+import io
+
+import pandas as pd
+import pytest
+from streamlit.runtime.download_data_util import convert_data_to_bytes_and_infer_mime
+
+from pipeline import export_formats, export_frame, xlsx_engine
+
+
+def frame():
+    return pd.DataFrame({
+        'Tanggal': pd.to_datetime(['2025-01-01', '2025-01-02', '2025-01-03', '2025-01-04', '2025-01-05']),
+        'Toko': pd.Categorical(['A', 'B', 'A', 'B', 'A']),
+        'Harga': [1_500_000, 25_000_000, 3, 4, 2_500_000_000],
+        'Produk Toko Saya': [None, None, None, 'KEYBOARD X', None],   # kosong di potongan pertama
+        'Margin (%)': [1.5, None, -2.0, 0.0, 10.25],
+    })
+
+def read_back(data, fmt):
+    if fmt == 'CSV': return pd.read_csv(io.BytesIO(data), parse_dates=['Tanggal'])
+    if fmt == 'Parquet': return pd.read_parquet(io.BytesIO(data))
+    return pd.read_excel(io.BytesIO(data))
+
+
+@pytest.mark.parametrize('fmt', ['CSV', 'Parquet', 'XLSX'])
+def test_export_round_trip_in_chunks(fmt):
+    if fmt not in export_formats(): pytest.skip("xlsxwriter / openpyxl tidak terpasang")
+    df = frame()
+    data = export_frame(df, fmt, chunk_rows=2)
+    back = read_back(data, fmt)
+    assert list(back.columns) == list(df.columns) and len(back) == len(df)
+    assert back['Harga'].tolist() == df['Harga'].tolist()
+    assert back['Toko'].astype(str).tolist() == df['Toko'].astype(str).tolist()
+    assert back['Produk Toko Saya'].tolist()[3] == 'KEYBOARD X' and back['Produk Toko Saya'].isna().sum() == 4
+    assert back['Margin (%)'].equals(df['Margin (%)'])
+    assert (pd.to_datetime(back['Tanggal']) == df['Tanggal']).all()
+
+
+@pytest.mark.parametrize('fmt', ['CSV', 'Parquet'])
+def test_deferred_download_data_is_accepted_by_streamlit(fmt):
+    # Hasil callable st.download_button lewat konversi yang sama dengan Streamlit
+    deferred = lambda: export_frame(frame(), fmt, chunk_rows=2)
+    data, _ = convert_data_to_bytes_and_infer_mime(deferred(), unsupported_error=TypeError("unsupported"))
+    assert data == export_frame(frame(), fmt, chunk_rows=2) and len(data) > 0
+
+
+def test_empty_frame_exports_header_only():
+    back = read_back(export_frame(frame().iloc[0:0], 'Parquet'), 'Parquet')
+    assert back.empty and list(back.columns) == list(frame().columns)
+
+
+def test_xlsx_engines_write_same_cells(monkeypatch):
+    pytest.importorskip('xlsxwriter'); pytest.importorskip('openpyxl')
+    import pipeline
+    outputs = {}
+    for engine in ('xlsxwriter', 'openpyxl'):
+        monkeypatch.setattr(pipeline, 'xlsx_engine', lambda engine=engine: engine)
+        outputs[engine] = read_back(export_frame(frame(), 'XLSX', chunk_rows=2), 'XLSX')
+    pd.testing.assert_frame_equal(outputs['xlsxwriter'], outputs['openpyxl'])
+    assert xlsx_engine() in ('xlsxwriter', 'openpyxl')
@@ -0,0 +1,120 @@
+import pandas as pd
+
+from pipeline import (
+    HISTORY_COLUMNS, append_history, change_feed, detect_changes, hpp_index, hpp_margin_history, query_history,
+)
+
+
+def rekap(rows, sku=None):
+    df = pd.DataFrame(rows, columns=['Tanggal', 'Toko', 'Status', 'Nama Produk', 'Harga'])
+    df['Tanggal'] = pd.to_datetime(df['Tanggal'])
+    df['Terjual per Bulan'] = 3
+    df['SKU'] = sku
+    return df
+
+DAY1 = [('2025-01-01', 'A', 'Tersedia', 'X', 120), ('2025-01-01', 'A', 'Tersedia', 'Y', 50)]
+DAY2 = [('2025-01-02', 'A', 'Tersedia', 'X', 100), ('2025-01-02', 'A', 'Tersedia', 'Y', 50)]
+
+
+# ================================
+# RIWAYAT: BATAS HARI TERAKHIR
+# ================================
+def test_append_is_idempotent_and_only_adds_new_days(tmp_path):
+    path = str(tmp_path / 'history.sqlite')
+    assert append_history(path, rekap(DAY1))['Total baris riwayat'] == 2
+    assert append_history(path, rekap(DAY1))['Total baris riwayat'] == 2
+    stats = append_history(path, rekap(DAY1 + DAY2))
+    assert stats['Total baris riwayat'] == 4 and stats['Baris hari terakhir diganti'] == 2
+
+
+def test_last_day_edit_with_same_row_count_is_rewritten(tmp_path):
+    path = str(tmp_path / 'history.sqlite')
+    append_history(path, rekap(DAY1 + DAY2))
+    edited = DAY2[:1] + [('2025-01-02', 'A', 'Tersedia', 'Y', 45)]
+    append_history(path, rekap(DAY1 + edited))
+    history = query_history(path)
+    assert history.loc[history['Tanggal'] == '2025-01-02', 'Harga'].tolist() == [100, 45]
+    assert len(history) == 4
+
+
+def test_earlier_days_survive_sheet_trimming(tmp_path):
+    path = str(tmp_path / 'history.sqlite')
+    append_history(path, rekap(DAY1 + DAY2))
+    # Sheet dipangkas (hari pertama hilang) dan hari kedua berubah: hari pertama tetap di riwayat
+    append_history(path, rekap([('2025-01-02', 'A', 'Tersedia', 'X', 99)]))
+    history = query_history(path)
+    assert history.loc[history['Tanggal'] == '2025-01-01', 'Harga'].tolist() == [120, 50]
+    assert history.loc[history['Tanggal'] == '2025-01-02', 'Harga'].tolist() == [99]
+
+
+# ================================
+# RIWAYAT: SKEMA KOLOM STABIL
+# ================================
+def test_query_keeps_all_columns_even_when_empty_in_window(tmp_path):
+    path = str(tmp_path / 'history.sqlite')
+    append_history(path, rekap(DAY1 + DAY2))   # toko tanpa SKU
+    history = query_history(path, '2025-01-02', '2025-01-02', stores=('A',))
+    assert set(HISTORY_COLUMNS) <= set(history.columns)
+    assert history['SKU'].isna().all() and history['Brand'].astype(str).tolist() == ['X', 'Y']
+    margin = hpp_margin_history(history, hpp_index(pd.DataFrame({'SKU': ['S1'], 'HPP (LATEST)': [10]})))
+    assert margin['per_sku'].empty
+
+    empty = query_history(path, '2030-01-01', '2030-01-02')
+    assert empty.empty and set(HISTORY_COLUMNS) <= set(empty.columns)
+
+
+# ================================
+# UMPAN PERUBAHAN KOMPETITOR
+# ================================
+CHANGE_DAYS = [
+    [('2025-01-01', 'B', 'Tersedia', 'X', 100), ('2025-01-01', 'B', 'Habis', 'Y', 50), ('2025-01-01', 'DB KLIK', 'Tersedia', 'M', 10)],
+    [('2025-01-02', 'B', 'Tersedia', 'X', 90), ('2025-01-02', 'B', 'Tersedia', 'Y', 50), ('2025-01-02', 'B', 'Tersedia', 'Z', 10),
+     ('2025-01-02', 'DB KLIK', 'Tersedia', 'M', 12)],
+    [('2025-01-03', 'B', 'Tersedia', 'X', 95), ('2025-01-03', 'B', 'Habis', 'Y', 50), ('2025-01-03', 'B', 'Tersedia', 'Z', 10)],
+]
+EXPECTED_EVENTS = [
+    ('2025-01-02', 'X', 'Harga Turun'), ('2025-01-02', 'Y', 'Restock'), ('2025-01-02', 'Z', 'Listing Baru'),
+    ('2025-01-03', 'X', 'Harga Naik'), ('2025-01-03', 'Y', 'Stok Habis'),
+]
+
+def events(feed):
+    return sorted(zip(feed['Tanggal'].dt.strftime('%Y-%m-%d'), feed['Produk Kompetitor'], feed['Perubahan'].astype(str)))
+
+
+def test_change_feed_detects_events_for_competitors_only(tmp_path):
+    path = str(tmp_path / 'history.sqlite')
+    detect_changes(path, rekap(sum(CHANGE_DAYS, [])))
+    feed = change_feed(path)
+    assert events(feed) == EXPECTED_EVENTS   # hari pertama hanya kondisi awal; toko sendiri tidak masuk
+    drop = feed[feed['Perubahan'] == 'Harga Turun'].iloc[0]
+    assert (drop['Harga Lama'], drop['Harga Baru'], drop['Perubahan Harga (%)']) == (100, 90, -10.0)
+    assert events(change_feed(path, start_date='2025-01-03', kinds=('Harga Naik',))) == [('2025-01-03', 'X', 'Harga Naik')]
+
+
+def test_incremental_detection_equals_one_pass(tmp_path):
+    path = str(tmp_path / 'history.sqlite')
+    seen = []
+    for day in range(1, len(CHANGE_DAYS) + 1):
+        seen = sum(CHANGE_DAYS[:day], [])
+        detect_changes(path, rekap(seen))
+        detect_changes(path, rekap(seen))   # dipanggil ulang tanpa baris baru: tidak ada event ganda
+    assert events(change_feed(path)) == EXPECTED_EVENTS
+
+
+def test_provisional_last_day_is_recomputed(tmp_path):
+    path = str(tmp_path / 'history.sqlite')
+    # Hari 2 baru sebagian dan harga X kemudian diedit: event hari itu dihitung ulang, bukan ditambah
+    detect_changes(path, rekap(CHANGE_DAYS[0] + [('2025-01-02', 'B', 'Tersedia', 'X', 120)]))
+    assert events(change_feed(path)) == [('2025-01-02', 'X', 'Harga Naik')]
+    detect_changes(path, rekap(sum(CHANGE_DAYS, [])))
+    assert events(change_feed(path)) == EXPECTED_EVENTS
+
+
+def test_change_feed_joins_affected_own_products(tmp_path):
+    path = str(tmp_path / 'history.sqlite')
+    detect_changes(path, rekap(sum(CHANGE_DAYS, [])))
+    matches = pd.DataFrame({'Produk Toko Saya': ['M', 'N'], 'Harga Toko Saya': [12, 20], 'Produk Kompetitor': ['X', 'X'],
+                            'Toko Kompetitor': ['B', 'B'], 'Skor Kemiripan': [95, 90]})
+    feed = change_feed(path, matches)
+    assert sorted(feed.loc[feed['Produk Kompetitor'] == 'X', 'Produk Toko Saya']) == ['M', 'M', 'N', 'N']
+    assert feed.loc[feed['Produk Kompetitor'] == 'Y', 'Produk Toko Saya'].isna().all()
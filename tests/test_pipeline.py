@@ -0,0 +1,278 @@
+import json
+import random
+
+import pandas as pd
+import pytest
+from rapidfuzz import fuzz, process
+
+from benchmark import _name_variant, _synthetic_catalog, generate_sheets, write_sheets
+import pipeline
+from pipeline import (
+    MATCH_LIMIT, MATCH_RESULT_COLUMNS, MATCHING_SHEET_NAME, FlakySheetsClient, LocalSheetsClient, blocking_recall_report,
+    brands_by_name, build_blocking_index, latest_source_rows, load_all_data, match_catalog, name_tokens, normalize_product_name,
+    plan_matching_upsert, run_price_comparison_update, write_matching_results,
+)
+from fakes import ExhaustedSheetsClient, ExhaustedSpreadsheet, FakeClock, quota_client
+
+
+# ================================
+# KLIEN SHEETS: RETRY, ANGGARAN, SHEET GAGAL
+# ================================
+def test_retry_recovers_every_injected_429(sheets_path):
+    clock = FakeClock()
+    flaky = FlakySheetsClient(LocalSheetsClient(sheets_path), error_rate=0.3, seed=3)
+    gc = quota_client(flaky, clock, requests_per_minute=1000, max_retries=8)
+    rekap_df, database_df, matches_df = load_all_data(gc, 'offline')
+    stats = gc.stats_snapshot()
+    assert flaky.injected > 0
+    assert stats['Error 429'] == stats['Diulang'] == flaky.injected
+    assert stats['Gagal setelah retry'] == 0
+    assert rekap_df.attrs['degraded_sheets'] == {}
+    assert set(rekap_df['Toko'].astype(str)) == {'DB KLIK', 'ABDITAMA', 'LEVEL99'}
+    # Semua jeda adalah backoff (anggaran tidak pernah habis), dan semuanya lewat sleep palsu
+    assert stats['Menunggu anggaran (detik)'] == 0
+    assert sum(clock.sleeps) == pytest.approx(stats['Backoff (detik)'], abs=0.05)
+
+
+def test_request_budget_throttles_to_sliding_window(sheets_path):
+    clock = FakeClock()
+    gc = quota_client(LocalSheetsClient(sheets_path), clock, requests_per_minute=5)
+    spreadsheet = gc.open_by_key('offline')
+    for _ in range(11): spreadsheet.values_get(f"'{MATCHING_SHEET_NAME}'!A1:A2")
+    stats = gc.stats_snapshot()
+    # 12 request, 5 per menit: request ke-6 menunggu sampai t=60, ke-11 sampai t=120
+    assert stats['Request'] == 12
+    assert stats['Menunggu anggaran (detik)'] == pytest.approx(120)
+    assert clock.now == pytest.approx(120)
+
+
+def test_degraded_sheet_is_reported_and_blocks_matching_update(sheets_path):
+    clock = FakeClock()
+    gc = quota_client(ExhaustedSheetsClient(sheets_path), clock, max_retries=2)
+    rekap_df, _, _ = load_all_data(gc, 'offline')
+    degraded = rekap_df.attrs['degraded_sheets']
+    assert list(degraded) == [ExhaustedSpreadsheet.failing]
+    assert degraded[ExhaustedSpreadsheet.failing].startswith('Kuota habis (429)')
+    assert gc.stats_snapshot()['Gagal setelah retry'] >= 1
+    assert rekap_df[(rekap_df['Toko'] == 'ABDITAMA') & (rekap_df['Status'] == 'Tersedia')].empty
+
+    with open(sheets_path, encoding='utf-8') as f: before = json.load(f)[MATCHING_SHEET_NAME]
+    outcome = run_price_comparison_update(gc, 'offline', source_df=latest_source_rows(rekap_df))
+    assert outcome['status'] == 'gagal'
+    assert list(outcome['degraded_sheets']) == [ExhaustedSpreadsheet.failing]
+    with open(sheets_path, encoding='utf-8') as f: assert json.load(f)[MATCHING_SHEET_NAME] == before
+
+
+def test_update_matches_the_configured_store(sheets_path, monkeypatch):
+    monkeypatch.setattr(pipeline, 'MY_STORE_NAME', 'ABDITAMA')
+    outcome = run_price_comparison_update(LocalSheetsClient(sheets_path), 'offline', score_cutoff=85)
+    results = outcome['results_df']
+    assert outcome['status'] == 'sukses' and not results.empty
+    assert set(results['Toko Kompetitor']) <= {'DB KLIK', 'LEVEL99'} and 'DB KLIK' in set(results['Toko Kompetitor'])
+    rekap_df, _, _ = load_all_data(LocalSheetsClient(sheets_path), 'offline')
+    assert set(results['Produk Toko Saya']) <= set(rekap_df.loc[rekap_df['Toko'] == 'ABDITAMA', 'Nama Produk'].astype(str))
+
+
+# ================================
+# UPSERT HASIL_MATCHING
+# ================================
+WIDTH = len(MATCH_RESULT_COLUMNS)
+
+def match_rows(n):
+    return pd.DataFrame({
+        'Produk Toko Saya': [f"PRODUK {i}" for i in range(n)], 'Harga Toko Saya': [100_000 + i for i in range(n)],
+        'Produk Kompetitor': [f"KOMPETITOR {i}" for i in range(n)], 'Harga Kompetitor': [90_000 + i for i in range(n)],
+        'Toko Kompetitor': ['ABDITAMA'] * n, 'Skor Kemiripan': [90] * n, 'Tanggal_Update': ['2025-01-01'] * n,
+    })[MATCH_RESULT_COLUMNS]
+
+def sheet_values(results_df):
+    return [MATCH_RESULT_COLUMNS] + results_df.astype(str).to_numpy().tolist()
+
+
+def test_upsert_plan_counts_changed_reused_and_deleted_rows():
+    existing = match_rows(6)
+    updated = existing.drop(index=[1, 2]).assign(Tanggal_Update='2025-02-01')   # tanggal saja bukan perubahan
+    updated.loc[0, 'Harga Kompetitor'] = 85_000
+    updated = pd.concat([updated, match_rows(7).iloc[[6]]], ignore_index=True)
+    plan = plan_matching_upsert(sheet_values(existing), updated)
+    assert not plan['full_rewrite']
+    assert plan['stats'] == {'Baris baru': 1, 'Baris berubah': 1, 'Baris dihapus': 1, 'Baris tetap': 3, 'Sel ditulis': 2 * WIDTH}
+    # Baris sheet 2 = baris 0 (berubah); slot baris 3 (hapus) dipakai ulang untuk baris baru; baris 4 dihapus
+    assert sorted(plan['writes']) == [2, 3] and plan['deletes'] == [4]
+
+    assert plan_matching_upsert([], updated)['stats']['Sel ditulis'] == (len(updated) + 1) * WIDTH
+    assert plan_matching_upsert(sheet_values(existing), existing)['stats']['Sel ditulis'] == 0
+
+
+def test_upsert_round_trip_with_dry_run(tmp_path):
+    path = str(tmp_path / 'matching.json')
+    with open(path, 'w', encoding='utf-8') as f: json.dump({MATCHING_SHEET_NAME: sheet_values(match_rows(6))}, f)
+    updated = pd.concat([match_rows(6).drop(index=[1, 2, 3]), match_rows(8).iloc[[6]]], ignore_index=True)
+    updated.loc[0, 'Harga Kompetitor'] = 85_000
+
+    dry = write_matching_results(LocalSheetsClient(path).open_by_key('offline'), updated, dry_run=True)
+    with open(path, encoding='utf-8') as f: assert json.load(f)[MATCHING_SHEET_NAME] == sheet_values(match_rows(6))
+    assert (dry['Sel ditulis'], dry['Baris dihapus']) == (2 * WIDTH, 2)
+
+    written = write_matching_results(LocalSheetsClient(path).open_by_key('offline'), updated)
+    assert written == dry
+    with open(path, encoding='utf-8') as f: values = json.load(f)[MATCHING_SHEET_NAME]
+    stored = pd.DataFrame(values[1:], columns=values[0])
+    key = ['Produk Toko Saya', 'Produk Kompetitor', 'Toko Kompetitor']
+    assert sorted(map(tuple, stored[key].to_numpy())) == sorted(map(tuple, updated[key].to_numpy()))
+    assert stored.set_index('Produk Toko Saya').loc['PRODUK 0', 'Harga Kompetitor'] == '85000'
+
+    again = write_matching_results(LocalSheetsClient(path).open_by_key('offline'), updated)
+    assert (again['Sel ditulis'], again['Request']) == (0, 0)
+
+
+def test_upsert_writes_raw_values_and_stays_idempotent(tmp_path):
+    # Nama yang akan diubah USER_ENTERED jadi angka / tanggal / rumus harus tersimpan & terbaca apa adanya
+    path = str(tmp_path / 'matching.json')
+    with open(path, 'w', encoding='utf-8') as f: json.dump({}, f)
+    results = match_rows(3).assign(**{'Produk Kompetitor': ['0123', '1/2', '=SUM(A1)']})
+    bodies = []
+    def recording_spreadsheet():
+        spreadsheet = LocalSheetsClient(path).open_by_key('offline')
+        batch_update_values = spreadsheet.values_batch_update
+        def values_batch_update(body):
+            bodies.append(body); return batch_update_values(body)
+        spreadsheet.values_batch_update = values_batch_update
+        return spreadsheet
+
+    first = write_matching_results(recording_spreadsheet(), results)
+    assert first['Sel ditulis'] == 4 * WIDTH and {body['valueInputOption'] for body in bodies} == {'RAW'}
+    with open(path, encoding='utf-8') as f: values = json.load(f)[MATCHING_SHEET_NAME]
+    assert [row[2] for row in values[1:]] == ['0123', '1/2', '=SUM(A1)']
+    assert write_matching_results(recording_spreadsheet(), results)['Sel ditulis'] == 0
+
+
+def test_local_batch_update_rejects_unsupported_requests(tmp_path):
+    path = str(tmp_path / 'sheet.json')
+    with open(path, 'w', encoding='utf-8') as f: json.dump({'S': [['a', 'b'], ['1', '2'], ['3', '4'], ['5', '6']]}, f)
+    spreadsheet = LocalSheetsClient(path).open_by_key('offline')
+    sheet_id = spreadsheet.worksheet('S').id
+    delete_row = {'deleteDimension': {'range': {'sheetId': sheet_id, 'dimension': 'ROWS', 'startIndex': 1, 'endIndex': 2}}}
+    with pytest.raises(ValueError, match='deleteDimension'):
+        spreadsheet.batch_update({'requests': [delete_row, {'repeatCell': {}}]})
+    with open(path, encoding='utf-8') as f: assert len(json.load(f)['S']) == 4   # batch dibatalkan utuh
+
+    delete_column = {'deleteDimension': {'range': {'sheetId': sheet_id, 'dimension': 'COLUMNS', 'startIndex': 0, 'endIndex': 1}}}
+    spreadsheet.batch_update({'requests': [delete_row, delete_column]})
+    with open(path, encoding='utf-8') as f: assert json.load(f)['S'] == [['b'], ['4'], ['6']]
+
+
+# ================================
+# PENCOCOKAN KATALOG
+# ================================
+def catalog(seed=2):
+    sheets = generate_sheets(n_stores=3, n_products=60, n_days=1, seed=seed)
+    names = {}
+    for title, rows in sheets.items():
+        if 'REKAP' not in title or len(rows) < 2: continue
+        col = rows[0].index('NAMA')
+        names.setdefault(title.split(' - ')[0], []).extend(row[col] for row in rows[1:])
+    my_names = list(dict.fromkeys(names.pop('DB KLIK')))
+    competitor_names = list(dict.fromkeys(name for store_names in names.values() for name in store_names))
+    return my_names, competitor_names
+
+def extract_table(queries, choices, score_cutoff, limit=MATCH_LIMIT):
+    return [(my_pos, comp_pos, round(score, 2))
+            for my_pos, query in enumerate(queries)
+            for _, score, comp_pos in process.extract(query, choices, scorer=fuzz.token_set_ratio, score_cutoff=score_cutoff, limit=limit)]
+
+def as_rows(table):
+    return [(int(m), int(c), round(float(s), 2)) for m, c, s in table[['my_pos', 'comp_pos', 'score']].itertuples(index=False)]
+
+
+@pytest.mark.parametrize('score_cutoff', [80, 90])
+def test_match_catalog_matches_process_extract(score_cutoff):
+    my_names, competitor_names = catalog()
+    raw = match_catalog(my_names, competitor_names, score_cutoff, normalize=False, chunk_size=7)
+    assert len(raw) > 0
+    assert as_rows(raw) == extract_table(my_names, competitor_names, score_cutoff)
+    # Dengan normalisasi: sama dengan process.extract atas bentuk kanonik
+    normalized = match_catalog(my_names, competitor_names, score_cutoff, chunk_size=7)
+    assert as_rows(normalized) == extract_table([normalize_product_name(n) for n in my_names],
+                                                [normalize_product_name(n) for n in competitor_names], score_cutoff)
+
+
+MARKETING_TAGS = ['NEW', 'HOT SALE', 'BEST SELLER', 'PO', 'FREE ONGKIR', 'BARU', 'Promo Murah', '[READY STOCK]']
+
+def labelled_sample(seed=7, n_products=150):
+    # Nama katalog sendiri + dua varian kompetitor per produk (tag di depan / belakang), label = posisi produk asli
+    rnd = random.Random(seed)
+    own = [product['Nama'] for product in _synthetic_catalog(n_products, rnd)]
+    variants, labels = [], []
+    for pos, name in enumerate(own):
+        for _ in range(2):
+            variant = _name_variant(name, rnd)
+            if rnd.random() < 0.5:
+                tag = rnd.choice(MARKETING_TAGS)
+                variant = f"{tag} {variant}" if rnd.random() < 0.5 else f"{variant} {tag}"
+            variants.append(variant); labels.append(pos)
+    return own, variants, labels
+
+def top1_accuracy(own, variants, labels, **kwargs):
+    table = match_catalog(variants, own, 0, limit=1, **kwargs)
+    best = dict(zip(table['my_pos'], table['comp_pos']))
+    return sum(best.get(pos) == label for pos, label in enumerate(labels)) / len(labels)
+
+
+def test_noise_tokens_keep_identity_words():
+    assert name_tokens('[READY STOCK] Nintendo NEW 3DS XL Original Garansi Resmi') == ('NINTENDO', 'NEW', '3DS', 'XL')
+    assert name_tokens('Keyboard Hot Swap RK61 BNIB') == ('KEYBOARD', 'HOT', 'SWAP', 'RK61')
+    assert normalize_product_name('Nintendo New 3DS') != normalize_product_name('Nintendo 3DS')
+
+
+def test_restricted_noise_tokens_keep_accuracy_on_labelled_sample(monkeypatch):
+    sample = labelled_sample()
+    accuracy = top1_accuracy(*sample)
+    assert accuracy >= top1_accuracy(*sample, normalize=False) and accuracy >= 0.99
+    # Daftar lama (NEW / BARU / HOT / BEST / FREE / PO ikut dibuang) tidak lebih akurat pada sampel yang sama
+    monkeypatch.setattr(pipeline, 'NAME_NOISE_TOKENS', pipeline.NAME_NOISE_TOKENS | {'NEW', 'BARU', 'HOT', 'BEST', 'FREE', 'PO'})
+    name_tokens.cache_clear(); normalize_product_name.cache_clear()
+    try:
+        assert top1_accuracy(*sample) == accuracy
+    finally:
+        monkeypatch.undo()
+        name_tokens.cache_clear(); normalize_product_name.cache_clear()
+
+
+def test_blocked_matches_are_a_subset_of_full_matches():
+    my_names, competitor_names = catalog()
+    full = set(as_rows(match_catalog(my_names, competitor_names, 85, limit=None)))
+    blocked = set(as_rows(match_catalog(my_names, competitor_names, 85, limit=None, blocking_index=build_blocking_index(competitor_names))))
+    assert blocked and blocked <= full
+
+
+def test_brand_column_recovers_pairs_the_name_tokens_miss():
+    # Nama toko sendiri diawali jenis produk, nama kompetitor diawali merek, tanpa token model bersama:
+    # hanya kolom Brand yang menaruh keduanya di blok yang sama
+    my_names, competitor_names = ['MOUSE GAMING LOGITECH PRO'], ['LOGITECH MOUSE GAMING PRO WIRELESS', 'REXUS MOUSE MURAH']
+    source = pd.DataFrame({'Nama Produk': my_names + competitor_names, 'Brand': ['LOGITECH', 'LOGITECH', 'REXUS']})
+    my_brands, competitor_brands = brands_by_name(source, my_names), brands_by_name(source, competitor_names)
+
+    without, missed = blocking_recall_report(my_names, competitor_names, 85)
+    assert without['Recall semua pasangan >= cutoff'] == 0 and missed['Produk Kompetitor'].tolist() == [competitor_names[0]]
+    with_brands, missed = blocking_recall_report(my_names, competitor_names, 85, my_brands, competitor_brands)
+    assert with_brands['Recall semua pasangan >= cutoff'] == 1 and missed.empty
+    assert with_brands['Perbandingan dihitung (dengan blocking)'] == 1   # REXUS tetap tidak dibandingkan
+
+
+def test_blocking_keeps_every_labelled_pair(tmp_path):
+    # HASIL_MATCHING sintetis = pasangan produk yang benar-benar sama (label); blocking tidak boleh kehilangan satu pun
+    sheets = generate_sheets(n_stores=4, n_products=200, n_days=1, seed=2)
+    rekap_df, _, _ = load_all_data(LocalSheetsClient(write_sheets(sheets, str(tmp_path / 'sheets.json'))), 'offline')
+    source = latest_source_rows(rekap_df)
+    mine, competitors = source[source['Toko'] == 'DB KLIK'], source[source['Toko'] != 'DB KLIK']
+    my_names = list(dict.fromkeys(mine['Nama Produk'].astype(str)))
+    competitor_names = list(dict.fromkeys(competitors['Nama Produk'].astype(str)))
+    index = build_blocking_index(competitor_names, brands_by_name(competitors, competitor_names))
+    pairs = lambda table: {(my_names[i], competitor_names[j]) for i, j in zip(table['my_pos'], table['comp_pos'])}
+    full = match_catalog(my_names, competitor_names, 85, limit=None)
+    blocked = match_catalog(my_names, competitor_names, 85, limit=None, blocking_index=index, my_brands=brands_by_name(mine, my_names))
+
+    labelled = {(row[0], row[2]) for row in sheets[MATCHING_SHEET_NAME][1:]} & pairs(full)
+    assert len(labelled) > 100 and labelled <= pairs(blocked)
+    assert blocked.attrs['pairs_scored'] < full.attrs['pairs_scored'] / 3
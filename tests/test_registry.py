@@ -0,0 +1,64 @@
+import gc
+
+import pandas as pd
+
+from pipeline import DatasetRegistry, SessionToken, SharedDataset
+
+
+def dataset(version):
+    return SharedDataset(version, pd.DataFrame({'Harga': range(3)}), pd.DataFrame(), pd.DataFrame())
+
+def live_versions(registry):
+    gc.collect()
+    return sorted(row['Versi'] for row in registry.stats())
+
+
+# ================================
+# DATASET BERSAMA: BERBAGI & PELEPASAN VERSI LAMA
+# ================================
+def test_same_version_is_shared_between_sessions():
+    registry = DatasetRegistry()
+    first = registry.publish(dataset('v1'))
+    second = registry.publish(dataset('v1'))   # sesi lain memuat data yang sama
+    assert second is first and registry.get('v1') is first
+
+    a, b = SessionToken(), SessionToken()
+    registry.attach(first, a); registry.attach(second, b)
+    assert len(first.sessions) == 2
+
+
+def test_old_version_is_released_when_no_session_uses_it():
+    registry = DatasetRegistry()
+    def open_session(version):
+        # Seperti session state Streamlit: sesi memegang token dan dataset yang sedang dipakainya
+        session = {'token': SessionToken()}
+        session['dataset'] = registry.attach(registry.publish(dataset(version)), session['token'])
+        return session
+
+    a, b = open_session('v1'), open_session('v1')
+    assert a['dataset'] is b['dataset'] and len(a['dataset'].sessions) == 2
+    a['dataset'] = registry.attach(registry.publish(dataset('v2')), a['token'])   # sesi a pindah ke versi baru
+    assert len(b['dataset'].sessions) == 1 and len(a['dataset'].sessions) == 1
+    assert live_versions(registry) == ['v1', 'v2']   # sesi b masih memakai v1
+
+    b.clear()   # sesi b berakhir
+    assert live_versions(registry) == ['v2']
+    assert registry.get('v1') is None and len(a['dataset'].sessions) == 1
+
+
+def test_latest_version_survives_without_sessions():
+    registry = DatasetRegistry()
+    token = SessionToken()
+    registry.attach(registry.publish(dataset('v1')), token)
+    del token
+    assert live_versions(registry) == ['v1']
+    stats = registry.stats()
+    assert stats[0]['Sesi'] == 0 and stats[0]['Terbaru']
+
+
+def test_matches_only_version_reuses_rekap_frames():
+    registry = DatasetRegistry()
+    base = registry.publish(dataset('v1'))
+    updated = registry.publish(base.with_matches('v2', pd.DataFrame({'Skor Kemiripan': [90]})))
+    assert updated.df is base.df and updated.db_df is base.db_df
+    assert registry.publish(dataset(None)).version is None and registry.get(None) is None
@@ -0,0 +1,128 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+
+from pipeline import (
+    SNAPSHOT_FILES, LocalSheetsClient, compute_data_version, history_bounds, history_path, latest_source_rows,
+    load_dataset, load_snapshot, read_snapshot_meta, replace_snapshot_matches, run_price_comparison_update,
+)
+from fakes import ExhaustedSheetsClient, ExhaustedSpreadsheet, FakeClock, RecordingSheetsClient, quota_client
+
+KEY = 'offline'
+
+
+class OfflineClient:
+    def open_by_key(self, key):
+        raise AssertionError("Sheets tidak boleh dibuka selama snapshot masih dalam TTL")
+
+def snapshot_file(snapshot_dir, name):
+    return os.path.join(snapshot_dir, os.listdir(snapshot_dir)[0], name)   # satu folder per spreadsheet
+
+def age_snapshot(snapshot_dir, minutes):
+    path = snapshot_file(snapshot_dir, 'meta.json')
+    with open(path, encoding='utf-8') as f: meta = json.load(f)
+    meta['created_at'] = (datetime.now() - timedelta(minutes=minutes)).isoformat(timespec='seconds')
+    with open(path, 'w', encoding='utf-8') as f: json.dump(meta, f)
+
+
+# ================================
+# SNAPSHOT LOKAL: TTL & MUAT ULANG
+# ================================
+def test_fresh_snapshot_is_served_without_sheets(sheets_path, tmp_path):
+    snapshot_dir = str(tmp_path / 'snap')
+    rekap_df, database_df, matches_df, data_version = load_dataset(LocalSheetsClient(sheets_path), KEY, snapshot_dir, max_age_minutes=60)
+    assert data_version == compute_data_version(rekap_df, database_df, matches_df)
+
+    snap_rekap, snap_database, snap_matches, snap_version = load_dataset(OfflineClient(), KEY, snapshot_dir, max_age_minutes=60)
+    assert snap_version == data_version
+    pd.testing.assert_frame_equal(snap_rekap, rekap_df.reset_index(drop=True))
+    pd.testing.assert_frame_equal(snap_database, database_df)
+    assert len(snap_matches) == len(matches_df)
+
+
+def test_expired_snapshot_is_synced_from_sheets(sheets_path, tmp_path):
+    snapshot_dir = str(tmp_path / 'snap')
+    _, _, _, data_version = load_dataset(LocalSheetsClient(sheets_path), KEY, snapshot_dir, max_age_minutes=60)
+    age_snapshot(snapshot_dir, minutes=90)
+    assert load_snapshot(snapshot_dir, KEY, max_age_minutes=60) is None
+    assert load_snapshot(snapshot_dir, KEY, max_age_minutes=120) is not None
+
+    gc = RecordingSheetsClient(sheets_path)
+    _, _, _, synced_version = load_dataset(gc, KEY, snapshot_dir, max_age_minutes=60)
+    assert gc.ranges and synced_version == data_version   # sheet tidak berubah: versi data tetap
+    assert read_snapshot_meta(snapshot_dir, KEY)['age_minutes'] < 1
+
+
+def test_corrupt_snapshot_is_ignored(sheets_path, tmp_path):
+    snapshot_dir = str(tmp_path / 'snap')
+    load_dataset(LocalSheetsClient(sheets_path), KEY, snapshot_dir, max_age_minutes=60)
+    with open(snapshot_file(snapshot_dir, SNAPSHOT_FILES['rekap']), 'wb') as f: f.write(b'bukan parquet')
+    assert load_snapshot(snapshot_dir, KEY) is None
+    rekap_df, _, _, data_version = load_dataset(LocalSheetsClient(sheets_path), KEY, snapshot_dir, max_age_minutes=60)
+    assert data_version and not rekap_df.empty
+    assert load_snapshot(snapshot_dir, KEY) is not None
+
+
+def test_job_result_replaces_only_matches_in_snapshot(sheets_path, tmp_path):
+    # Job pembaruan menulis snapshot sekali; sesi cukup mengadopsi versi yang dikembalikan
+    snapshot_dir = str(tmp_path / 'snap')
+    assert replace_snapshot_matches(snapshot_dir, KEY, pd.DataFrame()) is None   # belum ada snapshot
+    rekap_df, database_df, matches_df, data_version = load_dataset(LocalSheetsClient(sheets_path), KEY, snapshot_dir, max_age_minutes=60)
+    meta_before = read_snapshot_meta(snapshot_dir, KEY)
+    new_matches = matches_df.head(3)
+
+    new_version = replace_snapshot_matches(snapshot_dir, KEY, new_matches)
+    assert new_version not in (None, data_version)
+    assert new_version == compute_data_version(rekap_df, database_df, new_matches)
+    meta = read_snapshot_meta(snapshot_dir, KEY)
+    assert (meta['data_version'], meta['created_at'], meta['watermarks']) == (new_version, meta_before['created_at'], meta_before['watermarks'])
+    assert meta['matches_updated_at'] is not None
+    _, _, snap_matches, _ = load_snapshot(snapshot_dir, KEY)
+    assert len(snap_matches) == 3
+
+
+# ================================
+# SNAPSHOT LOKAL: DATA DENGAN SHEET GAGAL
+# ================================
+
+
+def exhausted_client(sheets_path):
+    return quota_client(ExhaustedSheetsClient(sheets_path), FakeClock(), max_retries=1)
+
+
+def test_degraded_first_load_is_not_persisted(sheets_path, tmp_path):
+    snapshot_dir = str(tmp_path / 'snap')
+    rekap_df, _, _, data_version = load_dataset(exhausted_client(sheets_path), KEY, snapshot_dir, max_age_minutes=60)
+    assert data_version and list(rekap_df.attrs['degraded_sheets']) == [ExhaustedSpreadsheet.failing]
+    assert read_snapshot_meta(snapshot_dir, KEY) is None
+    assert not os.path.exists(history_path(snapshot_dir, KEY))
+
+
+@pytest.mark.parametrize('incremental', [True, False])
+def test_degraded_refresh_keeps_previous_snapshot_and_history(sheets_path, tmp_path, incremental):
+    snapshot_dir = str(tmp_path / 'snap')
+    good_df, _, _, good_version = load_dataset(LocalSheetsClient(sheets_path), KEY, snapshot_dir, max_age_minutes=60)
+    assert good_df.attrs['degraded_sheets'] == {}
+    meta_before = read_snapshot_meta(snapshot_dir, KEY)
+    history_before = history_bounds(history_path(snapshot_dir, KEY))
+
+    rekap_df, _, _, data_version = load_dataset(exhausted_client(sheets_path), KEY, snapshot_dir, max_age_minutes=60,
+                                                force_refresh=True, incremental=incremental)
+    assert rekap_df.attrs['degraded_sheets'] and data_version != good_version
+    meta_after = read_snapshot_meta(snapshot_dir, KEY)
+    assert (meta_after['data_version'], meta_after['created_at']) == (meta_before['data_version'], meta_before['created_at'])
+    assert history_bounds(history_path(snapshot_dir, KEY)) == history_before
+
+    # Sesi berikutnya / setelah restart membaca snapshot lengkap yang lama, bukan data yang bolong
+    snap_df, _, _, meta = load_snapshot(snapshot_dir, KEY, max_age_minutes=60)
+    assert meta['data_version'] == good_version
+    assert set(snap_df['Toko'].astype(str)) == set(good_df['Toko'].astype(str))
+
+
+def test_degraded_in_memory_data_still_blocks_matching(sheets_path, tmp_path):
+    rekap_df, _, _, _ = load_dataset(exhausted_client(sheets_path), KEY, str(tmp_path / 'snap'), max_age_minutes=60)
+    outcome = run_price_comparison_update(LocalSheetsClient(sheets_path), KEY, source_df=latest_source_rows(rekap_df))
+    assert outcome['status'] == 'gagal' and list(outcome['degraded_sheets']) == [ExhaustedSpreadsheet.failing]
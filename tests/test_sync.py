@@ -0,0 +1,75 @@
+import json
+
+import pandas as pd
+
+from pipeline import LocalSheetsClient, load_all_data, load_dataset, read_snapshot_meta
+from fakes import RecordingSheetsClient
+
+KEY = 'offline'
+SHEET = 'ABDITAMA - REKAP - READY'
+
+
+def edit_sheets(path, edit):
+    with open(path, encoding='utf-8') as f: sheets = json.load(f)
+    edit(sheets)
+    with open(path, 'w', encoding='utf-8') as f: json.dump(sheets, f, ensure_ascii=False)
+
+def new_day_rows(rows, day='05/01/2025'):
+    # Hari baru: salin baris hari terakhir dengan tanggal berikutnya
+    last_day = rows[-1][3]
+    return [row[:3] + [day] + row[4:] for row in rows[1:] if row[3] == last_day]
+
+def canonical(df):
+    df = df.astype({col: object for col in df.select_dtypes('category').columns}).astype({'Harga': float, 'Terjual per Bulan': float})
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+# ================================
+# SINKRONISASI INKREMENTAL (WATERMARK)
+# ================================
+def test_append_only_rows_are_synced_as_delta(sheets_path, tmp_path):
+    snapshot_dir = str(tmp_path / 'snap')
+    load_dataset(LocalSheetsClient(sheets_path), KEY, snapshot_dir, max_age_minutes=60)
+    rows_before = read_snapshot_meta(snapshot_dir, KEY)['watermarks'][SHEET]['rows']
+    appended = []
+    def append(sheets): appended.extend(new_day_rows(sheets[SHEET])); sheets[SHEET].extend(appended)
+    edit_sheets(sheets_path, append)
+
+    gc = RecordingSheetsClient(sheets_path)
+    rekap_df, _, _, data_version = load_dataset(gc, KEY, snapshot_dir, max_age_minutes=60, force_refresh=True)
+    assert rekap_df.attrs['sync_stats'][SHEET] == len(appended) > 0
+    assert sum(rekap_df.attrs['sync_stats'].values()) == len(appended)
+    # REKAP lama tidak diunduh ulang: sheet ini hanya dibaca header + mulai baris data terakhir
+    sheet_ranges = [r for r in gc.ranges if SHEET in r]
+    assert sorted(sheet_ranges) == sorted([f"'{SHEET}'!1:1", f"'{SHEET}'!A{rows_before + 1}:G"])
+    assert read_snapshot_meta(snapshot_dir, KEY)['watermarks'][SHEET]['rows'] == rows_before + len(appended)
+    assert read_snapshot_meta(snapshot_dir, KEY)['data_version'] == data_version
+
+    full_df, _, _ = load_all_data(LocalSheetsClient(sheets_path), KEY)
+    pd.testing.assert_frame_equal(canonical(rekap_df), canonical(full_df))
+
+
+def test_edited_last_row_falls_back_to_full_load(sheets_path, tmp_path):
+    snapshot_dir = str(tmp_path / 'snap')
+    load_dataset(LocalSheetsClient(sheets_path), KEY, snapshot_dir, max_age_minutes=60)
+    def edit_last_row(sheets):
+        appended = new_day_rows(sheets[SHEET])
+        sheets[SHEET][-1][1] = '1234500'   # baris yang sudah dimuat diedit, lalu hari baru ditambah
+        sheets[SHEET].extend(appended)
+    edit_sheets(sheets_path, edit_last_row)
+
+    rekap_df, _, _, _ = load_dataset(LocalSheetsClient(sheets_path), KEY, snapshot_dir, max_age_minutes=60, force_refresh=True)
+    assert 'sync_stats' not in rekap_df.attrs
+    full_df, _, _ = load_all_data(LocalSheetsClient(sheets_path), KEY)
+    pd.testing.assert_frame_equal(canonical(rekap_df), canonical(full_df))
+    assert (rekap_df['Harga'] == 1_234_500).sum() == 1
+    assert read_snapshot_meta(snapshot_dir, KEY)['watermarks'] == full_df.attrs['sheet_watermarks']
+
+
+def test_removed_sheet_falls_back_to_full_load(sheets_path, tmp_path):
+    snapshot_dir = str(tmp_path / 'snap')
+    load_dataset(LocalSheetsClient(sheets_path), KEY, snapshot_dir, max_age_minutes=60)
+    edit_sheets(sheets_path, lambda sheets: sheets.pop(SHEET))
+    rekap_df, _, _, _ = load_dataset(LocalSheetsClient(sheets_path), KEY, snapshot_dir, max_age_minutes=60, force_refresh=True)
+    assert 'sync_stats' not in rekap_df.attrs
+    assert rekap_df[(rekap_df['Toko'] == 'ABDITAMA') & (rekap_df['Status'] == 'Tersedia')].empty
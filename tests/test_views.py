@@ -0,0 +1,148 @@
+import numpy as np
+import pandas as pd
+
+from benchmark import generate_sheets, write_sheets
+from pipeline import (
+    LocalSheetsClient, availability_changes, build_availability_index, build_price_comparison, compact_rekap_df, derive_frames,
+    hpp_index, hpp_margin_history, hpp_tables, load_all_data, merge_hpp, normalize_rekap_df,
+)
+
+COLUMNS = ['Tanggal', 'Toko', 'Status', 'Nama Produk', 'Harga', 'Terjual per Bulan', 'SKU']
+
+
+def rekap(rows):
+    return compact_rekap_df(normalize_rekap_df(pd.DataFrame(rows, columns=COLUMNS)))
+
+
+# ================================
+# PERBANDINGAN HARGA (TAB 2)
+# ================================
+PRICE_ROWS = [
+    ('06/01/2025', 'DB KLIK', 'Tersedia', 'KB A', '110.000', 1, 'S1'),
+    ('07/01/2025', 'DB KLIK', 'Tersedia', 'KB A', '100.000', 10, 'S1'),
+    ('07/01/2025', 'DB KLIK', 'Tersedia', 'KB B', '50.000', 0, 'S2'),
+    ('07/01/2025', 'C1', 'Tersedia', 'KB A1', '90.000', 20, ''),
+    ('07/01/2025', 'C2', 'Habis', 'KB A2', '110.000', 5, ''),
+]
+PRICE_MATCHES = pd.DataFrame([
+    ('KB A', '100000', 'KB A1', '90000', 'C1', '95', '2025-01-07'),
+    ('KB A', '100000', 'KB A2', '110000', 'C2', '92', '2025-01-07'),
+    ('KB B', '50000', 'KB B1', '40000', 'C1', '80', '2025-01-07'),   # di bawah cutoff
+], columns=['Produk Toko Saya', 'Harga Toko Saya', 'Produk Kompetitor', 'Harga Kompetitor', 'Toko Kompetitor',
+            'Skor Kemiripan', 'Tanggal_Update'])
+
+
+def test_price_comparison_summary_and_offers():
+    comparison = build_price_comparison(derive_frames(rekap(PRICE_ROWS)), PRICE_MATCHES, score_cutoff=85)
+    assert comparison['total_competitor_stores'] == 2
+    summary = comparison['summary']
+    a, b = summary.loc['KB A'], summary.loc['KB B']
+    assert (a['Harga'], a['Jumlah Penawaran'], a['Harga Termurah Kompetitor'], a['Toko Termurah']) == (100_000, 2, 90_000, 'C1')
+    assert (a['Selisih vs Termurah'], a['Selisih vs Termurah (%)'], a['Persentil Harga']) == (10_000, 11.1, 50)
+    assert (a['Ready'], a['Habis']) == (1, 1)   # KB A2 di C2 sedang habis
+    assert a['Harga Rata-Rata'] == np.mean([110_000, 100_000]) and a['Toko Omzet Tertinggi'] == 'DB KLIK'
+    assert b['Jumlah Penawaran'] == 0 and np.isnan(b['Harga Termurah Kompetitor']) and (b['Ready'], b['Habis']) == (0, 2)
+
+    offers = comparison['offers']
+    assert set(offers) == {'KB A'}
+    assert offers['KB A']['Produk Kompetitor'].tolist() == ['KB A1', 'KB A2']   # urut skor
+    assert offers['KB A']['Selisih Harga'].tolist() == [-10_000, 10_000]
+    assert offers['KB A']['Omzet'].tolist() == [90_000 * 20, 110_000 * 5]
+
+
+def test_price_comparison_without_matches():
+    comparison = build_price_comparison(derive_frames(rekap(PRICE_ROWS)), pd.DataFrame(), score_cutoff=85)
+    summary = comparison['summary']
+    assert comparison['offers'] == {} and (summary['Jumlah Penawaran'] == 0).all()
+    assert summary['Habis'].tolist() == [2, 2]
+
+
+# ================================
+# KETERSEDIAAN PRODUK (TAB 6)
+# ================================
+W1, W2, W3 = (pd.Timestamp(day) for day in ('2025-01-06', '2025-01-13', '2025-01-20'))
+AVAILABILITY_ROWS = [
+    ('06/01/2025', 'C1', 'Tersedia', 'P', '10', 0, ''), ('13/01/2025', 'C1', 'Habis', 'P', '10', 0, ''),
+    ('20/01/2025', 'C1', 'Tersedia', 'P', '10', 0, ''),
+    ('13/01/2025', 'C1', 'Tersedia', 'R', '30', 0, ''), ('21/01/2025', 'C1', 'Habis', 'R', '30', 0, ''),
+    ('22/01/2025', 'C1', 'Tersedia', 'Q', '20', 0, ''),
+]
+
+def changes(df, week_a, week_b, **kwargs):
+    result = availability_changes(build_availability_index(df), week_a, week_b, **kwargs)
+    return sorted(zip(result['Nama Produk'], result['Perubahan']))
+
+
+def test_availability_new_restock_and_gone():
+    df = rekap(AVAILABILITY_ROWS)
+    assert changes(df, W1, W2) == [('P', 'Hilang'), ('R', 'Baru')]
+    assert changes(df, W2, W3) == [('P', 'Restock'), ('Q', 'Baru'), ('R', 'Hilang')]
+    assert changes(df, W1, W3) == [('Q', 'Baru')]   # P tersedia di kedua minggu
+
+    weekly = derive_frames(df)['latest_entries_weekly']
+    detail = availability_changes(build_availability_index(df), W2, W3, weekly_rows=weekly).set_index('Nama Produk')
+    assert detail.loc['Q', 'Harga'] == 20 and detail.loc['Q', 'Minggu'] == W3
+    assert detail.loc['R', 'Minggu'] == W2   # Hilang: detail dari minggu A
+
+
+def test_availability_matches_naive_set_difference(tmp_path):
+    path = write_sheets(generate_sheets(n_stores=3, n_products=40, n_days=22, seed=4), str(tmp_path / 'sheets.json'))
+    df, _, _ = load_all_data(LocalSheetsClient(path), 'offline')
+    index = build_availability_index(df)
+    ready = df[df['Status'] == 'Tersedia']
+    weeks_by_product = ready.groupby([ready['Toko'].astype(str), ready['Nama Produk'].astype(str)])['Minggu'].agg(set)
+    weeks = list(index['weeks'])
+    assert len(weeks) >= 3
+    for week_a in weeks:
+        for week_b in weeks:
+            if week_a >= week_b: continue
+            expected = set()
+            for (toko, name), seen in weeks_by_product.items():
+                if week_b in seen and week_a not in seen:
+                    expected.add((toko, name, 'Baru' if min(seen) > week_a else 'Restock'))
+                elif week_a in seen and week_b not in seen:
+                    expected.add((toko, name, 'Hilang'))
+            result = availability_changes(index, week_a, week_b)
+            assert set(zip(result['Toko'], result['Nama Produk'], result['Perubahan'])) == expected
+
+
+# ================================
+# ANALISIS HPP
+# ================================
+DATABASE = pd.DataFrame({'SKU': ['S1', 'S2', 'S2', 'S3', ''], 'HPP (LATEST)': ['95000', '', '60000', None, '1'],
+                         'HPP (AVERAGE)': ['94000', '55000', '61000', None, '1']})
+HPP_ROWS = [
+    ('06/01/2025', 'DB KLIK', 'Tersedia', 'KB A', '90.000', 10, 'S1'),   # minggu 1: di bawah HPP
+    ('07/01/2025', 'DB KLIK', 'Tersedia', 'KB B', '50.000', 4, 'S2'),
+    ('13/01/2025', 'DB KLIK', 'Tersedia', 'KB A', '100.000', 10, 'S1'),
+    ('13/01/2025', 'DB KLIK', 'Tersedia', 'KB B', '50.000', 4, 'S2'),
+    ('13/01/2025', 'DB KLIK', 'Tersedia', 'KB C', '70.000', 1, 'S3'),
+]
+
+
+def test_hpp_index_prefers_latest_then_average():
+    index = hpp_index(DATABASE)
+    assert index.to_dict() == {'S1': 95_000, 'S2': 55_000}   # SKU ganda: baris pertama; tanpa HPP / SKU kosong dibuang
+    assert hpp_index(pd.DataFrame()).empty
+
+
+def test_hpp_tables_split_latest_snapshot():
+    df = rekap(HPP_ROWS)
+    merged = merge_hpp(derive_frames(df)['my_latest_products'], DATABASE)
+    tables = hpp_tables(merged)
+    assert tables['rugi']['Nama Produk'].astype(str).tolist() == ['KB B'] and tables['rugi']['Selisih'].tolist() == [-5_000]
+    assert tables['untung']['Nama Produk'].astype(str).tolist() == ['KB A']
+    assert tables['tidak_ditemukan']['Nama Produk'].astype(str).tolist() == ['KB C']
+    assert 'HPP' not in tables['tidak_ditemukan'].columns and 'Terjual/Bln' in tables['rugi'].columns
+
+
+def test_hpp_margin_history_per_week():
+    df = rekap(HPP_ROWS)
+    history = hpp_margin_history(df, hpp_index(DATABASE))
+    assert set(history['per_sku']['SKU']) == {'S1', 'S2'} and len(history['per_sku']) == 4
+    weekly = history['mingguan'].set_index('Minggu')
+    assert weekly.loc[W1, 'Produk di Bawah HPP'] == 2 and weekly.loc[W1, 'Produk ber-HPP'] == 2
+    assert weekly.loc[W1, 'Potensi Rugi/Bulan'] == 5_000 * 10 + 5_000 * 4
+    assert (weekly.loc[W2, 'Produk di Bawah HPP'], weekly.loc[W2, 'Potensi Rugi/Bulan']) == (1, 5_000 * 4)
+    empty = hpp_margin_history(df.iloc[:0], hpp_index(DATABASE))
+    assert empty['per_sku'].empty and empty['mingguan'].empty